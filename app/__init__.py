@@ -55,4 +55,5 @@ app.register_blueprint(leaderboard_endpoints)
 from app.utils.app_functions import (
     before_request,
     after_request,
-)
\ No newline at end of file
+)
+from app.utils import cli_commands
\ No newline at end of file
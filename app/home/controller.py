@@ -1,9 +1,34 @@
 from flask import (
-    jsonify
+    jsonify,
+    request
 )
 from app.models.response import Response
+from app.utils import metrics
 
 
 def home():
     response = Response(errorStatus=0, message_en="⚡Pocket Ninja", message_ja="⚡Pocket Ninja")
     return jsonify(response.to_dict()), 200
+
+
+def get_metrics():
+    """
+    GET /metrics
+    Returns this worker's counters and gauges.
+    Requires 'Authorization: Bearer <METRICS_TOKEN>'; without a configured token the route does not exist.
+    """
+    if not metrics.METRICS_TOKEN:
+        response = Response(message_en="Not found.", message_ja="見つかりません。")
+        return jsonify(response.to_dict()), 404
+
+    if not metrics.is_authorized(request.headers.get("Authorization")):
+        response = Response(message_en="Invalid metrics token.", message_ja="メトリクスのトークンが無効です。")
+        return jsonify(response.to_dict()), 401
+
+    response = Response(
+        errorStatus=0,
+        message_en="Metrics fetched successfully.",
+        message_ja="メトリクスが正常に取得されました。",
+        result=metrics.snapshot()
+    )
+    return jsonify(response.to_dict()), 200
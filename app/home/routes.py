@@ -1,7 +1,8 @@
 from flask import Blueprint
 
-from app.home.controller import home
+from app.home.controller import home, get_metrics
 
 home_endpoints = Blueprint('home', __name__)
 
 home_endpoints.add_url_rule(rule='/', view_func=home, methods=['GET'])
+home_endpoints.add_url_rule(rule='/metrics', view_func=get_metrics, methods=['GET'])
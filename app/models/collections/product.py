@@ -1,13 +1,101 @@
+import os
+import threading
+
 from app import db
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from difflib import SequenceMatcher
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.utils import catalog_snapshot, metrics
+from app.utils.catalog_snapshot import SnapshotDocs, SnapshotPositions
+from app.utils.ngram_index import NgramIndex
+from app.utils.prefix_index import PrefixIndex
+from app.utils.text_normalizer import canonicalize_product_name
+
+# Number of candidates the n-gram index hands to SequenceMatcher per lookup
+FUZZY_SHORTLIST_SIZE = 50
+
+# Products appended to the index since its last build; past this the next sync rebuilds it
+INDEX_OVERLAY_REBUILD_SIZE = 2000
+
+# Minimum time between background rebuilds of the autocomplete index
+PREFIX_INDEX_REBUILD_INTERVAL = timedelta(seconds=10)
+
+# Projection of the fields the in-memory cache keeps per product
+CACHE_PROJECTION = {"name": 1, "englishName": 1, "aliases": 1, "updatedAt": 1}
+
+# How long a worker may serve fuzzy matches from its cache before pulling other workers' changes
+PRODUCT_CACHE_MAX_STALENESS = timedelta(seconds=float(os.getenv("PRODUCT_CACHE_MAX_STALENESS_SECONDS", "60")))
+
+# Delta queries re-read this much history so writes stamped slightly before the
+# watermark (slow requests, clock skew between workers) are not missed
+PRODUCT_CACHE_SYNC_OVERLAP = timedelta(seconds=30)
+
+# Directory for the memory-mapped catalog snapshot shared by all workers on a host.
+# Unset: every worker keeps (and rebuilds) a private in-memory cache.
+PRODUCT_SNAPSHOT_DIR = os.getenv("PRODUCT_SNAPSHOT_DIR", "")
+
+
+# Update-pipeline stage that recomputes the cheapest-price summary from the 'prices' array,
+# so reads never have to scan it: {minPrice, store, date, storeCount}.
+# $min over {price, store, date} documents compares by price first, then store name.
+PRICE_SUMMARY_STAGE = {"$set": {"priceSummary": {"$let": {
+    "vars": {"entries": {"$ifNull": ["$prices", []]}},
+    "in": {"$let": {
+        "vars": {"cheapest": {"$min": {"$map": {
+            "input": "$$entries",
+            "in": {"price": "$$this.price", "store": "$$this.store", "date": "$$this.date"}
+        }}}},
+        "in": {
+            "minPrice": "$$cheapest.price",
+            "store": "$$cheapest.store",
+            "date": "$$cheapest.date",
+            "storeCount": {"$size": "$$entries"}
+        }
+    }}
+}}}}
+
+# Update-pipeline stage converting the legacy 'prices.<store>: {price, date}' map into
+# the indexable [{store, price, date}] array. A no-op on documents already migrated.
+PRICES_TO_ARRAY_STAGE = {"$set": {"prices": {"$cond": [
+    {"$eq": [{"$type": "$prices"}, "object"]},
+    {"$map": {
+        "input": {"$objectToArray": "$prices"},
+        "in": {"store": "$$this.k", "price": "$$this.v.price", "date": "$$this.v.date"}
+    }},
+    {"$ifNull": ["$prices", []]}
+]}}}
+
+_indexes_ready = False
 
 
 class Product:
     # Simple in-memory cache to avoid fetching all products every time
-    # Structure: [{'id': ObjectId, 'name': 'Coca Cola', 'aliases': []}, ...]
+    # Structure: [{'_id': ObjectId, 'name': 'Coca Cola', 'aliases': []}, ...]
     _product_cache = None
+    # N-gram index over cached names and aliases -> position in _product_cache
+    _product_index = None
+    # _id -> position in _product_cache
+    _cache_positions = None
+    # Bumped on every change applied to the cache
+    _cache_version = 0
+    # Latest 'updatedAt' seen in the products collection; delta syncs start here
+    _cache_watermark = None
     _last_cache_update = None
+    # Shared catalog snapshot backing the cache when PRODUCT_SNAPSHOT_DIR is set
+    _snapshot = None
+    _cache_lock = threading.RLock()
+    # Set while one thread runs a delta sync
+    _cache_syncing = False
+
+    # Autocomplete index over the cache, rebuilt off the request thread when the cache version moves
+    _prefix_index = None
+    _prefix_index_docs = None
+    _prefix_index_version = None
+    _prefix_index_built_at = None
+    _prefix_index_rebuilding = False
 
     @staticmethod
     def get_collection():
@@ -15,50 +103,428 @@ class Product:
             return None
         return db['products']
 
+    @staticmethod
+    def ensure_indexes():
+        collection = Product.get_collection()
+        if collection is None:
+            return
+        try:
+            collection.create_index([("name", 1)])
+            collection.create_index([("aliases", 1)])
+            collection.create_index([("nameKeys", 1)])
+            # Multikey indexes for per-store queries: cheapest at a store, prices updated since X
+            collection.create_index([("prices.store", 1), ("prices.price", 1)])
+            collection.create_index([("prices.store", 1), ("prices.date", -1)])
+            collection.create_index([("updatedAt", 1)])
+        except Exception as e:
+            print(f"Error creating product indexes: {e}")
+
+    @staticmethod
+    def get_price_summary(product_id: str = None, name: str = None):
+        """
+        Fetches a product with its precomputed cheapest-price summary.
+        Looks up by id, else by exact name/alias, else by canonical name key.
+        Returns (doc, matched_by) where matched_by is 'id', 'name' or 'normalized'; (None, None) if not found.
+        """
+        collection = Product.get_collection()
+        if collection is None:
+            return None, None
+
+        projection = {"name": 1, "englishName": 1, "priceSummary": 1}
+
+        if product_id:
+            if not ObjectId.is_valid(product_id):
+                return None, None
+            doc = collection.find_one({"_id": ObjectId(product_id)}, projection)
+            return (doc, "id") if doc else (None, None)
+
+        if not name:
+            return None, None
+
+        doc = collection.find_one({"$or": [{"name": name}, {"aliases": name}]}, projection)
+        if doc:
+            return doc, "name"
+
+        name_key = canonicalize_product_name(name)
+        if name_key:
+            doc = collection.find_one({"nameKeys": name_key}, projection)
+            if doc:
+                return doc, "normalized"
+
+        return None, None
+
+    @staticmethod
+    def resolve_products(product_ids: list = (), names: list = ()):
+        """
+        Resolves many products at once with their prices, for basket comparisons.
+        Ids are looked up directly; names go through the same tiers as receipt items
+        (exact name/alias, canonical name key, then fuzzy against the cache).
+        Returns ({id: doc}, {name: (doc, matched_by)}); unresolved entries are left out.
+        """
+        collection = Product.get_collection()
+        if collection is None:
+            return {}, {}
+
+        projection = {"name": 1, "englishName": 1, "prices": 1}
+
+        ids = list({ObjectId(product_id) for product_id in product_ids if ObjectId.is_valid(product_id)})
+        by_id = {
+            str(doc['_id']): doc
+            for doc in collection.find({"_id": {"$in": ids}}, projection)
+        } if ids else {}
+
+        names = list(dict.fromkeys(name for name in names if name))
+        if not names:
+            return by_id, {}
+
+        keys = list({canonicalize_product_name(name) for name in names} - {""})
+        by_name, by_alias, by_key = {}, {}, {}
+        for doc in collection.find({"$or": [
+            {"name": {"$in": names}},
+            {"aliases": {"$in": names}},
+            {"nameKeys": {"$in": keys}}
+        ]}, dict(projection, aliases=1, nameKeys=1)):
+            by_name.setdefault(doc.get('name'), doc)
+            for alias in doc.get('aliases', []):
+                by_alias.setdefault(alias, doc)
+            for key in doc.get('nameKeys', []):
+                by_key.setdefault(key, doc)
+
+        resolved = {}
+        unmatched = []
+        for name in names:
+            doc = by_name.get(name) or by_alias.get(name)
+            if doc:
+                resolved[name] = (doc, "name")
+                continue
+            doc = by_key.get(canonicalize_product_name(name))
+            if doc:
+                resolved[name] = (doc, "normalized")
+            else:
+                unmatched.append(name)
+
+        if unmatched:
+            Product._ensure_cache(collection)
+            fuzzy = {
+                name: cached['_id']
+                for name, (cached, _) in zip(unmatched, Product._fuzzy_match_batch(unmatched))
+                if cached
+            }
+            # The cache holds names only; fetch the matched products' prices
+            docs = {
+                doc['_id']: doc
+                for doc in collection.find({"_id": {"$in": list(set(fuzzy.values()))}}, projection)
+            } if fuzzy else {}
+            for name, product_id in fuzzy.items():
+                if product_id in docs:
+                    resolved[name] = (docs[product_id], "fuzzy")
+
+        return by_id, resolved
+
+    @staticmethod
+    def get_price_entries(product: dict) -> list:
+        """The product's prices as [{store, price, date}], whichever layout the document is in."""
+        prices = product.get('prices') or []
+        if isinstance(prices, dict):
+            # Not yet migrated to the array layout
+            return [dict(entry, store=store) for store, entry in prices.items() if isinstance(entry, dict)]
+        return [entry for entry in prices if isinstance(entry, dict)]
+
+    @staticmethod
+    def search_by_prefix(query: str, limit: int = 10):
+        """
+        Autocomplete over canonical names, English names and aliases.
+        Returns up to `limit` cached product docs, best first.
+        """
+        collection = Product.get_collection()
+        if collection is None:
+            return []
+
+        Product._ensure_cache(collection)
+
+        if Product._prefix_index is None:
+            # First use in this worker: nothing to serve yet, so build inline once
+            Product._rebuild_prefix_index()
+        elif Product._prefix_index_version != Product._cache_version:
+            Product._schedule_prefix_index_rebuild()
+
+        index, docs = Product._prefix_index, Product._prefix_index_docs
+        return [docs[position] for position in index.search(query, limit)]
+
+    @staticmethod
+    def _schedule_prefix_index_rebuild():
+        """Starts one background rebuild unless one is running or the last one was too recent."""
+        with Product._cache_lock:
+            if Product._prefix_index_rebuilding:
+                return
+            if datetime.now(timezone.utc) - Product._prefix_index_built_at < PREFIX_INDEX_REBUILD_INTERVAL:
+                return
+            Product._prefix_index_rebuilding = True
+
+        threading.Thread(target=Product._rebuild_prefix_index, daemon=True).start()
+
+    @staticmethod
+    def _rebuild_prefix_index():
+        """Builds a new autocomplete index from the cache and swaps it in; readers keep the old one meanwhile."""
+        try:
+            with Product._cache_lock:
+                docs = Product._product_cache
+                version = Product._cache_version
+                size = len(docs)
+
+            entries = []
+            for position in range(size):
+                doc = docs[position]
+                entries.append((doc.get('name', ''), position, 0))
+                english_name = doc.get('englishName') or ''
+                # Every word start of the English name, so "cola" finds "Coca Cola"
+                words = english_name.split()
+                for i in range(len(words)):
+                    entries.append((" ".join(words[i:]), position, 1 if i == 0 else 2))
+                for alias in doc.get('aliases', []):
+                    entries.append((alias, position, 3))
+
+            index = PrefixIndex(entries)
+
+            with Product._cache_lock:
+                Product._prefix_index = index
+                Product._prefix_index_docs = docs
+                Product._prefix_index_version = version
+                Product._prefix_index_built_at = datetime.now(timezone.utc)
+        except Exception as e:
+            print(f"Error rebuilding product prefix index: {e}")
+        finally:
+            Product._prefix_index_rebuilding = False
+
     @staticmethod
     def _refresh_cache(collection):
         """
-        Refreshes the internal product name cache. 
+        Refreshes the internal product name cache with a full catalog read.
         In production, you might use Redis or a proper caching strategy.
         """
-        cursor = collection.find({}, {"name": 1, "aliases": 1})
-        Product._product_cache = list(cursor)
-        Product._last_cache_update = datetime.now()
+        if PRODUCT_SNAPSHOT_DIR:
+            Product._load_snapshot(collection)
+            return
+
+        cursor = collection.find({}, CACHE_PROJECTION)
+        Product._set_cache(list(cursor))
 
     @staticmethod
-    def _find_best_match(collection, input_name, threshold=0.85):
+    def _sync_cache(collection):
         """
-        Finds the best matching product using a tiered approach:
-        1. Exact Match (Name or Alias)
-        2. Fuzzy Match (Similarity > threshold)
+        Pulls products changed by other workers since the watermark and applies them in place.
+        Falls back to a full refresh if the cache was never loaded. One sync runs at a time;
+        requests arriving meanwhile keep using the current cache.
         """
-        # 1. Exact DB Lookup (Fastest)
-        # Check if input_name matches 'name' OR exists in 'aliases' array
-        exact_match = collection.find_one({
-            "$or": [
-                {"name": input_name},
-                {"aliases": input_name}
-            ]
-        })
-        if exact_match:
-            return exact_match, 1.0  # 1.0 = 100% match
+        if Product._product_cache is None or Product._cache_watermark is None:
+            Product._refresh_cache(collection)
+            return
+
+        with Product._cache_lock:
+            if Product._cache_syncing:
+                return
+            Product._cache_syncing = True
 
-        # 2. Fuzzy Matching (Slower - requires cache)
-        # If cache is empty or old (e.g., > 5 mins), refresh it
+        try:
+            snapshot = Product._snapshot
+            if snapshot is not None and catalog_snapshot.current_version(PRODUCT_SNAPSHOT_DIR) != snapshot.version:
+                # Another worker published a newer snapshot: switch to it rather than replaying its changes
+                Product._load_snapshot(collection)
+                return
+
+            Product._pull_changes(collection)
+
+            # Fold the in-place additions back into the vectorized part of the index
+            if Product._product_index.overlay_size > INDEX_OVERLAY_REBUILD_SIZE:
+                if PRODUCT_SNAPSHOT_DIR:
+                    Product._load_snapshot(collection, stale_version=snapshot.version if snapshot is not None else None)
+                else:
+                    Product._rebuild_index()
+        finally:
+            Product._cache_syncing = False
+
+    @staticmethod
+    def _pull_changes(collection):
+        """Applies every product changed since the watermark (minus the overlap) to the cache."""
+        since = Product._cache_watermark - PRODUCT_CACHE_SYNC_OVERLAP
+        # Read the delta before taking the lock so lookups aren't blocked on the round trip
+        docs = list(collection.find({"updatedAt": {"$gte": since}}, CACHE_PROJECTION))
+
+        with Product._cache_lock:
+            for doc in docs:
+                Product._apply_to_cache(doc)
+            Product._last_cache_update = datetime.now(timezone.utc)
+
+    @staticmethod
+    def _load_snapshot(collection, stale_version=None):
+        """
+        Switches the cache to the published catalog snapshot, building a new one first if there
+        is none or it is still `stale_version` (only one process builds; see build_or_load).
+        Changes made since the snapshot was built are pulled on top of it.
+        """
+        def load_docs():
+            return list(collection.find({}, CACHE_PROJECTION))
+
+        try:
+            snapshot = catalog_snapshot.build_or_load(PRODUCT_SNAPSHOT_DIR, load_docs, stale_version)
+        except Exception as e:
+            print(f"Error loading product catalog snapshot, using a private cache: {e}")
+            Product._snapshot = None
+            Product._set_cache(load_docs())
+            return
+
+        with Product._cache_lock:
+            Product._snapshot = snapshot
+            Product._product_cache = SnapshotDocs(snapshot)
+            Product._product_index = snapshot.index
+            Product._cache_positions = SnapshotPositions(snapshot)
+            Product._cache_watermark = snapshot.watermark or snapshot.built_at
+            Product._cache_version += 1
+
+        # Cheap indexed delta; covers writes made since the snapshot was built
+        Product._pull_changes(collection)
+
+    @staticmethod
+    def _ensure_cache(collection):
+        """Loads the cache on first use and delta-syncs it once it is older than the max staleness."""
         if Product._product_cache is None:
             Product._refresh_cache(collection)
+        elif datetime.now(timezone.utc) - Product._last_cache_update > PRODUCT_CACHE_MAX_STALENESS:
+            Product._sync_cache(collection)
+
+    @staticmethod
+    def _set_cache(docs: list):
+        """Replaces the cache with `docs` and rebuilds the n-gram feature index over it."""
+        index, positions = Product._build_index(docs)
+        watermark = None
+        for doc in docs:
+            watermark = Product._later(watermark, doc.get('updatedAt'))
+
+        with Product._cache_lock:
+            Product._product_cache = docs
+            Product._product_index = index
+            Product._cache_positions = positions
+            Product._cache_watermark = watermark or datetime.now(timezone.utc)
+            Product._cache_version += 1
+            Product._last_cache_update = datetime.now(timezone.utc)
+
+    @staticmethod
+    def _rebuild_index():
+        """
+        Rebuilds the n-gram index over a copy of the cache, outside the lock, and swaps it in.
+        Entries replaced or appended while it was being built are replayed onto it first.
+        """
+        with Product._cache_lock:
+            source = Product._product_cache
+            version = Product._cache_version
+            docs = list(source)
+
+        index, positions = Product._build_index(docs)
+
+        with Product._cache_lock:
+            if Product._product_cache is not source:
+                # Reloaded meanwhile; that index is at least as fresh
+                return
+            if Product._cache_version != version:
+                for position in range(len(source)):
+                    doc = source[position]
+                    if position >= len(docs):
+                        docs.append(doc)
+                        positions[doc['_id']] = position
+                        Product._index_doc(index, position, doc)
+                    elif doc is not docs[position]:
+                        previous = docs[position]
+                        docs[position] = doc
+                        known = {previous.get('name', '')} | set(previous.get('aliases', []))
+                        Product._index_doc(index, position, doc, skip=known)
+
+            Product._product_cache = docs
+            Product._product_index = index
+            Product._cache_positions = positions
+            Product._cache_version += 1
 
+    @staticmethod
+    def _build_index(docs: list):
+        """Returns the n-gram index and the _id -> position map over `docs`."""
+        index = NgramIndex.build(
+            (position, text)
+            for position, doc in enumerate(docs)
+            for text in [doc.get('name', '')] + doc.get('aliases', [])
+        )
+        positions = {doc['_id']: position for position, doc in enumerate(docs)}
+        return index, positions
+
+    @staticmethod
+    def _index_doc(index, position, doc, skip=()):
+        for text in [doc.get('name', '')] + doc.get('aliases', []):
+            if text not in skip:
+                index.add(position, text)
+
+    @staticmethod
+    def _apply_to_cache(doc: dict):
+        """
+        Inserts or replaces one product in the cache without a reload.
+        Only names/aliases the cache hasn't seen for this product are added to the index.
+        """
+        with Product._cache_lock:
+            if Product._product_cache is None:
+                return
+
+            position = Product._cache_positions.get(doc['_id'])
+            if position is None:
+                position = len(Product._product_cache)
+                Product._product_cache.append(doc)
+                Product._cache_positions[doc['_id']] = position
+                Product._index_doc(Product._product_index, position, doc)
+            else:
+                cached = Product._product_cache[position]
+                known = {cached.get('name', '')} | set(cached.get('aliases', []))
+                Product._product_cache[position] = doc
+                Product._index_doc(Product._product_index, position, doc, skip=known)
+
+            Product._cache_watermark = Product._later(Product._cache_watermark, doc.get('updatedAt'))
+            Product._cache_version += 1
+
+    @staticmethod
+    def _later(current, candidate):
+        """Returns the later of two optional datetimes (Mongo hands back naive UTC)."""
+        if not isinstance(candidate, datetime):
+            return current
+        if candidate.tzinfo is None:
+            candidate = candidate.replace(tzinfo=timezone.utc)
+        return candidate if current is None or candidate > current else current
+
+    @staticmethod
+    def _fuzzy_match_batch(input_names: list, threshold=0.85) -> list:
+        """
+        Scores the cached products against every name in one pass.
+        The n-gram index shortlists candidates for all names with a vectorized
+        shared-gram count; only those are confirmed with SequenceMatcher, in cache
+        order so ties resolve the same way as a full scan.
+        Returns one (doc, ratio) or (None, 0.0) per name.
+        """
+        shortlists = Product._product_index.shortlist_batch(input_names, limit=FUZZY_SHORTLIST_SIZE)
+
+        results = []
+        for input_name, shortlist in zip(input_names, shortlists):
+            candidates = [Product._product_cache[position] for position in sorted(shortlist)]
+            results.append(Product._best_candidate(input_name, candidates, threshold))
+        return results
+
+    @staticmethod
+    def _best_candidate(input_name, candidates, threshold=0.85):
+        """Returns the (doc, ratio) of the best candidate at or above threshold, else (None, 0.0)."""
         best_doc = None
         best_ratio = 0.0
 
-        for doc in Product._product_cache:
+        for doc in candidates:
             # Compare with canonical name
-            ratio = SequenceMatcher(None, input_name, doc.get('name', '')).ratio()
+            ratio = Product._similarity(input_name, doc.get('name', ''), threshold)
 
             # If canonical didn't match well, check aliases
             if ratio < threshold and 'aliases' in doc:
                 for alias in doc['aliases']:
-                    alias_ratio = SequenceMatcher(None, input_name, alias).ratio()
+                    alias_ratio = Product._similarity(input_name, alias, threshold)
                     if alias_ratio > ratio:
                         ratio = alias_ratio
 
@@ -71,116 +537,314 @@ class Product:
 
         return None, 0.0
 
+    @staticmethod
+    def _similarity(a: str, b: str, threshold: float) -> float:
+        """
+        SequenceMatcher ratio, skipping the full computation when the cheap upper
+        bounds already rule out reaching the threshold (0.0 is returned then).
+        """
+        matcher = SequenceMatcher(None, a, b)
+        if matcher.real_quick_ratio() < threshold or matcher.quick_ratio() < threshold:
+            return 0.0
+        return matcher.ratio()
+
+    @staticmethod
+    def _store_price(product: dict, store_name: str):
+        """Returns the product's {store, price, date} entry for store_name, or None."""
+        for entry in Product.get_price_entries(product):
+            if entry.get('store') == store_name:
+                return entry
+        return None
+
+    @staticmethod
+    def _should_update_price(product: dict, store_name: str, now: datetime) -> bool:
+        """A store price is rewritten unless it already carries a date at or after `now`."""
+        existing_store_data = Product._store_price(product, store_name)
+        if existing_store_data is None:
+            return True
+
+        last_date = existing_store_data.get('date')
+        if not isinstance(last_date, datetime):
+            return True
+
+        # Mongo hands back naive UTC datetimes
+        if last_date.tzinfo is None:
+            last_date = last_date.replace(tzinfo=timezone.utc)
+        return last_date < now
+
+    @staticmethod
+    def _record_match_tiers(store_name: str, tier_counts: dict):
+        """
+        Adds one receipt's match tiers to the process metrics and logs the exact-hit rate
+        (raw name/alias hits plus canonical-key hits over all resolved items).
+        """
+        for tier, count in tier_counts.items():
+            metrics.increment(f"product_match.{tier}", count)
+
+        resolved = sum(tier_counts.values())
+        if not resolved:
+            return
+
+        receipt_rate = (tier_counts["exact"] + tier_counts["normalized"]) / resolved
+        totals = {tier: metrics.get_counter(f"product_match.{tier}") for tier in tier_counts}
+        overall_rate = (totals["exact"] + totals["normalized"]) / (sum(totals.values()) or 1)
+        metrics.set_gauge("product_match.exact_hit_rate", round(overall_rate, 4))
+
+        print(f"Product matching for {store_name}: {tier_counts} "
+              f"exact-hit rate {receipt_rate:.0%} (worker total {overall_rate:.0%})")
+
     @staticmethod
     def bulk_upsert(store_name: str, products_data: list):
         """
         Updates product prices with Fuzzy Matching and Aliasing.
+
+        Every item on the receipt is resolved first (one `$in` query for exact
+        name/alias hits, the in-memory cache for fuzzy ones), then all inserts,
+        price updates and alias additions go out as a single unordered bulk_write.
+        Price updates are pipeline updates that also recompute the price summary.
         """
         collection = Product.get_collection()
         if collection is None:
             return 0
 
-        # --- Index Creation ---
-        try:
-            collection.create_index([("name", 1)])
-            collection.create_index([("aliases", 1)])
-            collection.create_index([("prices", 1)])
-        except Exception as e:
-            print(f"Error creating product indexes: {e}")
+        # --- Index Creation (once per process) ---
+        global _indexes_ready
+        if not _indexes_ready:
+            Product.ensure_indexes()
+            _indexes_ready = True
 
-        updated_count = 0
         now = datetime.now(timezone.utc)
 
-        for item in products_data:
-            input_name = item.get('name')
-            english_name = item.get('english_name')
-            price = item.get('price')
+        items = [
+            item for item in products_data
+            if item.get('name') and item.get('price') is not None
+        ]
+        if not items:
+            return 0
 
-            if not input_name or price is None:
-                continue
+        try:
+            # --- STEP 1: Exact Matches for the whole receipt in one round-trip ---
+            names = list({item['name'] for item in items})
+            keys = list({canonicalize_product_name(name) for name in names} - {""})
+            by_name = {}
+            by_alias = {}
+            by_key = {}
+            for doc in collection.find({"$or": [
+                {"name": {"$in": names}},
+                {"aliases": {"$in": names}},
+                {"nameKeys": {"$in": keys}}
+            ]}):
+                by_name.setdefault(doc.get('name'), doc)
+                for alias in doc.get('aliases', []):
+                    by_alias.setdefault(alias, doc)
+                for key in doc.get('nameKeys', []):
+                    by_key.setdefault(key, doc)
+        except Exception as e:
+            print(f"Error looking up products for {store_name}: {e}")
+            return 0
+
+        # product _id -> {"insert": doc} or {"price": ..., "englishName": ..., "aliases": [...], "nameKeys": [...]},
+        # in first-seen order
+        plans = {}
+        # product _id -> number of receipt items counted towards updated_count
+        item_counts = {}
+        # How each item was resolved: exact / normalized / fuzzy / new
+        tier_counts = {"exact": 0, "normalized": 0, "fuzzy": 0, "new": 0}
+        # Products created by this receipt, so near-identical names later on it collapse into them
+        pending_inserts = []
+
+        # --- STEP 2a: Fuzzy-match every remaining item against the catalog in one vectorized call ---
+        unmatched = list(dict.fromkeys(
+            item['name'] for item in items
+            if item['name'] not in by_name and item['name'] not in by_alias
+            and canonicalize_product_name(item['name']) not in by_key
+        ))
+        fuzzy_matches = {}
+        if unmatched:
+            Product._ensure_cache(collection)
+            fuzzy_matches = dict(zip(unmatched, Product._fuzzy_match_batch(unmatched)))
+
+        for item in items:
+            input_name = item['name']
+            english_name = item.get('english_name')
+            price = item['price']
+            name_key = canonicalize_product_name(input_name)
 
             try:
-                # --- STEP 1: Find Canonical Product ---
-                existing_product, similarity = Product._find_best_match(collection, input_name)
+                # --- STEP 2b: Find Canonical Product ---
+                existing_product = by_name.get(input_name) or by_alias.get(input_name)
+                similarity = 1.0
+                tier = "exact"
+
+                if not existing_product and name_key:
+                    existing_product = by_key.get(name_key)
+                    tier = "normalized"
+
+                if not existing_product:
+                    tier = "fuzzy"
+                    existing_product, similarity = fuzzy_matches.get(input_name, (None, 0.0))
 
-                should_update = False
-                is_fuzzy_match = False
+                    # Products inserted earlier on this receipt come after the catalog in cache order
+                    pending_product, pending_similarity = Product._best_candidate(input_name, pending_inserts)
+                    if pending_similarity > similarity:
+                        existing_product, similarity = pending_product, pending_similarity
+                    elif existing_product:
+                        # Work on a copy; the cached entry is replaced, not mutated
+                        existing_product = dict(existing_product)
 
                 if not existing_product:
                     # Case: Brand New Product
-                    collection.insert_one({
+                    tier_counts["new"] += 1
+                    new_product = {
+                        "_id": ObjectId(),
                         "name": input_name,
                         "englishName": english_name,
                         "aliases": [],  # Initialize empty alias list
-                        "prices": {
-                            store_name: {
+                        "nameKeys": [name_key] if name_key else [],
+                        "prices": [
+                            {
+                                "store": store_name,
                                 "price": price,
                                 "date": now
                             }
-                        }
+                        ],
+                        "priceSummary": {"minPrice": price, "store": store_name, "date": now, "storeCount": 1},
+                        "updatedAt": now
+                    }
+                    plans[new_product["_id"]] = {"insert": new_product}
+                    item_counts[new_product["_id"]] = 1
+                    pending_inserts.append(new_product)
+                    by_name[input_name] = new_product
+                    if name_key:
+                        by_key.setdefault(name_key, new_product)
+
+                    # Add to cache so near-identical names later on this receipt collapse into it
+                    Product._apply_to_cache({
+                        "_id": new_product["_id"], "name": input_name, "englishName": english_name,
+                        "aliases": [], "updatedAt": now
                     })
-                    # Add to cache to make it available for next items in this loop
-                    if Product._product_cache is not None:
-                        Product._product_cache.append({"name": input_name, "aliases": []})
-
-                    updated_count += 1
                     continue
 
-                # Case: Found Existing Product (Exact or Fuzzy)
+                # Case: Found Existing Product (Exact, Normalized or Fuzzy)
                 # If similarity is < 1.0, it means we found it via fuzzy match.
                 # We should add the 'input_name' to the 'aliases' of the existing product
                 # so future lookups are exact.
-                if similarity < 1.0:
-                    is_fuzzy_match = True
-
-                prices = existing_product.get('prices', {})
-                existing_store_data = prices.get(store_name)
+                tier_counts[tier] += 1
+                product_id = existing_product["_id"]
+                is_fuzzy_match = similarity < 1.0
+                should_update = Product._should_update_price(existing_product, store_name, now)
 
-                # --- STEP 2: Price Update Logic ---
-                if existing_store_data is None:
-                    should_update = True
-                else:
-                    last_date = existing_store_data.get('date')
-                    if last_date and isinstance(last_date, datetime):
-                        if last_date < now:
-                            should_update = True
-                    else:
-                        should_update = True
+                if not should_update and not is_fuzzy_match:
+                    continue
 
-                # --- STEP 3: Perform Update ---
-                # Prepare update query
-                update_query = {}
-                set_fields = {}
-                add_to_set_fields = {}
+                plan = plans.setdefault(product_id, {"price": None, "englishName": None, "aliases": [], "nameKeys": []})
+                target = plan.get("insert")
 
+                # --- STEP 3: Merge into the pending write for this product ---
                 if should_update:
-                    set_fields[f"prices.{store_name}"] = {"price": price, "date": now}
-                    # Always update English name to latest (or keep existing if current is better?)
-                    # Let's overwrite for now to keep it simple
-                    set_fields["englishName"] = english_name
-
-                if is_fuzzy_match:
-                    # Add the new variation to aliases so next time it's an exact match
-                    add_to_set_fields["aliases"] = input_name
+                    if target is not None:
+                        # Inserts only ever hold this receipt's store
+                        target["prices"][0].update(price=price, date=now)
+                        target["priceSummary"].update(minPrice=price, date=now)
+                        target["englishName"] = english_name
+                    else:
+                        plan["price"] = price
+                        # Always update English name to latest
+                        plan["englishName"] = english_name
 
-                # Construct MongoDB Query
-                if set_fields:
-                    update_query["$set"] = set_fields
+                    # Later duplicates of this item on the same receipt see the fresh price
+                    prices = [
+                        entry for entry in existing_product.get('prices') or []
+                        if isinstance(entry, dict) and entry.get('store') != store_name
+                    ]
+                    existing_product['prices'] = prices + [{"store": store_name, "price": price, "date": now}]
 
-                if add_to_set_fields:
-                    update_query["$addToSet"] = add_to_set_fields
+                if is_fuzzy_match:
+                    # Add the new variation (and its key) so next time it's an exact match
+                    aliases = target["aliases"] if target is not None else plan["aliases"]
+                    if input_name not in aliases:
+                        aliases.append(input_name)
+                    by_alias[input_name] = existing_product
+
+                    name_keys = target["nameKeys"] if target is not None else plan["nameKeys"]
+                    if name_key and name_key not in name_keys:
+                        name_keys.append(name_key)
+                        by_key.setdefault(name_key, existing_product)
+
+                    # Copy: for a product inserted on this receipt this is the insert's own list
+                    cached_aliases = list(existing_product.get('aliases', []))
+                    Product._apply_to_cache({
+                        "_id": product_id,
+                        "name": existing_product.get('name', ''),
+                        "englishName": english_name if should_update else existing_product.get('englishName'),
+                        "aliases": cached_aliases if input_name in cached_aliases else cached_aliases + [input_name],
+                        "updatedAt": now
+                    })
 
-                if update_query:
-                    collection.update_one(
-                        {"_id": existing_product["_id"]},
-                        update_query
-                    )
-                    updated_count += 1
+                item_counts[product_id] = item_counts.get(product_id, 0) + 1
 
             except Exception as e:
                 print(f"Error upserting product {input_name}: {e}")
 
-        # Invalidate cache after batch operation so next request fetches fresh data
-        Product._product_cache = None
+        Product._record_match_tiers(store_name, tier_counts)
+
+        # --- STEP 4: One unordered bulk_write for the whole receipt ---
+        operations = []
+        operation_products = []
+        for product_id, plan in plans.items():
+            if "insert" in plan:
+                operations.append(InsertOne(plan["insert"]))
+                operation_products.append(product_id)
+                continue
+
+            new_names = {field: plan[field] for field in ("aliases", "nameKeys") if plan[field]}
+
+            if plan["price"] is None:
+                # Alias-only change
+                add_to_set = {field: {"$each": values} for field, values in new_names.items()}
+                extra = {"$addToSet": add_to_set} if add_to_set else {}
+                operations.append(UpdateOne({"_id": product_id}, dict({"$set": {"updatedAt": now}}, **extra)))
+                operation_products.append(product_id)
+                continue
+
+            # One pipeline update, whichever 'prices' layout the document is in: convert a legacy map,
+            # replace this store's entry (or append it) and recompute the summary atomically with it
+            pipeline_set = {
+                "updatedAt": now,
+                "englishName": {"$literal": plan["englishName"]},
+                "prices": {"$concatArrays": [
+                    {"$filter": {"input": "$prices", "cond": {"$ne": ["$$this.store", {"$literal": store_name}]}}},
+                    {"$literal": [{"store": store_name, "price": plan["price"], "date": now}]}
+                ]}
+            }
+            for field, values in new_names.items():
+                # $addToSet equivalent: append the names the document doesn't have yet
+                existing = {"$ifNull": [f"${field}", []]}
+                pipeline_set[field] = {"$concatArrays": [existing, {"$filter": {
+                    "input": {"$literal": values},
+                    "cond": {"$eq": [{"$in": ["$$this", existing]}, False]}
+                }}]}
+            operations.append(UpdateOne(
+                {"_id": product_id},
+                [PRICES_TO_ARRAY_STAGE, {"$set": pipeline_set}, PRICE_SUMMARY_STAGE]
+            ))
+            operation_products.append(product_id)
+
+        if not operations:
+            return 0
+
+        failed_products = set()
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed_products.add(operation_products[error['index']])
+                print(f"Error upserting product {operations[error['index']]}: {error.get('errmsg')}")
+            # Some cached inserts/aliases never made it to the DB; reload on next use
+            Product._product_cache = None
+        except Exception as e:
+            print(f"Error writing products for {store_name}: {e}")
+            Product._product_cache = None
+            return 0
 
-        return updated_count
+        return sum(count for product_id, count in item_counts.items() if product_id not in failed_products)
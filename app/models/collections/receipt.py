@@ -1,6 +1,48 @@
+import base64
+import json
+import os
+
+import gridfs
+
 from app import db
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+from imaging.optimizer import IMAGE_HASH_BITS
+
+# How long a worker owns a claimed receipt; past this another worker may retry it
+RECEIPT_CLAIM_LEASE = timedelta(minutes=5)
+
+# Claims per receipt before it is given up on and marked FAILED
+RECEIPT_MAX_ATTEMPTS = 3
+
+# Near-duplicate detection on the 256-bit perceptual image hash. The hash is indexed as 16
+# position-tagged 16-bit chunks: two hashes within 15 bits of each other share at least one
+# chunk exactly (pigeonhole), so candidates come from an index lookup and only they get a Hamming check.
+IMAGE_HASH_CHUNKS = 16
+DUPLICATE_RECEIPT_MAX_DISTANCE = min(int(os.getenv("DUPLICATE_RECEIPT_MAX_DISTANCE", "14")), IMAGE_HASH_CHUNKS - 1)
+DUPLICATE_RECEIPT_WINDOW = timedelta(days=7)
+# PENDING receipts older than this are treated as abandoned, not as the original of a resubmission
+DUPLICATE_PENDING_WINDOW = timedelta(minutes=15)
+
+# Receipt history pages: default and maximum number of receipts per page
+RECEIPT_PAGE_SIZE = 20
+RECEIPT_MAX_PAGE_SIZE = 100
+
+# Fields of each receipt in a history page; the large 'result' is left to the per-receipt endpoint
+RECEIPT_LIST_PROJECTION = {
+    "status": 1, "submittedAt": 1, "storeName": 1, "totalAmount": 1,
+    "productsFound": 1, "productsUpdated": 1
+}
+
+# Fields returned to clients polling a receipt
+RECEIPT_STATUS_PROJECTION = {
+    "status": 1, "submittedAt": 1, "storeName": 1, "totalAmount": 1,
+    "productsFound": 1, "productsUpdated": 1, "result": 1
+}
+
+_indexes_ready = False
 
 
 class Receipt:
@@ -10,6 +52,28 @@ class Receipt:
             return None
         return db['receipts']
 
+    @staticmethod
+    def ensure_indexes():
+        collection = Receipt.get_collection()
+        if collection is None:
+            return
+        try:
+            # History pages: equality on userId, then newest first with _id as the tie-breaker
+            collection.create_index([("userId", 1), ("submittedAt", -1), ("_id", -1)])
+            # Queue scan of the receipt worker
+            collection.create_index([("status", 1), ("imageId", 1), ("submittedAt", 1)])
+            # Near-duplicate lookups (multikey over the hash chunks)
+            collection.create_index([("userId", 1), ("imageHashChunks", 1)])
+        except Exception as e:
+            print(f"Error creating receipt index: {e}")
+
+    @staticmethod
+    def get_image_store():
+        """GridFS bucket holding uploaded images until their receipt is processed."""
+        if db is None:
+            return None
+        return gridfs.GridFS(db, collection='receiptImages')
+
     @staticmethod
     def create_receipt(user_id: str):
         """
@@ -20,11 +84,10 @@ class Receipt:
         if collection is None:
             return None
 
-        # Add Index
-        try:
-            collection.create_index([("userId", 1)])
-        except Exception as e:
-            print(f"Error creating receipt index: {e}")
+        global _indexes_ready
+        if not _indexes_ready:
+            Receipt.ensure_indexes()
+            _indexes_ready = True
 
         document = {
             "userId": ObjectId(user_id),
@@ -67,53 +130,241 @@ class Receipt:
         )
 
     @staticmethod
-    def get_by_user(user_id: str, month: str = None):
+    def _hash_chunks(image_hash: int) -> list:
+        chunk_bits = IMAGE_HASH_BITS // IMAGE_HASH_CHUNKS
+        mask = (1 << chunk_bits) - 1
+        return [
+            f"{i}:{(image_hash >> (chunk_bits * (IMAGE_HASH_CHUNKS - 1 - i))) & mask:04x}"
+            for i in range(IMAGE_HASH_CHUNKS)
+        ]
+
+    @staticmethod
+    def set_image_hash(receipt_id, image_hash: int):
+        """Stores the perceptual hash of the receipt's image and its indexed chunks."""
+        collection = Receipt.get_collection()
+        if collection is None:
+            return
+        collection.update_one(
+            {"_id": receipt_id},
+            {"$set": {
+                "imageHash": f"{image_hash:0{IMAGE_HASH_BITS // 4}x}",
+                "imageHashChunks": Receipt._hash_chunks(image_hash)
+            }}
+        )
+
+    @staticmethod
+    def find_near_duplicate(user_id: str, receipt_id, image_hash: int):
+        """
+        Returns the user's earlier receipt whose image is within DUPLICATE_RECEIPT_MAX_DISTANCE bits
+        of `image_hash`: a recent SUCCESS, or a PENDING one still being processed. None otherwise.
+        Only receipts created before `receipt_id` count, so of two concurrent uploads the first wins.
+        """
+        collection = Receipt.get_collection()
+        if collection is None:
+            return None
+
+        now = datetime.now(timezone.utc)
+        candidates = collection.find(
+            {
+                "userId": ObjectId(user_id),
+                "imageHashChunks": {"$in": Receipt._hash_chunks(image_hash)},
+                "_id": {"$lt": receipt_id},
+                "$or": [
+                    {"status": "SUCCESS", "submittedAt": {"$gte": now - DUPLICATE_RECEIPT_WINDOW}},
+                    {"status": "PENDING", "submittedAt": {"$gte": now - DUPLICATE_PENDING_WINDOW}}
+                ]
+            },
+            {"status": 1, "imageHash": 1, "submittedAt": 1}
+        )
+
+        best = None
+        for doc in candidates:
+            distance = (int(doc['imageHash'], 16) ^ image_hash).bit_count()
+            if distance <= DUPLICATE_RECEIPT_MAX_DISTANCE and (best is None or distance < best[1]):
+                best = (doc, distance)
+        return best[0] if best else None
+
+    @staticmethod
+    def queue_image(receipt_id, image_bytes: bytes):
+        """Stores the optimized image of a PENDING receipt for the receipt worker."""
+        image_id = Receipt.get_image_store().put(image_bytes, receiptId=receipt_id)
+        Receipt.get_collection().update_one(
+            {"_id": receipt_id},
+            {"$set": {"imageId": image_id, "attempts": 0, "claimedUntil": None}}
+        )
+
+    @staticmethod
+    def claim_next(worker_id: str):
+        """
+        Atomically claims the oldest queued receipt whose lease is free or expired.
+        Returns the receipt document (with its new 'attempts' count), or None if the queue is empty.
+        """
+        collection = Receipt.get_collection()
+        if collection is None:
+            return None
+
+        now = datetime.now(timezone.utc)
+        return collection.find_one_and_update(
+            {
+                "status": "PENDING",
+                "imageId": {"$ne": None},
+                "$or": [{"claimedUntil": None}, {"claimedUntil": {"$lt": now}}]
+            },
+            {
+                "$set": {"claimedBy": worker_id, "claimedUntil": now + RECEIPT_CLAIM_LEASE},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("submittedAt", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def load_image(receipt: dict):
+        """Returns the queued image bytes of a claimed receipt, or None if it is gone."""
+        try:
+            return Receipt.get_image_store().get(receipt['imageId']).read()
+        except gridfs.NoFile:
+            return None
+
+    @staticmethod
+    def release_claim(receipt_id):
+        """Puts a receipt back in the queue after a failed attempt."""
+        Receipt.get_collection().update_one(
+            {"_id": receipt_id, "status": "PENDING"},
+            {"$set": {"claimedUntil": None}}
+        )
+
+    @staticmethod
+    def mark_side_effect(receipt_id, marker: str):
+        """Sets the `marker` timestamp (e.g. 'rewardedAt') once the side effect it stands for was applied."""
+        Receipt.get_collection().update_one(
+            {"_id": receipt_id, marker: {"$exists": False}},
+            {"$set": {marker: datetime.now(timezone.utc)}}
+        )
+
+    @staticmethod
+    def mark_products_applied(receipt_id, products_updated: int):
+        """Records that the receipt's prices are in the product database, so a retry does not apply them twice."""
+        Receipt.get_collection().update_one(
+            {"_id": receipt_id},
+            {"$set": {"productsAppliedAt": datetime.now(timezone.utc), "productsUpdated": products_updated}}
+        )
+
+    @staticmethod
+    def discard_image(receipt: dict):
+        """Deletes the queued image once the receipt reached SUCCESS or FAILED."""
+        try:
+            Receipt.get_image_store().delete(receipt['imageId'])
+        except Exception as e:
+            print(f"Error deleting image of receipt {receipt['_id']}: {e}")
+
+    @staticmethod
+    def get_status(receipt_id: str, user_id: str):
+        """Fetches one of the user's receipts for status polling; None if it doesn't exist or isn't theirs."""
+        collection = Receipt.get_collection()
+        if collection is None or not ObjectId.is_valid(receipt_id):
+            return None
+
+        # The _id lookup uses the primary index; userId only scopes it to the caller
+        return collection.find_one(
+            {"_id": ObjectId(receipt_id), "userId": ObjectId(user_id)},
+            RECEIPT_STATUS_PROJECTION
+        )
+
+    @staticmethod
+    def get_by_user(user_id: str, month: str = None, limit: int = RECEIPT_PAGE_SIZE, page_token: str = None):
         """
-        Fetches recent receipts for a user, filtered by month.
+        Fetches one page of a user's receipts for a month, newest first.
 
         :param user_id: The ID of the user.
         :param month: String in "YYYY-MM" format. Defaults to current UTC month if None.
+        :param limit: Page size, capped at RECEIPT_MAX_PAGE_SIZE.
+        :param page_token: 'nextPageToken' of the previous page, None for the first page.
+        :return: (receipts, next page token or None). Receipts carry the slim RECEIPT_LIST_PROJECTION
+                 fields plus 'receiptId'; the full result comes from GET /user/receipt/<receiptId>.
+        :raises ValueError: If the page token is malformed or belongs to another month.
         """
         collection = Receipt.get_collection()
         if collection is None:
-            return []
+            return [], None
 
         # Default to current month if not provided
         if month is None:
             month = datetime.now(timezone.utc).strftime("%Y-%m")
 
         try:
-            # Parse the month string "YYYY-MM"
-            dt_start_naive = datetime.strptime(month, "%Y-%m")
+            dt_start, dt_end = Receipt._month_range(month)
+        except ValueError:
+            print(f"Invalid month format provided: {month}")
+            return [], None
+
+        query = {
+            "userId": ObjectId(user_id),
+            "submittedAt": {
+                "$gte": dt_start,
+                "$lt": dt_end
+            }
+        }
 
-            # Make it timezone aware (UTC) to match database storage
-            dt_start = dt_start_naive.replace(tzinfo=timezone.utc)
+        # Keyset pagination: continue strictly after the last (submittedAt, _id) of the previous page
+        if page_token:
+            last_submitted_at, last_id = Receipt._decode_page_token(page_token, month)
+            query["$or"] = [
+                {"submittedAt": {"$lt": last_submitted_at}},
+                {"submittedAt": last_submitted_at, "_id": {"$lt": last_id}}
+            ]
 
-            # Calculate the start of the next month for the upper bound
-            if dt_start.month == 12:
-                dt_end = dt_start.replace(year=dt_start.year + 1, month=1)
-            else:
-                dt_end = dt_start.replace(month=dt_start.month + 1)
+        limit = max(1, min(limit, RECEIPT_MAX_PAGE_SIZE))
+        # Served in index order by (userId, submittedAt, _id); one extra document tells whether a next page exists
+        cursor = collection.find(query, RECEIPT_LIST_PROJECTION).sort(
+            [("submittedAt", -1), ("_id", -1)]
+        ).limit(limit + 1)
+        docs = list(cursor)
 
-            query = {
-                "userId": ObjectId(user_id),
-                "submittedAt": {
-                    "$gte": dt_start,
-                    "$lt": dt_end
-                }
-            }
-        except ValueError:
-            print(f"Invalid month format provided: {month}")
-            return []
+        next_token = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_token = Receipt._encode_page_token(docs[-1], month)
+
+        for doc in docs:
+            doc['receiptId'] = str(doc.pop('_id'))
+        return docs, next_token
 
-        projection = {"_id": 0, "userId": 0, "result.result": 0}
+    @staticmethod
+    def _month_range(month: str):
+        """[start, end) of a "YYYY-MM" month in UTC; ValueError if malformed."""
+        # Parse the month string "YYYY-MM"
+        dt_start_naive = datetime.strptime(month, "%Y-%m")
+
+        # Make it timezone aware (UTC) to match database storage
+        dt_start = dt_start_naive.replace(tzinfo=timezone.utc)
+
+        # Calculate the start of the next month for the upper bound
+        if dt_start.month == 12:
+            dt_end = dt_start.replace(year=dt_start.year + 1, month=1)
+        else:
+            dt_end = dt_start.replace(month=dt_start.month + 1)
+        return dt_start, dt_end
 
-        cursor = collection.find(query, projection).sort("submittedAt", -1)
+    @staticmethod
+    def _encode_page_token(doc: dict, month: str) -> str:
+        """Opaque continuation token: the month and the (submittedAt, _id) key of the page's last receipt."""
+        submitted_at = doc['submittedAt']
+        if submitted_at.tzinfo is None:
+            submitted_at = submitted_at.replace(tzinfo=timezone.utc)
+        payload = {"m": month, "t": int(submitted_at.timestamp() * 1000), "i": str(doc['_id'])}
+        return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
 
-        # Convert ObjectId to str for JSON serialization
-        results = []
-        for doc in cursor:
-            # doc['_id'] = str(doc['_id'])
-            # doc['userId'] = str(doc['userId'])
-            results.append(doc)
-        return results
+    @staticmethod
+    def _decode_page_token(token: str, month: str):
+        """(submittedAt, _id) the next page starts after; ValueError if the token is not one of ours."""
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+            submitted_at = datetime.fromtimestamp(payload["t"] / 1000, tz=timezone.utc)
+            last_id = ObjectId(payload["i"])
+            token_month = payload["m"]
+        except Exception:
+            raise ValueError("Malformed page token")
+        if token_month != month:
+            raise ValueError("Page token belongs to another month")
+        return submitted_at, last_id
@@ -0,0 +1,81 @@
+import os
+
+from app import db
+from datetime import datetime, timezone, timedelta
+from pymongo.errors import DuplicateKeyError
+
+# How long a Gemini verdict for an image/prompt pair is reused
+ANALYSIS_CACHE_TTL = timedelta(seconds=int(os.getenv("GEMINI_ANALYSIS_CACHE_TTL_SECONDS", "86400")))
+
+
+class ReceiptAnalysisCache:
+    """
+    Shared cache of Gemini receipt analyses, keyed by image + prompt hash.
+    A document is either PENDING (one process is calling Gemini for it, until 'leaseUntil')
+    or DONE (holding the parsed result). Documents expire through a TTL index on 'createdAt'.
+    """
+
+    @staticmethod
+    def get_collection():
+        if db is None:
+            return None
+        return db['receiptAnalyses']
+
+    @staticmethod
+    def ensure_indexes():
+        collection = ReceiptAnalysisCache.get_collection()
+        if collection is None:
+            return
+        try:
+            collection.create_index([("createdAt", 1)], expireAfterSeconds=int(ANALYSIS_CACHE_TTL.total_seconds()))
+        except Exception as e:
+            print(f"Error creating receipt analysis index: {e}")
+
+    @staticmethod
+    def get(key: str):
+        """Returns the cache document for `key`, or None."""
+        collection = ReceiptAnalysisCache.get_collection()
+        if collection is None:
+            return None
+        return collection.find_one({"_id": key})
+
+    @staticmethod
+    def claim(key: str, lease: timedelta) -> bool:
+        """
+        Tries to become the one process analyzing `key`: succeeds if nobody has claimed it
+        yet or the previous claim's lease ran out. False means another process holds it.
+        """
+        collection = ReceiptAnalysisCache.get_collection()
+        if collection is None:
+            return True
+
+        now = datetime.now(timezone.utc)
+        try:
+            collection.insert_one({"_id": key, "status": "PENDING", "leaseUntil": now + lease, "createdAt": now})
+            return True
+        except DuplicateKeyError:
+            taken_over = collection.update_one(
+                {"_id": key, "status": "PENDING", "leaseUntil": {"$lt": now}},
+                {"$set": {"leaseUntil": now + lease}}
+            )
+            return taken_over.modified_count == 1
+
+    @staticmethod
+    def store_result(key: str, result: dict):
+        collection = ReceiptAnalysisCache.get_collection()
+        if collection is None:
+            return
+        collection.update_one(
+            {"_id": key},
+            {"$set": {"status": "DONE", "result": result, "createdAt": datetime.now(timezone.utc)},
+             "$unset": {"leaseUntil": ""}},
+            upsert=True
+        )
+
+    @staticmethod
+    def release(key: str):
+        """Drops an unfinished claim so the next submission retries right away."""
+        collection = ReceiptAnalysisCache.get_collection()
+        if collection is None:
+            return
+        collection.delete_one({"_id": key, "status": "PENDING"})
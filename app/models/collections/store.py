@@ -1,7 +1,26 @@
+import os
+import threading
+import time
+
 from app import db
 
+# How long a worker serves its store list before re-reading it (stores added by other workers)
+STORE_CACHE_TTL_SECONDS = float(os.getenv("STORE_CACHE_TTL_SECONDS", "300"))
+
+DEFAULT_STORES = [
+    "FamilyMart", "Lawson", "7-Eleven",
+    "Seicomart", "AEON", "Co-op", "Satudora"
+]
+
 
 class Store:
+    # In-memory sorted store list; a tuple so callers can't modify the shared copy
+    _names_cache = None
+    # Bumped whenever the cached list changes; lets callers memoize anything derived from it
+    _names_version = 0
+    _names_loaded_at = None
+    _cache_lock = threading.Lock()
+
     @staticmethod
     def get_collection():
         if db is None:
@@ -9,27 +28,46 @@ class Store:
         return db['stores']
 
     @staticmethod
-    def get_all_store_names():
-        """Fetches a list of all available store names from the database."""
+    def get_store_names():
+        """
+        Returns (store names tuple, version). Served from memory and re-read from the
+        database at most every STORE_CACHE_TTL_SECONDS; the version only moves when the
+        list actually changes.
+        """
+        loaded_at = Store._names_loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < STORE_CACHE_TTL_SECONDS:
+            return Store._names_cache, Store._names_version
+
+        names = Store._load_store_names()
+        with Store._cache_lock:
+            if names is not None:
+                if names != Store._names_cache:
+                    Store._names_cache = names
+                    Store._names_version += 1
+                Store._names_loaded_at = time.monotonic()
+            elif Store._names_cache is None:
+                # Database unavailable and nothing cached yet: defaults, retried on the next call
+                return tuple(sorted(DEFAULT_STORES)), Store._names_version
+            return Store._names_cache, Store._names_version
+
+    @staticmethod
+    def _load_store_names():
+        """Reads the store names, seeding the defaults into an empty collection. None on error."""
         collection = Store.get_collection()
         if collection is None:
-            return []
-
-        # Check if collection is empty (or doesn't exist yet)
-        if collection.count_documents({}) == 0:
-            default_stores = [
-                "FamilyMart", "Lawson", "7-Eleven",
-                "Seicomart", "AEON", "Co-op", "Satudora"
-            ]
-            try:
-                collection.insert_many([{"name": s} for s in default_stores])
+            return ()
+
+        try:
+            # Check if collection is empty (or doesn't exist yet)
+            if collection.find_one({}, {"_id": 1}) is None:
+                collection.insert_many([{"name": s} for s in DEFAULT_STORES])
                 print("Seeded 'stores' collection with default values.")
-            except Exception as e:
-                print(f"Error seeding stores: {e}")
-                return default_stores
 
-        cursor = collection.find({}, {"name": 1, "_id": 0})
-        return [doc['name'] for doc in cursor if 'name' in doc]
+            cursor = collection.find({}, {"name": 1, "_id": 0})
+            return tuple(sorted(doc['name'] for doc in cursor if 'name' in doc))
+        except Exception as e:
+            print(f"Error loading stores: {e}")
+            return None
 
     @staticmethod
     def add_store_if_not_exists(store_name: str):
@@ -38,6 +76,11 @@ class Store:
         if collection is None or not store_name:
             return
 
+        # Known stores (nearly every receipt) need no database round trip
+        cached = Store._names_cache
+        if cached is not None and store_name in cached:
+            return
+
         try:
             # Upsert: If name exists, do nothing. If not, insert it.
             collection.update_one(
@@ -47,3 +90,9 @@ class Store:
             )
         except Exception as e:
             print(f"Error adding new store '{store_name}': {e}")
+            return
+
+        with Store._cache_lock:
+            if Store._names_cache is not None and store_name not in Store._names_cache:
+                Store._names_cache = tuple(sorted(Store._names_cache + (store_name,)))
+                Store._names_version += 1
@@ -1,9 +1,27 @@
 from app import db
 from datetime import datetime, timezone, timedelta
 from bson.objectid import ObjectId
+from cachetools import TTLCache
 from pymongo import ReturnDocument
 
+from app.models.collections.user_rating import UserRating
+from app.utils import metrics
+
+import os
 import random
+import threading
+
+# Per-worker cache of user documents read by the auth decorators: (user id, fields) -> document.
+# Writes through User drop the entries in this worker; other workers see the change within the TTL.
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "4096"))
+
+_user_cache = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS)
+_user_cache_lock = threading.Lock()
+# Field sets with cached entries, so an invalidation can drop every entry of a user
+_cached_field_sets = set()
+# Bumped by every invalidation; a read that raced with a write does not store its result
+_user_cache_generation = 0
 
 
 class User:
@@ -45,10 +63,10 @@ class User:
             "totalExpenditure": 0.0,
             "estimatedTotalSavings": 0.0,
 
-            # Rating System (Start with 5.0 base)
+            # Rating System (Start with 5.0 base); the ratings themselves live in 'userRatings'
             "userRating": {
                 "totalScore": 5,
-                "ratedByUsers": []
+                "raterCount": 0
             },
 
             # Monthly Stat Tracking
@@ -91,57 +109,78 @@ class User:
             return None
 
     @staticmethod
-    def check_and_reset_monthly_stats(user_id: str):
-        """Resets monthly stats if the calendar month has changed."""
+    def update_user_stats(user_id: str, rank_increment: int = 0, contribution: int = 0, expenditure: float = 0.0, savings: float = 0.0):
+        """
+        Updates lifetime and monthly stats, and stores the latest rank gain.
+        One pipeline update: the monthly counters restart from zero when 'statsMonth'
+        is not the current month (no separate reset write).
+        """
         collection = User.get_collection()
         if collection is None:
-            return
+            return False
 
         now_month = datetime.now(timezone.utc).strftime("%Y-%m")
+        same_month = {"$eq": ["$statsMonth", now_month]}
 
-        collection.update_one(
-            {"_id": ObjectId(user_id), "statsMonth": {"$ne": now_month}},
-            {
+        def lifetime(field, amount):
+            return {"$add": [{"$ifNull": [f"${field}", 0]}, amount]}
+
+        def monthly(field, amount):
+            return {"$add": [{"$cond": [same_month, {"$ifNull": [f"${field}", 0]}, 0]}, amount]}
+
+        result = collection.update_one(
+            {"_id": ObjectId(user_id)},
+            [{
                 "$set": {
+                    "rankScore": lifetime("rankScore", rank_increment),
+                    "totalContributions": lifetime("totalContributions", contribution),
+                    "totalExpenditure": lifetime("totalExpenditure", expenditure),
+                    "estimatedTotalSavings": lifetime("estimatedTotalSavings", savings),
                     "statsMonth": now_month,
-                    "monthlyContributions": 0,
-                    "monthlyExpenditure": 0.0,
-                    "monthlySavings": 0.0
+                    "monthlyContributions": monthly("monthlyContributions", contribution),
+                    "monthlyExpenditure": monthly("monthlyExpenditure", expenditure),
+                    "monthlySavings": monthly("monthlySavings", savings),
+                    "lastRankIncrement": rank_increment,  # Overwrites with newest gain
+                    "consecutiveBadUploads": 0,
+                    "bannedUntil": None
                 }
-            }
+            }]
         )
+        User.invalidate_cache(user_id)
+        return result.modified_count == 1
 
     @staticmethod
-    def update_user_stats(user_id: str, rank_increment: int = 0, contribution: int = 0, expenditure: float = 0.0, savings: float = 0.0):
+    def roll_over_monthly_stats(month: str, after_id=None, batch_size: int = 1000):
         """
-        Updates lifetime and monthly stats, and stores the latest rank gain.
+        Zeroes the monthly counters of up to `batch_size` users (in _id order after `after_id`)
+        whose 'statsMonth' is not `month`. Returns (users reset, last _id scanned or None when done).
         """
         collection = User.get_collection()
         if collection is None:
-            return False
-
-        User.check_and_reset_monthly_stats(user_id)
-
-        result = collection.update_one(
-            {"_id": ObjectId(user_id)},
+            return 0, None
+
+        query = {"statsMonth": {"$ne": month}}
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        ids = [doc["_id"] for doc in collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+        if not ids:
+            return 0, None
+
+        # statsMonth is re-checked: a reward written meanwhile already started the new month
+        result = collection.update_many(
+            {"_id": {"$in": ids}, "statsMonth": {"$ne": month}},
             {
-                "$inc": {
-                    "rankScore": rank_increment,
-                    "totalContributions": contribution,
-                    "monthlyContributions": contribution,
-                    "totalExpenditure": expenditure,
-                    "monthlyExpenditure": expenditure,
-                    "estimatedTotalSavings": savings,
-                    "monthlySavings": savings
-                },
                 "$set": {
-                    "lastRankIncrement": rank_increment,  # Overwrites with newest gain
-                    "consecutiveBadUploads": 0,
-                    "bannedUntil": None
+                    "statsMonth": month,
+                    "monthlyContributions": 0,
+                    "monthlyExpenditure": 0.0,
+                    "monthlySavings": 0.0
                 }
             }
         )
-        return result.modified_count == 1
+        for user_id in ids:
+            User.invalidate_cache(user_id)
+        return result.modified_count, ids[-1]
 
     @staticmethod
     def add_user_rating(target_user_id: str, rater_user_id: str, score: int):
@@ -152,17 +191,24 @@ class User:
         if not (1 <= score <= 5):
             return False
 
+        # The unique rating document decides whether this rater already rated the user
+        if not UserRating.add(target_user_id, rater_user_id, score):
+            return False
+
+        # Until migrate-user-ratings has moved this user's array, raters listed there count as rated
         result = collection.update_one(
             {
                 "_id": ObjectId(target_user_id),
                 "userRating.ratedByUsers": {"$ne": ObjectId(rater_user_id)}
             },
-            {
-                "$push": {"userRating.ratedByUsers": ObjectId(rater_user_id)},
-                "$inc": {"userRating.totalScore": score}
-            }
+            {"$inc": {"userRating.totalScore": score, "userRating.raterCount": 1}}
         )
-        return result.modified_count == 1
+        if result.modified_count != 1:
+            UserRating.remove(target_user_id, rater_user_id)
+            return False
+
+        User.invalidate_cache(target_user_id)
+        return True
 
     @staticmethod
     def get_id_and_username_by_social_account_id(social_id: str, provider: str):
@@ -195,6 +241,7 @@ class User:
             {"_id": ObjectId(user_id)},
             {"$set": {"username": chosen_username}}
         )
+        User.invalidate_cache(user_id)
         return 0 if result.matched_count > 0 else 2
 
     @staticmethod
@@ -207,6 +254,7 @@ class User:
             {"_id": ObjectId(user_id)},
             {"$set": {"userAvatarId": avatar_id}}
         )
+        User.invalidate_cache(user_id)
         return result.matched_count > 0
 
     @staticmethod
@@ -219,14 +267,51 @@ class User:
             {"_id": ObjectId(user_id)},
             {"$set": {"preferredStoreProximity": proximity}}
         )
+        User.invalidate_cache(user_id)
         return result.matched_count > 0
 
     @staticmethod
-    def get_by_id(user_id: str):
+    def get_by_id(user_id: str, fields: tuple = None, cached: bool = False):
+        """
+        Fetches the user document, or only `fields` (plus _id) when given.
+        With cached=True the result may come from this worker's user cache
+        (at most USER_CACHE_TTL_SECONDS old for writes made by other workers).
+        """
         collection = User.get_collection()
         if collection is None or not ObjectId.is_valid(user_id):
             return None
-        return collection.find_one({"_id": ObjectId(user_id)})
+
+        projection = {field: 1 for field in fields} if fields is not None else None
+        if not cached:
+            return collection.find_one({"_id": ObjectId(user_id)}, projection)
+
+        key = (str(user_id), fields)
+        with _user_cache_lock:
+            user = _user_cache.get(key)
+            generation = _user_cache_generation
+        if user is not None:
+            metrics.increment("user_cache.hit")
+            return dict(user)
+
+        metrics.increment("user_cache.miss")
+        user = collection.find_one({"_id": ObjectId(user_id)}, projection)
+        if user is not None:
+            with _user_cache_lock:
+                if generation == _user_cache_generation:
+                    _user_cache[key] = user
+                    _cached_field_sets.add(fields)
+            user = dict(user)
+        return user
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        """Drops the user's cached documents in this worker; every write to a user goes through here."""
+        global _user_cache_generation
+        user_id = str(user_id)
+        with _user_cache_lock:
+            _user_cache_generation += 1
+            for fields in _cached_field_sets:
+                _user_cache.pop((user_id, fields), None)
 
     @staticmethod
     def get_user_score_detail(user_id: str):
@@ -299,6 +384,7 @@ class User:
             projection={"consecutiveBadUploads": 1},  # Only fetch what we need
             return_document=ReturnDocument.AFTER
         )
+        User.invalidate_cache(user_id)
 
         if not updated_user:
             return False
@@ -311,6 +397,7 @@ class User:
                 {"_id": ObjectId(user_id)},
                 {"$set": {"bannedUntil": ban_expiry}}
             )
+            User.invalidate_cache(user_id)
             return True  # User was just banned
 
         return False  # User penalized but not yet banned
@@ -356,4 +443,5 @@ class User:
             {"_id": ObjectId(user_id)},
             {"$set": {"bannedUntil": None, "consecutiveBadUploads": 0}}
         )
+        User.invalidate_cache(user_id)
         return True
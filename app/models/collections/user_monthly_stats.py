@@ -0,0 +1,119 @@
+from app import db
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+# Fields accumulated per (user, month)
+MONTHLY_STAT_FIELDS = ("receipts", "contributions", "expenditure", "savings")
+
+# Months returned by a history request at most
+MONTHLY_STATS_MAX_MONTHS = 36
+
+_indexes_ready = False
+
+
+class UserMonthlyStats:
+    """
+    One small document per user and calendar month (UTC, "YYYY-MM"):
+    {userId, month, receipts, contributions, expenditure, savings, updatedAt}.
+    Incremented as receipts are rewarded, so history reads never scan receipts.
+    """
+
+    @staticmethod
+    def get_collection():
+        if db is None:
+            return None
+        return db['userMonthlyStats']
+
+    @staticmethod
+    def ensure_indexes():
+        collection = UserMonthlyStats.get_collection()
+        if collection is None:
+            return
+        try:
+            collection.create_index([("userId", 1), ("month", -1)], unique=True)
+        except Exception as e:
+            print(f"Error creating user monthly stats index: {e}")
+
+    @staticmethod
+    def current_month() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m")
+
+    @staticmethod
+    def add(user_id: str, month: str = None, receipts: int = 0, contributions: int = 0,
+            expenditure: float = 0.0, savings: float = 0.0):
+        """Adds to the user's totals for `month` (default: current UTC month), creating the document."""
+        collection = UserMonthlyStats.get_collection()
+        if collection is None:
+            return
+
+        global _indexes_ready
+        if not _indexes_ready:
+            UserMonthlyStats.ensure_indexes()
+            _indexes_ready = True
+
+        collection.update_one(
+            {"userId": ObjectId(user_id), "month": month or UserMonthlyStats.current_month()},
+            {
+                "$inc": {
+                    "receipts": receipts,
+                    "contributions": contributions,
+                    "expenditure": expenditure,
+                    "savings": savings
+                },
+                "$set": {"updatedAt": datetime.now(timezone.utc)}
+            },
+            upsert=True
+        )
+
+    @staticmethod
+    def get(user_id: str, month: str = None) -> dict:
+        """The user's totals for `month` (default: current UTC month); zeros if nothing was recorded."""
+        month = month or UserMonthlyStats.current_month()
+        collection = UserMonthlyStats.get_collection()
+        doc = None
+        if collection is not None:
+            doc = collection.find_one({"userId": ObjectId(user_id), "month": month}, {"_id": 0, "userId": 0})
+        return UserMonthlyStats._to_result(doc or {"month": month})
+
+    @staticmethod
+    def get_history(user_id: str, months: int = 12) -> list:
+        """The user's last `months` recorded months, newest first (one index range read)."""
+        collection = UserMonthlyStats.get_collection()
+        if collection is None:
+            return []
+
+        months = max(1, min(months, MONTHLY_STATS_MAX_MONTHS))
+        cursor = collection.find(
+            {"userId": ObjectId(user_id)},
+            {"_id": 0, "userId": 0}
+        ).sort("month", -1).limit(months)
+        return [UserMonthlyStats._to_result(doc) for doc in cursor]
+
+    @staticmethod
+    def _to_result(doc: dict) -> dict:
+        return {
+            "month": doc.get("month"),
+            "receipts": doc.get("receipts", 0),
+            "contributions": doc.get("contributions", 0),
+            "expenditure": doc.get("expenditure", 0.0),
+            "savings": doc.get("savings", 0.0)
+        }
+
+    @staticmethod
+    def rebuild_operations(rows: list, current_month: str) -> list:
+        """
+        Bulk operations writing backfilled totals: rows of {userId, month, <MONTHLY_STAT_FIELDS>}.
+        Past months are overwritten (they are closed); the current month only ever goes up
+        ($max), since live receipts keep incrementing it while the backfill runs.
+        """
+        now = datetime.now(timezone.utc)
+        operations = []
+        for row in rows:
+            values = {field: row.get(field, 0) for field in MONTHLY_STAT_FIELDS}
+            if row["month"] >= current_month:
+                update = {"$max": values, "$set": {"updatedAt": now}}
+            else:
+                update = {"$set": dict(values, updatedAt=now)}
+            operations.append(UpdateOne({"userId": row["userId"], "month": row["month"]}, update, upsert=True))
+        return operations
@@ -0,0 +1,61 @@
+from app import db
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+_indexes_ready = False
+
+
+class UserRating:
+    """
+    One document per rating a user gave another: {targetUserId, raterUserId, score, createdAt}.
+    The unique (targetUserId, raterUserId) index lets each user rate another once; the
+    rated user's document only keeps the 'userRating.totalScore' / 'raterCount' counters.
+    """
+
+    @staticmethod
+    def get_collection():
+        if db is None:
+            return None
+        return db['userRatings']
+
+    @staticmethod
+    def ensure_indexes():
+        collection = UserRating.get_collection()
+        if collection is None:
+            return
+        try:
+            collection.create_index([("targetUserId", 1), ("raterUserId", 1)], unique=True)
+        except Exception as e:
+            print(f"Error creating user rating index: {e}")
+
+    @staticmethod
+    def add(target_user_id: str, rater_user_id: str, score: int) -> bool:
+        """Records the rating; False if the rater has already rated this user."""
+        collection = UserRating.get_collection()
+        if collection is None:
+            return False
+
+        global _indexes_ready
+        if not _indexes_ready:
+            UserRating.ensure_indexes()
+            _indexes_ready = True
+
+        try:
+            collection.insert_one({
+                "targetUserId": ObjectId(target_user_id),
+                "raterUserId": ObjectId(rater_user_id),
+                "score": score,
+                "createdAt": datetime.now(timezone.utc)
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    @staticmethod
+    def remove(target_user_id: str, rater_user_id: str):
+        """Drops a rating whose counter update did not apply."""
+        collection = UserRating.get_collection()
+        if collection is None:
+            return
+        collection.delete_one({"targetUserId": ObjectId(target_user_id), "raterUserId": ObjectId(rater_user_id)})
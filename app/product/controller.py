@@ -1,48 +1,32 @@
 import os
 import threading
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timezone, timedelta
+from cachetools import TTLCache
 from flask import request, jsonify
 
 from app.models.response import Response
 from app.models.collections.user import User
-from app.models.collections.store import Store
 from app.models.collections.product import Product
 from app.models.collections.receipt import Receipt
+from app.product.processor import process_receipt
 from app.utils.auth_helper import token_required
-from app.utils.gemini_helper import get_receipt_analysis_instruction, analyze_receipt_with_gemini
-from app.utils.image_helper import optimize_image_stream
+from app.utils.basket_optimizer import build_price_matrix, compare_stores
+from app.utils import metrics
+from app.utils.image_pool import optimize_upload
 
-# --- Async Task for User Stats ---
+# "sync": the upload request runs Gemini and the product update itself.
+# "async": the upload is stored and answered with 202; `flask receipt-worker` processes it.
+RECEIPT_PROCESSING_MODE = os.getenv("RECEIPT_PROCESSING_MODE", "sync")
 
-TARGET_CITY = os.getenv("TARGET_CITY")
+# Short-lived cache of product lookups for GET /product/: (lookup, value) -> (doc, matched_by)
+PRODUCT_RESPONSE_CACHE_TTL = float(os.getenv("PRODUCT_RESPONSE_CACHE_TTL_SECONDS", "30"))
+_product_response_cache = TTLCache(maxsize=2048, ttl=PRODUCT_RESPONSE_CACHE_TTL)
+_product_response_cache_lock = threading.Lock()
 
-
-def penalize_user_for_bad_upload(user_id):
-    try:
-        User.penalize_user(user_id=user_id)
-        print(f"Async penalty update for user {user_id} complete.")
-    except Exception as e:
-        print(f"Async penalty update failed for user {user_id}: {e}")
-
-
-def reward_user_and_update_store(store_name, user_id, contribution_count=None, total_expenditure=None):
-    if store_name:
-        Store.add_store_if_not_exists(store_name)
-
-    try:
-        # Simple gamification: 5 points per product contributed
-        rank_increment = contribution_count * 5
-
-        User.update_user_stats(
-            user_id=user_id,
-            rank_increment=rank_increment,
-            contribution=contribution_count,
-            expenditure=total_expenditure,
-            savings=0.0  # Savings are calculated in the Comparison flow, not Contribution flow
-        )
-        print(f"Async reward update for user {user_id} complete.")
-    except Exception as e:
-        print(f"Async reward update failed for user {user_id}: {e}")
+# Store prices older than this are left out of basket comparisons
+BASKET_MAX_PRICE_AGE_DAYS = int(os.getenv("BASKET_MAX_PRICE_AGE_DAYS", "30"))
+BASKET_MAX_ITEMS = 100
 
 
 @token_required
@@ -50,6 +34,8 @@ def add_or_update_product_details(current_user):
     """
     PUT /product/details
     Updated to handle multipart/form-data for faster uploads.
+    In async mode the optimized image is queued and 202 is returned with the receiptId;
+    poll GET /user/receipt/<receiptId> for the outcome.
     """
     user_id = str(current_user['_id'])
 
@@ -82,7 +68,9 @@ def add_or_update_product_details(current_user):
 
         # 3. Optimization: Pass the file directly (No Base64 decoding needed yet)
         # We pass the file to our helper function
-        optimized_image_bytes = optimize_image_stream(file_storage)
+        image_started = time.perf_counter()
+        optimized_image_bytes, image_hash = optimize_upload(file_storage)
+        metrics.observe("receipt.image", (time.perf_counter() - image_started) * 1000)
 
         if not optimized_image_bytes:
             response = Response(
@@ -93,126 +81,271 @@ def add_or_update_product_details(current_user):
                 Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
             return jsonify(response.to_dict()), 400
 
-        # 1. Get Context Data
-        available_stores = Store.get_all_store_names()
-        now_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        # Re-photographed receipts: reject before paying for a Gemini call (and a second reward)
+        if receipt_id:
+            Receipt.set_image_hash(receipt_id, image_hash)
+            duplicate = Receipt.find_near_duplicate(user_id, receipt_id, image_hash)
+            if duplicate:
+                response = Response(
+                    message_en="This receipt has already been submitted.",
+                    message_ja="このレシートはすでに送信されています。",
+                    result={"receiptId": str(receipt_id), "duplicateOf": str(duplicate['_id'])}
+                )
+                Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
+                return jsonify(response.to_dict()), 409
 
-        # 2. Prepare Gemini Instruction
-        instruction = get_receipt_analysis_instruction(
-            date_str=now_str,
-            target_city=TARGET_CITY,
-            available_stores=available_stores
+        # 5. Async mode: hand the image to the receipt worker and answer right away
+        if RECEIPT_PROCESSING_MODE == "async" and receipt_id:
+            Receipt.queue_image(receipt_id, optimized_image_bytes)
+            response = Response(
+                errorStatus=0,
+                message_en="Receipt received. It will be processed shortly.",
+                message_ja="レシートを受け付けました。まもなく処理されます。",
+                result={"receiptId": str(receipt_id), "status": "PENDING"}
+            )
+            return jsonify(response.to_dict()), 202
+
+        response_dict, status_code = process_receipt(receipt_id, user_id, optimized_image_bytes)
+        return jsonify(response_dict), status_code
+
+    except Exception as e:
+        print(f"Product Update Error: {e}")
+
+        response = Response(
+            message_en="Internal server error.",
+            message_ja="内部サーバーエラー。"
         )
 
-        # 3. Call Gemini
-        analysis_result = analyze_receipt_with_gemini(optimized_image_bytes, instruction)
+        return jsonify(response.to_dict()), 500
 
-        if not analysis_result:
-            response = Response(message_en="AI Analysis failed. Please try again.",
-                                message_ja="AI分析に失敗しました。もう一度お試しください。")
-            if receipt_id:
-                Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
-            return jsonify(response.to_dict()), 502
 
-        # 4. Check Gemini Error Codes
-        error_code = analysis_result.get("error_code")
+def _serialize_price_summary(doc, matched_by):
+    summary = doc.get('priceSummary') or {}
+    price_date = summary.get('date')
+
+    cheapest = None
+    if summary.get('minPrice') is not None:
+        if isinstance(price_date, datetime) and price_date.tzinfo is None:
+            price_date = price_date.replace(tzinfo=timezone.utc)
+        cheapest = {
+            "price": summary.get('minPrice'),
+            "store": summary.get('store'),
+            "updatedAt": price_date.isoformat() if price_date else None,
+            "ageDays": (datetime.now(timezone.utc) - price_date).days if price_date else None
+        }
+
+    return {
+        "productId": str(doc['_id']),
+        "name": doc.get('name'),
+        "englishName": doc.get('englishName'),
+        "matchedBy": matched_by,
+        "cheapest": cheapest,
+        "storeCount": summary.get('storeCount', 0)
+    }
+
 
-        if error_code != 0:
-            # Penalize user for bad receipt
-            thread = threading.Thread(
-                target=penalize_user_for_bad_upload,
-                args=(user_id,)
+def get_product_details():
+    """
+    GET /product/
+    Query Params: ?id=<productId> or ?name=<product name> (exact name/alias, then normalized name)
+    Returns where the product is currently cheapest, from the precomputed price summary.
+    """
+    try:
+        product_id = request.args.get('id', '').strip()
+        name = request.args.get('name', '').strip()
+
+        if not product_id and not name:
+            response = Response(
+                message_en="Provide either a product id or name.",
+                message_ja="商品IDまたは商品名を指定してください。"
             )
-            thread.start()
-
-            error_map = {
-                1: {"en": "Receipt is not from a supported store.", "ja": "レシートはサポートされているストアのものではありません。"},
-                2: {"en": "Receipt appears edited.", "ja": "レシートが編集されている可能性があります。"},
-                3: {"en": "Receipt date is too old or invalid.", "ja": "レシートの日付が古すぎるか、無効です。"},
-                4: {"en": "Could not read the date on the receipt.", "ja": "レシートの日付を読み取れませんでした。"},
-                5: {"en": "Store is not located in Sapporo.", "ja": "店舗が札幌市外のようです。"},
-                6: {"en": "Could not read store location on the receipt.", "ja": "店舗の場所を特定できませんでした。"},
-                7: {"en": "Could not read store name on the receipt.", "ja": "店舗名を特定できませんでした。"},
-            }
+            return jsonify(response.to_dict()), 400
+
+        cache_key = ("id", product_id) if product_id else ("name", name)
+        with _product_response_cache_lock:
+            cached = _product_response_cache.get(cache_key)
 
-            err_obj = error_map.get(error_code, {"en": "Unknown validation error.", "ja": "不明なエラーが発生しました。"})
+        if cached is None:
+            cached = Product.get_price_summary(product_id=product_id or None, name=name or None)
+            with _product_response_cache_lock:
+                _product_response_cache[cache_key] = cached
 
+        doc, matched_by = cached
+        if not doc:
             response = Response(
-                message_en=err_obj["en"],
-                message_ja=err_obj["ja"],
-                result=analysis_result
+                message_en="Product not found.",
+                message_ja="商品が見つかりませんでした。"
             )
+            return jsonify(response.to_dict()), 404
 
-            if receipt_id:
-                Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
-            return jsonify(response.to_dict()), 400
+        response = Response(
+            errorStatus=0,
+            message_en="Product details fetched successfully.",
+            message_ja="商品情報の取得に成功しました。",
+            result=_serialize_price_summary(doc, matched_by)
+        )
+        return jsonify(response.to_dict()), 200
+
+    except Exception as e:
+        print(f"Error fetching product details: {e}")
+        return jsonify(Response(message_en="Internal server error.", message_ja="内部サーバーエラー。").to_dict()), 500
 
-        # 5. Extract Valid Data
-        store_name = analysis_result.get("store_name")
-        products = analysis_result.get("products", [])
-        total_amount = analysis_result.get("total_amount", 0.0)
 
-        if not products:
+def search_products():
+    """
+    GET /product/search
+    Query Params: ?q=<prefix> (required), ?limit=<1-50> (Optional, defaults to 10)
+    Autocomplete over product names, English names and aliases.
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
             response = Response(
-                message_en="No products found in receipt.",
-                message_ja="レシートに商品が見つかりませんでした。",
-                result=analysis_result
+                message_en="Search query is required.",
+                message_ja="検索キーワードを入力してください。"
             )
+            return jsonify(response.to_dict()), 400
 
-            if receipt_id:
-                Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
+        try:
+            limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+        except ValueError:
+            limit = 10
+
+        suggestions = [
+            {
+                "productId": str(doc['_id']),
+                "name": doc.get('name'),
+                "englishName": doc.get('englishName')
+            }
+            for doc in Product.search_by_prefix(query, limit)
+        ]
+
+        response = Response(
+            errorStatus=0,
+            message_en="Products fetched successfully.",
+            message_ja="商品の検索に成功しました。",
+            result=suggestions
+        )
+        return jsonify(response.to_dict()), 200
+
+    except Exception as e:
+        print(f"Error searching products: {e}")
+        return jsonify(Response(message_en="Internal server error.", message_ja="内部サーバーエラー。").to_dict()), 500
+
+
+def _parse_basket_items(items):
+    """Normalizes basket items ("name" or {"productId"|"name", "quantity"}) into dicts; None if malformed."""
+    parsed = []
+    for item in items:
+        if isinstance(item, str):
+            item = {"name": item}
+        if not isinstance(item, dict):
+            return None
+
+        product_id = str(item.get('productId') or '').strip()
+        name = str(item.get('name') or '').strip()
+        quantity = item.get('quantity', 1)
+        if not (product_id or name) or not isinstance(quantity, (int, float)) or quantity <= 0:
+            return None
+        parsed.append({"productId": product_id, "name": name, "quantity": quantity})
+    return parsed
+
+
+def compare_basket():
+    """
+    POST /product/basket
+    Body: {"items": ["お茶", {"productId": "<id>", "quantity": 2}, {"name": "牛乳"}, ...]}
+    Compares a whole shopping list across stores: per-store totals and coverage,
+    the cheapest store carrying everything, and the cheapest split across two stores.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        items = _parse_basket_items(data.get('items') or [])
+
+        if not items or len(items) > BASKET_MAX_ITEMS:
+            response = Response(
+                message_en=f"Provide between 1 and {BASKET_MAX_ITEMS} basket items.",
+                message_ja=f"買い物リストには1〜{BASKET_MAX_ITEMS}件の商品を指定してください。"
+            )
             return jsonify(response.to_dict()), 400
 
-        # 6. Update Product Database
-        updated_count = Product.bulk_upsert(store_name, products)
+        by_id, by_name = Product.resolve_products(
+            product_ids=[item['productId'] for item in items if item['productId']],
+            names=[item['name'] for item in items if not item['productId']]
+        )
 
-        # 7. Async Update User Stats
-        thread = threading.Thread(
-            target=reward_user_and_update_store,
-            args=(store_name, user_id, updated_count, float(total_amount))
+        # One matrix row per distinct product; repeated products add up their quantities
+        resolved_items = []
+        rows = {}
+        for item in items:
+            if item['productId']:
+                doc, matched_by = by_id.get(item['productId']), "id"
+            else:
+                doc, matched_by = by_name.get(item['name'], (None, None))
+
+            resolved_items.append({
+                "query": item['productId'] or item['name'],
+                "quantity": item['quantity'],
+                "productId": str(doc['_id']) if doc else None,
+                "name": doc.get('name') if doc else None,
+                "englishName": doc.get('englishName') if doc else None,
+                "matchedBy": matched_by if doc else None
+            })
+            if doc:
+                row = rows.setdefault(str(doc['_id']), {"doc": doc, "quantity": 0})
+                row["quantity"] += item['quantity']
+
+        product_ids = list(rows)
+        min_date = datetime.now(timezone.utc) - timedelta(days=BASKET_MAX_PRICE_AGE_DAYS)
+        matrix, stores = build_price_matrix(
+            [Product.get_price_entries(rows[product_id]["doc"]) for product_id in product_ids], min_date
         )
-        thread.start()
+        comparison = compare_stores(matrix, [rows[product_id]["quantity"] for product_id in product_ids])
+
+        store_results = [
+            {
+                "store": stores[entry["column"]],
+                "total": round(entry["total"], 2),
+                "coveredItems": entry["covered"],
+                "missingProductIds": [product_ids[i] for i in entry["missing"]]
+            }
+            for entry in comparison["stores"]
+        ]
+
+        best_split = None
+        split = comparison["bestSplit"]
+        if split:
+            assigned = {stores[column]: [] for column in split["columns"]}
+            for i, column in enumerate(split["assignment"]):
+                if column >= 0:
+                    assigned[stores[column]].append(product_ids[i])
+            best_split = {
+                "stores": list(assigned),
+                "total": round(split["total"], 2),
+                "coveredItems": split["covered"],
+                "productIdsByStore": assigned
+            }
 
-        # 8. Success Response
         result_data = {
-            "receiptId": str(receipt_id),
-            "store": store_name,
-            "products_found": len(products),
-            "products_updated": updated_count,
-            "total_amount": total_amount
+            "items": resolved_items,
+            "productCount": len(product_ids),
+            "maxPriceAgeDays": BASKET_MAX_PRICE_AGE_DAYS,
+            "stores": store_results,
+            "cheapestStore": next(
+                (entry for entry in store_results if product_ids and entry["coveredItems"] == len(product_ids)),
+                None
+            ),
+            "bestSplit": best_split
         }
 
         response = Response(
             errorStatus=0,
-            message_en="Receipt processed successfully!",
-            message_ja="レシートの処理が完了しました！",
+            message_en="Basket compared successfully.",
+            message_ja="買い物リストの比較が完了しました。",
             result=result_data
         )
-
-        if receipt_id:
-            Receipt.update_receipt_status(
-                receipt_id=receipt_id,
-                status="SUCCESS",
-                result_data=response.to_dict(),
-                store_name=store_name,
-                total_amount=total_amount,
-                products_count=len(products),
-                products_updated=updated_count
-            )
-
         return jsonify(response.to_dict()), 200
 
     except Exception as e:
-        print(f"Product Update Error: {e}")
-
-        response = Response(
-            message_en="Internal server error.",
-            message_ja="内部サーバーエラー。"
-        )
-
-        return jsonify(response.to_dict()), 500
-
-
-def get_product_details():
-    response = Response(message_en="API Not implemented yet", message_ja="APIはまだ実装されていません")
-    return jsonify(response.to_dict()), 501
+        print(f"Error comparing basket: {e}")
+        return jsonify(Response(message_en="Internal server error.", message_ja="内部サーバーエラー。").to_dict()), 500
@@ -0,0 +1,286 @@
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+from app.models.response import Response
+from app.models.collections.user import User
+from app.models.collections.user_monthly_stats import UserMonthlyStats
+from app.models.collections.store import Store
+from app.models.collections.product import Product
+from app.models.collections.receipt import Receipt, RECEIPT_MAX_ATTEMPTS
+from app.utils import background_tasks, metrics
+from app.utils.analysis_cache import (
+    ANALYSIS_CLAIM_LEASE, ANALYSIS_WAIT_SECONDS, analysis_cache_key, analyze_with_cache
+)
+from app.utils.gemini_helper import (
+    GEMINI_MODEL,
+    RECEIPT_ANALYSIS_SYSTEM_INSTRUCTION,
+    get_receipt_analysis_instruction,
+    analyze_receipt_with_gemini,
+)
+
+TARGET_CITY = os.getenv("TARGET_CITY")
+
+RECEIPT_ERROR_MESSAGES = {
+    1: {"en": "Receipt is not from a supported store.", "ja": "レシートはサポートされているストアのものではありません。"},
+    2: {"en": "Receipt appears edited.", "ja": "レシートが編集されている可能性があります。"},
+    3: {"en": "Receipt date is too old or invalid.", "ja": "レシートの日付が古すぎるか、無効です。"},
+    4: {"en": "Could not read the date on the receipt.", "ja": "レシートの日付を読み取れませんでした。"},
+    5: {"en": "Store is not located in Sapporo.", "ja": "店舗が札幌市外のようです。"},
+    6: {"en": "Could not read store location on the receipt.", "ja": "店舗の場所を特定できませんでした。"},
+    7: {"en": "Could not read store name on the receipt.", "ja": "店舗名を特定できませんでした。"},
+}
+
+
+# --- User Stats Updates (background tasks for uploads, inline in the receipt worker) ---
+
+def penalize_user_for_bad_upload(user_id):
+    try:
+        User.penalize_user(user_id=user_id)
+        print(f"Async penalty update for user {user_id} complete.")
+        return True
+    except Exception as e:
+        print(f"Async penalty update failed for user {user_id}: {e}")
+        return False
+
+
+def reward_user_and_update_store(store_name, user_id, contribution_count=None, total_expenditure=None):
+    started = time.perf_counter()
+    if store_name:
+        Store.add_store_if_not_exists(store_name)
+
+    try:
+        # Simple gamification: 5 points per product contributed
+        rank_increment = contribution_count * 5
+
+        User.update_user_stats(
+            user_id=user_id,
+            rank_increment=rank_increment,
+            contribution=contribution_count,
+            expenditure=total_expenditure,
+            savings=0.0  # Savings are calculated in the Comparison flow, not Contribution flow
+        )
+        UserMonthlyStats.add(
+            user_id=user_id,
+            receipts=1,
+            contributions=contribution_count,
+            expenditure=total_expenditure
+        )
+        print(f"Async reward update for user {user_id} complete.")
+        return True
+    except Exception as e:
+        print(f"Async reward update failed for user {user_id}: {e}")
+        return False
+    finally:
+        metrics.observe("receipt.user_stats", (time.perf_counter() - started) * 1000)
+
+
+def _apply_user_update(receipt_id, attempt, marker: str, name: str, fn, *args):
+    """
+    Upload requests hand the user-stats update to the background threads. The receipt worker
+    runs it inline and sets `marker` only after it succeeded, so a worker dying in between
+    applies it again on the retry rather than never. A failed update is retried while
+    attempts are left.
+    """
+    if attempt is None:
+        background_tasks.submit(name, fn, *args)
+        return
+    if attempt.get(marker):
+        return
+    if fn(*args):
+        Receipt.mark_side_effect(receipt_id, marker)
+    elif attempt.get('attempts', 0) < RECEIPT_MAX_ATTEMPTS:
+        raise RuntimeError(f"{name} failed")
+
+
+def process_receipt(receipt_id, user_id: str, optimized_image_bytes: bytes, attempt: dict = None):
+    """
+    Runs an optimized receipt image through Gemini and the product database, and moves
+    the receipt from PENDING to SUCCESS or FAILED.
+    Shared by the synchronous upload endpoint and the receipt worker.
+    Returns (response dict, HTTP status) describing the outcome.
+
+    `attempt` is the receipt as claimed by the receipt worker. Its markers
+    (productsAppliedAt, rewardedAt, penalizedAt) tell which side effects an earlier attempt
+    already applied; those are skipped. A failed Gemini call or user-stats update raises
+    instead of failing the receipt while attempts are left, so the worker retries it.
+    """
+    # 1. Get Context Data (store list cached per worker)
+    available_stores, stores_version = Store.get_store_names()
+    now_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    # 2. Prepare Gemini Instruction (the static part is RECEIPT_ANALYSIS_SYSTEM_INSTRUCTION)
+    instruction = get_receipt_analysis_instruction(
+        date_str=now_str,
+        target_city=TARGET_CITY,
+        available_stores=available_stores,
+        stores_version=stores_version
+    )
+
+    # 3. Call Gemini (re-uploads of the same photo with the same prompt reuse the first verdict)
+    cache_key = analysis_cache_key(
+        optimized_image_bytes, RECEIPT_ANALYSIS_SYSTEM_INSTRUCTION + instruction, GEMINI_MODEL
+    )
+    # The receipt worker holds no request open, so it can wait out another process's call
+    analysis_result = analyze_with_cache(
+        cache_key, lambda: analyze_receipt_with_gemini(optimized_image_bytes, instruction),
+        max_wait=ANALYSIS_CLAIM_LEASE.total_seconds() if attempt is not None else ANALYSIS_WAIT_SECONDS
+    )
+
+    if not analysis_result:
+        if attempt is not None and attempt.get('attempts', 0) < RECEIPT_MAX_ATTEMPTS:
+            raise RuntimeError("AI analysis failed")
+        response = Response(message_en="AI Analysis failed. Please try again.",
+                            message_ja="AI分析に失敗しました。もう一度お試しください。")
+        if receipt_id:
+            Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
+        return response.to_dict(), 502
+
+    # 4. Check Gemini Error Codes
+    error_code = analysis_result.get("error_code")
+
+    if error_code != 0:
+        # Penalize user for bad receipt
+        _apply_user_update(receipt_id, attempt, "penalizedAt", "penalize_user", penalize_user_for_bad_upload, user_id)
+
+        err_obj = RECEIPT_ERROR_MESSAGES.get(
+            error_code, {"en": "Unknown validation error.", "ja": "不明なエラーが発生しました。"}
+        )
+
+        response = Response(
+            message_en=err_obj["en"],
+            message_ja=err_obj["ja"],
+            result=analysis_result
+        )
+
+        if receipt_id:
+            Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
+        return response.to_dict(), 400
+
+    # 5. Extract Valid Data
+    store_name = analysis_result.get("store_name")
+    products = analysis_result.get("products", [])
+    total_amount = analysis_result.get("total_amount", 0.0)
+
+    if not products:
+        response = Response(
+            message_en="No products found in receipt.",
+            message_ja="レシートに商品が見つかりませんでした。",
+            result=analysis_result
+        )
+
+        if receipt_id:
+            Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
+        return response.to_dict(), 400
+
+    # 6. Update Product Database (once per receipt, even across worker retries)
+    if attempt is not None and attempt.get('productsAppliedAt'):
+        updated_count = attempt.get('productsUpdated', 0)
+    else:
+        upsert_started = time.perf_counter()
+        updated_count = Product.bulk_upsert(store_name, products)
+        metrics.observe("receipt.product_upsert", (time.perf_counter() - upsert_started) * 1000)
+        if attempt is not None:
+            Receipt.mark_products_applied(receipt_id, updated_count)
+
+    # 7. Update User Stats (async for uploads, inline in the receipt worker)
+    _apply_user_update(
+        receipt_id, attempt, "rewardedAt",
+        "reward_user", reward_user_and_update_store, store_name, user_id, updated_count, float(total_amount)
+    )
+
+    # 8. Success Response
+    result_data = {
+        "receiptId": str(receipt_id),
+        "store": store_name,
+        "products_found": len(products),
+        "products_updated": updated_count,
+        "total_amount": total_amount
+    }
+
+    response = Response(
+        errorStatus=0,
+        message_en="Receipt processed successfully!",
+        message_ja="レシートの処理が完了しました！",
+        result=result_data
+    )
+
+    if receipt_id:
+        Receipt.update_receipt_status(
+            receipt_id=receipt_id,
+            status="SUCCESS",
+            result_data=response.to_dict(),
+            store_name=store_name,
+            total_amount=total_amount,
+            products_count=len(products),
+            products_updated=updated_count
+        )
+
+    return response.to_dict(), 200
+
+
+def process_queued_receipt(receipt: dict):
+    """Processes one receipt claimed from the queue; failed attempts go back to the queue."""
+    receipt_id = receipt['_id']
+
+    image_bytes = Receipt.load_image(receipt) if receipt.get('attempts', 0) <= RECEIPT_MAX_ATTEMPTS else None
+    if image_bytes is None:
+        response = Response(
+            message_en="Receipt could not be processed. Please upload it again.",
+            message_ja="レシートを処理できませんでした。もう一度アップロードしてください。"
+        )
+        Receipt.update_receipt_status(receipt_id, "FAILED", response.to_dict())
+        Receipt.discard_image(receipt)
+        return
+
+    try:
+        process_receipt(receipt_id, str(receipt['userId']), image_bytes, attempt=receipt)
+    except Exception as e:
+        print(f"Receipt worker error on {receipt_id} (attempt {receipt.get('attempts')}): {e}")
+        Receipt.release_claim(receipt_id)
+        return
+
+    Receipt.discard_image(receipt)
+
+
+def run_receipt_worker(threads: int = 4, poll_interval: float = 1.0):
+    """
+    Drives queued receipts to SUCCESS/FAILED with `threads` concurrent claimers until SIGTERM/SIGINT.
+    Run as many of these processes as the Gemini quota allows; claims are atomic.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Receipt worker {worker_id} stopping after the current receipts...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def claim_loop(slot):
+        while not stop.is_set():
+            try:
+                receipt = Receipt.claim_next(f"{worker_id}:{slot}")
+            except Exception as e:
+                print(f"Receipt worker claim error: {e}")
+                receipt = None
+
+            if receipt is None:
+                stop.wait(poll_interval)
+                continue
+            process_queued_receipt(receipt)
+
+    pool = [threading.Thread(target=claim_loop, args=(slot,)) for slot in range(threads)]
+    for thread in pool:
+        thread.start()
+    print(f"Receipt worker {worker_id} started with {threads} threads.")
+
+    # Keep the main thread free to receive signals
+    while any(thread.is_alive() for thread in pool):
+        stop.wait(1.0)
+    for thread in pool:
+        thread.join()
@@ -2,7 +2,9 @@ from flask import Blueprint
 
 from app.product.controller import (
     add_or_update_product_details,
-    get_product_details
+    compare_basket,
+    get_product_details,
+    search_products
 )
 
 product_endpoints = Blueprint('product', __name__, url_prefix="/product")
@@ -11,3 +13,7 @@ product_endpoints.add_url_rule(
     rule='/', view_func=add_or_update_product_details, methods=['PUT'])
 product_endpoints.add_url_rule(
     rule='/', view_func=get_product_details, methods=['GET'])
+product_endpoints.add_url_rule(
+    rule='/search', view_func=search_products, methods=['GET'])
+product_endpoints.add_url_rule(
+    rule='/basket', view_func=compare_basket, methods=['POST'])
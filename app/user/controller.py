@@ -1,24 +1,36 @@
 from flask import request, jsonify
 from app.models.collections.user import User
-from app.models.collections.receipt import Receipt
+from app.models.collections.user_monthly_stats import UserMonthlyStats
+from app.models.collections.receipt import Receipt, RECEIPT_PAGE_SIZE
 from app.utils.auth_helper import token_required
 from app.models.response import Response
 
 
-@token_required
+# Everything the profile shows; never the whole document. 'userRating' is only the two
+# counters once migrate-user-ratings has moved the user's 'ratedByUsers' array out.
+PROFILE_FIELDS = (
+    "username", "userAvatarId", "preferredStoreProximity", "joinedAt",
+    "rankScore", "lastRankIncrement", "totalContributions", "totalExpenditure", "estimatedTotalSavings",
+    "userRating"
+)
+
+
+# The profile shows live stats written by any worker, so it reads the user fresh
+@token_required(fields=PROFILE_FIELDS, cached=False)
 def get_profile(current_user):
     """
     Retrieves the authenticated user's profile data with calculated ratings 
     and current month stats.
     """
     try:
-        # Ensure monthly stats are fresh before returning
-        User.check_and_reset_monthly_stats(str(current_user['_id']))
+        # Read-only: the month's figures come from userMonthlyStats; the user document's
+        # monthly counters are reset by rewards and `flask monthly-rollover`, not here
 
         # Calculate Average Rating (Base 5.0 + contributions)
         rating_obj = current_user.get('userRating', {})
         total_score = rating_obj.get('totalScore', 5)
-        raters_count = len(rating_obj.get('ratedByUsers', []))
+        # Not-yet-migrated users still list their earlier raters in the array
+        raters_count = rating_obj.get('raterCount', 0) + len(rating_obj.get('ratedByUsers', []))
 
         # Average = total / (raters + 1 for the base rating)
         avg_rating = round(total_score / (raters_count + 1), 2)
@@ -34,12 +46,7 @@ def get_profile(current_user):
             "totalExpenditure": current_user.get('totalExpenditure', 0.0),
             "estimatedTotalSavings": current_user.get('estimatedTotalSavings', 0.0),
             "userRating": avg_rating,
-            "monthlyStats": {
-                "month": current_user.get('statsMonth'),
-                "contributions": current_user.get('monthlyContributions', 0),
-                "expenditure": current_user.get('monthlyExpenditure', 0.0),
-                "savings": current_user.get('monthlySavings', 0.0)
-            }
+            "monthlyStats": UserMonthlyStats.get(str(current_user['_id']))
         }
 
         response = Response(
@@ -196,21 +203,96 @@ def get_submitted_receipts(current_user):
     """
     GET /user/receipt
     Query Params: ?month=YYYY-MM (Optional, defaults to current month)
+                  ?limit=N (Optional, page size, default 20, max 100)
+                  ?pageToken=... (Optional, 'nextPageToken' of the previous page)
+    Result: {"receipts": [...], "nextPageToken": str or null}, newest first.
+    Each receipt is a summary; GET /user/receipt/<receiptId> returns its full result.
     """
     try:
         user_id = str(current_user['_id'])
         month = request.args.get('month')  # e.g., "2023-12"
+        page_token = request.args.get('pageToken')
 
-        receipts = Receipt.get_by_user(user_id, month=month)
+        try:
+            limit = int(request.args.get('limit', RECEIPT_PAGE_SIZE))
+            receipts, next_page_token = Receipt.get_by_user(user_id, month=month, limit=limit, page_token=page_token)
+        except ValueError:
+            response = Response(
+                message_en="Invalid page size or page token.",
+                message_ja="ページサイズまたはページトークンが無効です。"
+            )
+            return jsonify(response.to_dict()), 400
 
         response = Response(
             errorStatus=0,
             message_en="Receipts fetched successfully.",
             message_ja="領収書の取得に成功しました。",
-            result=receipts
+            result={"receipts": receipts, "nextPageToken": next_page_token}
         )
         return jsonify(response.to_dict()), 200
 
     except Exception as e:
         print(f"Error fetching receipts: {e}")
         return jsonify(Response(message_en="Internal server error.", message_ja="内部サーバーエラー。").to_dict()), 500
+
+
+@token_required
+def get_stats_history(current_user):
+    """
+    GET /user/stats
+    Query Params: ?months=N (Optional, default 12, max 36)
+    Returns the user's monthly totals (receipts, contributions, expenditure, savings), newest month first.
+    """
+    try:
+        try:
+            months = int(request.args.get('months', 12))
+        except ValueError:
+            response = Response(
+                message_en="Invalid number of months.",
+                message_ja="月数が無効です。"
+            )
+            return jsonify(response.to_dict()), 400
+
+        history = UserMonthlyStats.get_history(str(current_user['_id']), months=months)
+
+        response = Response(
+            errorStatus=0,
+            message_en="Monthly stats fetched successfully.",
+            message_ja="月別統計の取得に成功しました。",
+            result=history
+        )
+        return jsonify(response.to_dict()), 200
+
+    except Exception as e:
+        print(f"Error fetching monthly stats: {e}")
+        return jsonify(Response(message_en="Internal server error.", message_ja="内部サーバーエラー。").to_dict()), 500
+
+
+@token_required
+def get_receipt_status(current_user, receipt_id):
+    """
+    GET /user/receipt/<receipt_id>
+    Cheap status poll for a submitted receipt (PENDING, SUCCESS or FAILED) with its result once done.
+    """
+    try:
+        receipt = Receipt.get_status(receipt_id, str(current_user['_id']))
+        if not receipt:
+            response = Response(
+                message_en="Receipt not found.",
+                message_ja="レシートが見つかりませんでした。"
+            )
+            return jsonify(response.to_dict()), 404
+
+        receipt['receiptId'] = str(receipt.pop('_id'))
+
+        response = Response(
+            errorStatus=0,
+            message_en="Receipt status fetched successfully.",
+            message_ja="レシートの状態の取得に成功しました。",
+            result=receipt
+        )
+        return jsonify(response.to_dict()), 200
+
+    except Exception as e:
+        print(f"Error fetching receipt status: {e}")
+        return jsonify(Response(message_en="Internal server error.", message_ja="内部サーバーエラー。").to_dict()), 500
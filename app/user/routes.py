@@ -5,7 +5,9 @@ from app.user.controller import (
     update_username,
     update_avatar_id,
     update_proximity,
-    get_submitted_receipts
+    get_submitted_receipts,
+    get_receipt_status,
+    get_stats_history
 )
 
 user_endpoints = Blueprint('user', __name__, url_prefix="/user")
@@ -15,3 +17,5 @@ user_endpoints.add_url_rule(rule='/username', view_func=update_username, methods
 user_endpoints.add_url_rule(rule='/avatar/id', view_func=update_avatar_id, methods=['PUT'])
 user_endpoints.add_url_rule(rule='/proximity', view_func=update_proximity, methods=['PUT'])
 user_endpoints.add_url_rule(rule='/receipt', view_func=get_submitted_receipts, methods=['GET'])
+user_endpoints.add_url_rule(rule='/receipt/<receipt_id>', view_func=get_receipt_status, methods=['GET'])
+user_endpoints.add_url_rule(rule='/stats', view_func=get_stats_history, methods=['GET'])
@@ -0,0 +1,136 @@
+import copy
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone, timedelta
+
+from cachetools import TTLCache
+
+from app.models.collections.receipt_analysis_cache import ReceiptAnalysisCache, ANALYSIS_CACHE_TTL
+from app.utils import metrics
+
+# A process waiting on another one's Gemini call gives up and calls Gemini itself after this
+ANALYSIS_CLAIM_LEASE = timedelta(seconds=120)
+# ...but a web request only waits this long (it holds a gunicorn worker) before calling Gemini itself
+ANALYSIS_WAIT_SECONDS = float(os.getenv("GEMINI_ANALYSIS_WAIT_SECONDS", "5"))
+_POLL_INTERVAL = 0.5
+
+_memory_cache = TTLCache(maxsize=256, ttl=ANALYSIS_CACHE_TTL.total_seconds())
+_memory_cache_lock = threading.Lock()
+
+# key -> Future of the analysis currently running in this process
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+_indexes_ready = False
+
+
+def analysis_cache_key(image_bytes: bytes, instruction: str, model: str) -> str:
+    """
+    sha256 of the optimized image plus a hash of the full prompt, which embeds the
+    reference date and the store list: a new day or a new store means a new key.
+    """
+    prompt_hash = hashlib.sha256(f"{model}\n{instruction}".encode("utf-8")).hexdigest()[:16]
+    return f"{hashlib.sha256(image_bytes).hexdigest()}:{prompt_hash}"
+
+
+def analyze_with_cache(key: str, analyze, max_wait: float = ANALYSIS_WAIT_SECONDS):
+    """
+    Returns the analysis for `key`, calling `analyze()` only when neither this process
+    (LRU) nor the shared Mongo cache has it. Concurrent calls for the same key share one
+    `analyze()`: threads of this process wait on its future, other processes poll the
+    PENDING document until the result lands, the claim's lease expires or `max_wait`
+    seconds pass (then they call `analyze()` themselves).
+    Failed analyses (None) are not cached.
+    """
+    global _indexes_ready
+    if not _indexes_ready:
+        ReceiptAnalysisCache.ensure_indexes()
+        _indexes_ready = True
+
+    with _memory_cache_lock:
+        cached = _memory_cache.get(key)
+    if cached is not None:
+        metrics.increment("analysis_cache.hit_memory")
+        return copy.deepcopy(cached)
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        metrics.increment("analysis_cache.shared")
+        return copy.deepcopy(future.result())
+
+    try:
+        result = _load_or_analyze(key, analyze, max_wait)
+        future.set_result(result)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+    if result is not None:
+        with _memory_cache_lock:
+            _memory_cache[key] = result
+    return copy.deepcopy(result)
+
+
+def _load_or_analyze(key: str, analyze, max_wait: float):
+    try:
+        doc = ReceiptAnalysisCache.get(key)
+        if doc and doc.get('status') == "DONE":
+            metrics.increment("analysis_cache.hit_db")
+            return doc['result']
+
+        claimed = ReceiptAnalysisCache.claim(key, ANALYSIS_CLAIM_LEASE)
+    except Exception as e:
+        print(f"Analysis cache unavailable, calling Gemini directly: {e}")
+        return analyze()
+
+    if not claimed:
+        result = _wait_for_other_process(key, max_wait)
+        if result is not None:
+            metrics.increment("analysis_cache.shared")
+            return result
+
+    metrics.increment("analysis_cache.miss")
+    result = None
+    try:
+        result = analyze()
+    finally:
+        try:
+            if result is not None:
+                ReceiptAnalysisCache.store_result(key, result)
+            elif claimed:
+                # Only our own claim; a process we stopped waiting for may still be working
+                ReceiptAnalysisCache.release(key)
+        except Exception as e:
+            print(f"Error saving receipt analysis {key}: {e}")
+    return result
+
+
+def _wait_for_other_process(key: str, max_wait: float):
+    """Polls another process's PENDING analysis; None if it failed, its lease ran out or max_wait passed."""
+    deadline = time.monotonic() + min(max_wait, ANALYSIS_CLAIM_LEASE.total_seconds())
+    while time.monotonic() < deadline:
+        time.sleep(_POLL_INTERVAL)
+        doc = ReceiptAnalysisCache.get(key)
+        if doc is None:
+            return None
+        if doc.get('status') == "DONE":
+            return doc['result']
+        lease_until = doc.get('leaseUntil')
+        if lease_until is not None:
+            if lease_until.tzinfo is None:
+                lease_until = lease_until.replace(tzinfo=timezone.utc)
+            if lease_until < datetime.now(timezone.utc):
+                return None
+    return None
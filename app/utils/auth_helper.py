@@ -1,5 +1,9 @@
+import hashlib
 import os
+import threading
+import time
 import jwt
+from cachetools import TLRUCache
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import request, jsonify
@@ -7,6 +11,18 @@ from flask import request, jsonify
 # Get secret key from environment variable
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 
+# Verified tokens per worker: sha256(token) -> (user id, exp). A client sends the same token
+# for days, so its signature is checked once per worker; entries drop out when the token expires.
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+
+
+def _token_expiry(_key, value, _now):
+    return value[1]
+
+
+_token_cache = TLRUCache(maxsize=TOKEN_CACHE_MAX_ENTRIES, ttu=_token_expiry, timer=time.time)
+_token_cache_lock = threading.Lock()
+
 
 def encode_auth_token(user_id: str) -> str:
     """
@@ -35,19 +51,23 @@ def encode_auth_token(user_id: str) -> str:
 def decode_auth_token(auth_token: str) -> str | None:
     """
     Decodes the auth token to retrieve the user ID.
-    Returns the user ID (sub) or None if invalid/expired.
+    Returns the user ID (sub) or an error string if invalid/expired.
+    Tokens verified before are answered from this worker's token cache until they expire.
     """
+    key = hashlib.sha256(auth_token.encode()).digest()
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+    if cached is not None:
+        return cached[0]
+
     try:
+        # PyJWT rejects expired tokens (ExpiredSignatureError)
         payload = jwt.decode(
             auth_token,
             SECRET_KEY,
             algorithms=['HS256']
         )
-        # Check if the token is expired (though PyJWT handles this by default)
-        if payload['exp'] < datetime.now(timezone.utc).timestamp():
-            return None  # Token is expired
-
-        return payload['sub']  # Returns the user ID string
+        user_id, expires_at = payload['sub'], payload['exp']
     except jwt.ExpiredSignatureError:
         return 'Signature expired'
     except jwt.InvalidTokenError:
@@ -56,12 +76,31 @@ def decode_auth_token(auth_token: str) -> str | None:
         print(f"Unexpected error decoding JWT: {e}")
         return 'Token error'
 
+    with _token_cache_lock:
+        _token_cache[key] = (user_id, expires_at)
+    return user_id  # Returns the user ID string
 
-def token_required(f):
+
+# Fields the auth decorators load by default: enough to know the user exists and who it is.
+# Endpoints that need more declare it, e.g. @token_required(fields=("username", "rankScore")).
+AUTH_USER_FIELDS = ("_id",)
+
+
+def _load_current_user(user_id: str, fields, cached: bool):
+    """The token's user with the declared fields; fields=None loads the whole document."""
+    from app.models.collections.user import User
+    return User.get_by_id(user_id, fields=fields, cached=cached)
+
+
+def token_required(f=None, *, fields: tuple = AUTH_USER_FIELDS, cached: bool = True):
     """
     A decorator to secure API routes.
     It checks for a 'Bearer' token in the Authorization header.
+    The user passed on holds only `fields` (from this worker's user cache unless cached=False).
     """
+    if f is None:
+        return lambda func: token_required(func, fields=fields, cached=cached)
+
     @wraps(f)
     def decorated(*args, **kwargs):
         auth_header = request.headers.get('Authorization')
@@ -78,9 +117,8 @@ def token_required(f):
         if isinstance(user_id_or_error, str) and user_id_or_error not in ('Signature expired', 'Invalid token', 'Token error'):
             # Token is valid, and user_id_or_error is the user_id string
 
-            # --- Optional: Database lookup to ensure user exists (best practice) ---
-            from app.models.collections.user import User
-            current_user = User.get_by_id(user_id_or_error)
+            # --- Database lookup to ensure user exists (cached per worker) ---
+            current_user = _load_current_user(user_id_or_error, fields, cached)
 
             if not current_user:
                 return jsonify({'message': 'Token is valid but user no longer exists'}), 401
@@ -94,13 +132,16 @@ def token_required(f):
     return decorated
 
 
-def token_optional(f):
+def token_optional(f=None, *, fields: tuple = AUTH_USER_FIELDS, cached: bool = True):
     """
     A decorator for routes that support optional authentication.
-    - If Token is valid: Passes `current_user` object.
+    - If Token is valid: Passes `current_user` object (only `fields`, as in token_required).
     - If Token is missing: Passes `current_user` as None.
     - If Token is present but invalid: Returns 401 (Enforces validity if attempted).
     """
+    if f is None:
+        return lambda func: token_optional(func, fields=fields, cached=cached)
+
     @wraps(f)
     def decorated(*args, **kwargs):
         auth_header = request.headers.get('Authorization')
@@ -114,8 +155,7 @@ def token_optional(f):
         user_id_or_error = decode_auth_token(token)
 
         if isinstance(user_id_or_error, str) and user_id_or_error not in ('Signature expired', 'Invalid token', 'Token error'):
-            from app.models.collections.user import User
-            current_user = User.get_by_id(user_id_or_error)
+            current_user = _load_current_user(user_id_or_error, fields, cached)
 
             if not current_user:
                 # Token valid structurally but user gone from DB
@@ -0,0 +1,119 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+from app.utils import metrics
+
+# Side effects that may run after the response (user rewards/penalties, store upserts)
+BACKGROUND_TASK_THREADS = int(os.getenv("BACKGROUND_TASK_THREADS", "4"))
+BACKGROUND_TASK_MAX_QUEUE = int(os.getenv("BACKGROUND_TASK_MAX_QUEUE", "200"))
+# What to do with a task when the queue is full: "inline" (run it on the caller's thread) or "drop"
+BACKGROUND_TASK_OVERFLOW = os.getenv("BACKGROUND_TASK_OVERFLOW", "inline")
+# How long a stopping worker waits for queued tasks (keep it under gunicorn's graceful_timeout)
+BACKGROUND_TASK_DRAIN_SECONDS = float(os.getenv("BACKGROUND_TASK_DRAIN_SECONDS", "20"))
+
+_STOP = object()
+
+_queue = None
+_threads = []
+_pid = None
+_lock = threading.Lock()
+_active = 0
+
+
+def submit(name: str, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on the shared background threads of this process.
+    When BACKGROUND_TASK_MAX_QUEUE tasks are already waiting, the task is run inline or
+    dropped (BACKGROUND_TASK_OVERFLOW); both are counted. Failures are logged and counted
+    instead of disappearing with a bare thread.
+    """
+    task_queue = _ensure_started()
+    try:
+        task_queue.put_nowait((name, fn, args, kwargs))
+    except queue.Full:
+        if BACKGROUND_TASK_OVERFLOW == "drop":
+            metrics.increment("background.dropped")
+            print(f"Background queue full, dropped task {name}")
+            return
+        metrics.increment("background.inline")
+        _run(name, fn, args, kwargs)
+        return
+    metrics.set_gauge("background.queued", task_queue.qsize())
+
+
+def _ensure_started():
+    """Starts this process's threads on first use (a forked gunicorn worker starts its own)."""
+    global _queue, _threads, _pid
+    pid = os.getpid()
+    if _queue is not None and _pid == pid:
+        return _queue
+
+    with _lock:
+        if _queue is None or _pid != pid:
+            _queue = queue.Queue(maxsize=BACKGROUND_TASK_MAX_QUEUE)
+            # Daemon threads: interpreter exit must not block on idle workers; _drain waits for the work
+            _threads = [
+                threading.Thread(target=_worker, args=(_queue,), name=f"background-{i}", daemon=True)
+                for i in range(BACKGROUND_TASK_THREADS)
+            ]
+            for thread in _threads:
+                thread.start()
+            _pid = pid
+    return _queue
+
+
+def _worker(task_queue):
+    while True:
+        task = task_queue.get()
+        try:
+            if task is _STOP:
+                return
+            metrics.set_gauge("background.queued", task_queue.qsize())
+            _run(*task)
+        finally:
+            task_queue.task_done()
+
+
+def _run(name, fn, args, kwargs):
+    global _active
+    with _lock:
+        _active += 1
+        metrics.set_gauge("background.active", _active)
+    try:
+        fn(*args, **kwargs)
+    except Exception as e:
+        metrics.increment("background.failed")
+        print(f"Background task {name} failed: {e}")
+    finally:
+        with _lock:
+            _active -= 1
+            metrics.set_gauge("background.active", _active)
+
+
+@atexit.register
+def _drain():
+    """On worker shutdown, finishes the queued tasks (up to BACKGROUND_TASK_DRAIN_SECONDS)."""
+    if _queue is None or _pid != os.getpid():
+        return
+
+    pending = _queue.qsize() + _active
+    if pending:
+        print(f"Waiting for {pending} background tasks before exiting...")
+    deadline = time.monotonic() + BACKGROUND_TASK_DRAIN_SECONDS
+    for _ in _threads:
+        # Blocks while the queue is full; the stop markers queue up behind the remaining tasks
+        try:
+            _queue.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            break
+    for thread in _threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    with _queue.mutex:
+        left = sum(1 for task in _queue.queue if task is not _STOP) + _active
+    if left:
+        metrics.increment("background.lost", left)
+        print(f"Exiting with {left} background tasks unfinished.")
@@ -0,0 +1,121 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Upper bound on the (items x stores x stores) cells evaluated per step of the two-store search
+_MAX_PAIR_CELLS = 1 << 21
+
+
+def build_price_matrix(price_entries: list, min_date: datetime = None):
+    """
+    Turns one list of {store, price, date} entries per basket item into a dense
+    (items x stores) unit-price matrix, np.inf where a store has no usable price.
+    Entries dated before `min_date` (or undated, when `min_date` is given) and negative
+    prices (discount lines) are ignored. Returns (matrix, store_names).
+    """
+    # Compare against both naive (as stored) and aware dates without converting every entry
+    min_naive = min_date.astimezone(timezone.utc).replace(tzinfo=None) if min_date is not None else None
+
+    rows = []
+    for entries in price_entries:
+        row = {}
+        for entry in entries:
+            price = entry.get('price')
+            if entry.get('store') is None or not isinstance(price, (int, float)) or price < 0:
+                continue
+            if min_date is not None:
+                date = entry.get('date')
+                if not isinstance(date, datetime):
+                    continue
+                if date < (min_naive if date.tzinfo is None else min_date):
+                    continue
+            store = entry['store']
+            row[store] = min(price, row.get(store, price))
+        rows.append(row)
+
+    stores = sorted({store for row in rows for store in row})
+    column = {store: j for j, store in enumerate(stores)}
+    matrix = np.full((len(rows), len(stores)), np.inf)
+    for i, row in enumerate(rows):
+        for store, price in row.items():
+            matrix[i, column[store]] = price
+    return matrix, stores
+
+
+def compare_stores(matrix: np.ndarray, quantities) -> dict:
+    """
+    Scores a basket against every store.
+
+    Returns {"stores": [...], "bestSplit": {...} or None} where each store entry holds
+    the cost of the items it sells, how many it covers and the indexes of the missing ones,
+    ordered by coverage then total. "bestSplit" is the pair of stores covering the most items
+    at the lowest cost when each item is bought wherever of the two it is cheaper.
+    """
+    cost = matrix * np.asarray(quantities, dtype=np.float64)[:, None]
+    available = np.isfinite(cost)
+    coverage = available.sum(axis=0)
+    totals = np.where(available, cost, 0.0).sum(axis=0)
+
+    stores = [
+        {
+            "column": int(j),
+            "total": float(totals[j]),
+            "covered": int(coverage[j]),
+            "missing": np.flatnonzero(~available[:, j]).tolist()
+        }
+        for j in np.lexsort((totals, -coverage))
+    ]
+
+    return {"stores": stores, "bestSplit": _best_pair(cost)}
+
+
+def _best_pair(cost: np.ndarray):
+    """
+    Exhaustive two-store search without materializing a per-pair cost for every item.
+
+    With Z the costs (0 where not sold) and A the availability mask, buying each item at
+    the cheaper of stores a and b costs
+        T[a] + T[b] - (Z^T A)[a, b] - (A^T Z)[a, b] + sum_i min(Z[i, a], Z[i, b])
+    (items sold by both are counted once, at the lower price; prices are non-negative,
+    so the min term is 0 unless both stores sell the item). Only the min term needs
+    an (items x stores x stores) pass, done in blocks of first stores to bound memory.
+    """
+    n_items, n_stores = cost.shape
+    if n_stores < 2 or n_items == 0:
+        return None
+
+    available = np.isfinite(cost)
+    a_mask = available.astype(np.float64)
+    z = np.where(available, cost, 0.0)
+    store_totals = z.sum(axis=0)
+    store_coverage = a_mask.sum(axis=0)
+
+    covered = store_coverage[:, None] + store_coverage[None, :] - a_mask.T @ a_mask
+    shared = z.T @ a_mask
+    totals = store_totals[:, None] + store_totals[None, :] - shared - shared.T
+
+    z_by_store = np.ascontiguousarray(z.T)
+    block = max(1, _MAX_PAIR_CELLS // (n_items * n_stores))
+    for first in range(0, n_stores, block):
+        rows = z_by_store[first:first + block]
+        totals[first:first + block] += np.minimum(rows[:, None, :], z_by_store[None, :, :]).sum(axis=2)
+
+    # Only unordered pairs a < b; most items covered first, then cheapest
+    a_idx, b_idx = np.triu_indices(n_stores, k=1)
+    pair_covered = np.rint(covered[a_idx, b_idx]).astype(np.int64)
+    pair_totals = totals[a_idx, b_idx]
+    best = np.lexsort((pair_totals, -pair_covered))[0]
+    if pair_covered[best] == 0:
+        return None
+    a, b = int(a_idx[best]), int(b_idx[best])
+
+    # Item -> store it is bought at (-1: neither store sells it)
+    assignment = np.where(cost[:, a] <= cost[:, b], a, b)
+    assignment[~(available[:, a] | available[:, b])] = -1
+
+    return {
+        "columns": [a, b],
+        "total": float(pair_totals[best]),
+        "covered": int(pair_covered[best]),
+        "assignment": assignment.tolist()
+    }
@@ -0,0 +1,263 @@
+import fcntl
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone, timedelta
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from app.utils.ngram_index import NgramIndex
+
+# Layout of one snapshot directory:
+#   CURRENT            name of the published version, swapped with os.replace
+#   .build.lock        flock held while a process builds a new version
+#   v<ns>/meta.json    size, watermark, build time
+#   v<ns>/*.npy        the arrays below, never modified once the version is published
+_CURRENT_FILE = "CURRENT"
+_LOCK_FILE = ".build.lock"
+_META_FILE = "meta.json"
+
+# Versions kept on disk; older ones are deleted after a build (mapped files stay valid for their readers)
+_KEEP_VERSIONS = 2
+
+_DOC_ARRAYS = ("ids", "sorted_ids", "sorted_positions", "name_refs", "english_refs",
+               "alias_ptr", "alias_refs", "updated_at", "string_offsets", "string_data")
+_INDEX_ARRAYS = ("keys", "gram_ids", "indptr", "postings", "gram_counts")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def current_version(directory: str):
+    """Returns the published version name, or None if nothing was published yet."""
+    try:
+        with open(os.path.join(directory, _CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def build_or_load(directory: str, load_docs, stale_version=None):
+    """
+    Opens the published snapshot, first building one from `load_docs()` if there is none
+    or the published one is still `stale_version`.
+
+    Builds are serialized with an exclusive file lock. Processes that queued up behind a
+    build find the new version when they get the lock and just open it, so any number
+    of workers asking at once cost a single catalog read and build.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, _LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            version = current_version(directory)
+            if version is None or version == stale_version:
+                version = CatalogSnapshot.write(directory, load_docs())
+            return CatalogSnapshot(directory, version)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _to_millis(value):
+    if not isinstance(value, datetime):
+        return -1
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+
+def _from_millis(millis):
+    # Naive UTC, like the datetimes pymongo hands back
+    return None if millis < 0 else (_EPOCH + timedelta(milliseconds=millis)).replace(tzinfo=None)
+
+
+class CatalogSnapshot:
+    """
+    Read-only product catalog shared by every worker through memory-mapped files:
+    ids, names, English names, aliases, 'updatedAt' and the n-gram index arrays.
+    The OS page cache holds one copy however many processes map it.
+    """
+
+    def __init__(self, directory: str, version: str):
+        path = os.path.join(directory, version)
+        with open(os.path.join(path, _META_FILE)) as f:
+            meta = json.load(f)
+
+        self.version = version
+        self.size = meta["size"]
+        # Latest 'updatedAt' in the snapshot (aware, like Product's watermark), None for an empty catalog
+        self.watermark = _EPOCH + timedelta(milliseconds=meta["watermark"]) if meta["watermark"] >= 0 else None
+        self.built_at = datetime.fromisoformat(meta["builtAt"])
+
+        self._arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in _DOC_ARRAYS + _INDEX_ARRAYS
+        }
+        self.index = NgramIndex.from_arrays({name: self._arrays[name] for name in _INDEX_ARRAYS})
+
+    def __len__(self):
+        return self.size
+
+    def _string(self, ref: int) -> str:
+        offsets = self._arrays["string_offsets"]
+        return self._arrays["string_data"][offsets[ref]:offsets[ref + 1]].tobytes().decode("utf-8")
+
+    def doc(self, position: int) -> dict:
+        """Materializes the cached fields of one product (same shape as a CACHE_PROJECTION read)."""
+        arrays = self._arrays
+        english_ref = int(arrays["english_refs"][position])
+        alias_refs = arrays["alias_refs"][arrays["alias_ptr"][position]:arrays["alias_ptr"][position + 1]]
+        return {
+            "_id": ObjectId(arrays["ids"][position].tobytes()),
+            "name": self._string(int(arrays["name_refs"][position])),
+            "englishName": self._string(english_ref) if english_ref >= 0 else None,
+            "aliases": [self._string(int(ref)) for ref in alias_refs],
+            "updatedAt": _from_millis(int(arrays["updated_at"][position]))
+        }
+
+    def position_of(self, product_id):
+        """Position of the product with this _id, or None (binary search over the sorted ids)."""
+        if not isinstance(product_id, ObjectId):
+            return None
+        sorted_ids = self._arrays["sorted_ids"]
+        key = np.frombuffer(product_id.binary, dtype=sorted_ids.dtype)
+        i = int(np.searchsorted(sorted_ids, key)[0])
+        if i < len(sorted_ids) and sorted_ids[i].tobytes() == product_id.binary:
+            return int(self._arrays["sorted_positions"][i])
+        return None
+
+    @staticmethod
+    def write(directory: str, docs: list) -> str:
+        """
+        Writes `docs` (CACHE_PROJECTION reads) as a new version and publishes it.
+        The files are complete before the directory and CURRENT are renamed into place,
+        so a reader never opens a partial snapshot. Returns the new version name.
+        """
+        strings = []
+        name_refs = np.empty(len(docs), dtype=np.int32)
+        english_refs = np.full(len(docs), -1, dtype=np.int32)
+        alias_ptr = np.zeros(len(docs) + 1, dtype=np.int64)
+        alias_refs = []
+        updated_at = np.empty(len(docs), dtype=np.int64)
+        watermark = -1
+
+        for position, doc in enumerate(docs):
+            name_refs[position] = len(strings)
+            strings.append(doc.get('name') or '')
+            if doc.get('englishName'):
+                english_refs[position] = len(strings)
+                strings.append(doc['englishName'])
+            for alias in doc.get('aliases', []):
+                alias_refs.append(len(strings))
+                strings.append(alias)
+            alias_ptr[position + 1] = len(alias_refs)
+            updated_at[position] = _to_millis(doc.get('updatedAt'))
+            watermark = max(watermark, int(updated_at[position]))
+
+        encoded = [text.encode("utf-8") for text in strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        string_offsets[1:] = np.cumsum([len(data) for data in encoded])
+
+        # Raw 12-byte ObjectIds; void arrays sort and binary-search bytewise
+        ids = np.frombuffer(b"".join(doc['_id'].binary for doc in docs), dtype="V12")
+        sorted_positions = np.argsort(ids, kind="stable").astype(np.int32)
+
+        index = NgramIndex.build(
+            (position, text)
+            for position, doc in enumerate(docs)
+            for text in [doc.get('name', '')] + doc.get('aliases', [])
+        )
+
+        arrays = dict(index.to_arrays(), **{
+            "ids": ids,
+            "sorted_ids": ids[sorted_positions],
+            "sorted_positions": sorted_positions,
+            "name_refs": name_refs,
+            "english_refs": english_refs,
+            "alias_ptr": alias_ptr,
+            "alias_refs": np.array(alias_refs, dtype=np.int32),
+            "updated_at": updated_at,
+            "string_offsets": string_offsets,
+            "string_data": np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        })
+
+        version = f"v{time.time_ns()}"
+        staging = os.path.join(directory, f".tmp-{version}-{os.getpid()}")
+        os.makedirs(staging)
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, f"{name}.npy"), array)
+        with open(os.path.join(staging, _META_FILE), "w") as f:
+            json.dump({
+                "size": len(docs),
+                "watermark": watermark,
+                "builtAt": datetime.now(timezone.utc).isoformat()
+            }, f)
+        os.rename(staging, os.path.join(directory, version))
+
+        pointer = os.path.join(directory, f".{_CURRENT_FILE}.{os.getpid()}")
+        with open(pointer, "w") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer, os.path.join(directory, _CURRENT_FILE))
+
+        CatalogSnapshot._remove_old_versions(directory)
+        return version
+
+    @staticmethod
+    def _remove_old_versions(directory: str):
+        versions = sorted(name for name in os.listdir(directory) if name.startswith("v"))
+        for name in versions[:-_KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+class SnapshotDocs:
+    """
+    List-like view of a snapshot's products plus this worker's changes since it was built
+    (replaced and appended docs), so Product can use it in place of its list cache.
+    """
+
+    def __init__(self, snapshot: CatalogSnapshot):
+        self._snapshot = snapshot
+        self._replaced = {}
+        self._appended = []
+
+    def __len__(self):
+        return len(self._snapshot) + len(self._appended)
+
+    def __getitem__(self, position: int) -> dict:
+        if position >= len(self._snapshot):
+            return self._appended[position - len(self._snapshot)]
+        doc = self._replaced.get(position)
+        return doc if doc is not None else self._snapshot.doc(position)
+
+    def __setitem__(self, position: int, doc: dict):
+        if position >= len(self._snapshot):
+            self._appended[position - len(self._snapshot)] = doc
+        else:
+            self._replaced[position] = doc
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def append(self, doc: dict):
+        self._appended.append(doc)
+
+
+class SnapshotPositions:
+    """_id -> position lookups over a snapshot, plus the products appended since it was built."""
+
+    def __init__(self, snapshot: CatalogSnapshot):
+        self._snapshot = snapshot
+        self._added = {}
+
+    def get(self, product_id, default=None):
+        position = self._added.get(product_id)
+        if position is None:
+            position = self._snapshot.position_of(product_id)
+        return default if position is None else position
+
+    def __setitem__(self, product_id, position: int):
+        self._added[product_id] = position
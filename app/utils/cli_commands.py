@@ -0,0 +1,331 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+
+from pymongo import UpdateOne
+from app import app
+from app import db
+from app.models.collections.product import (
+    Product, CACHE_PROJECTION, PRICE_SUMMARY_STAGE, PRICES_TO_ARRAY_STAGE, PRODUCT_SNAPSHOT_DIR
+)
+from app.models.collections.receipt import Receipt
+from app.models.collections.user import User
+from app.models.collections.user_monthly_stats import UserMonthlyStats
+from app.models.collections.user_rating import UserRating
+from app.product.processor import run_receipt_worker
+from app.utils import catalog_snapshot, metrics
+from app.utils.text_normalizer import canonicalize_product_name
+
+
+@app.cli.command("backfill-product-keys")
+@click.option("--batch-size", default=500, show_default=True, help="Products updated per bulk_write.")
+def backfill_product_keys(batch_size):
+    """Recomputes 'nameKeys' (canonical name/alias keys) for every product."""
+    collection = Product.get_collection()
+    if collection is None:
+        click.echo("Database is not configured.")
+        return
+
+    collection.create_index([("nameKeys", 1)])
+
+    updated = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        batch = list(collection.find(query, {"name": 1, "aliases": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        operations = []
+        for doc in batch:
+            keys = {canonicalize_product_name(text) for text in [doc.get("name", "")] + doc.get("aliases", [])}
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"nameKeys": sorted(keys - {""})}}))
+
+        collection.bulk_write(operations, ordered=False)
+        updated += len(operations)
+        last_id = batch[-1]["_id"]
+        click.echo(f"Backfilled name keys for {updated} products (last _id {last_id})")
+
+    click.echo(f"Done. {updated} products updated.")
+
+
+@app.cli.command("backfill-price-summary")
+def backfill_price_summary():
+    """Recomputes 'priceSummary' (cheapest store/price) for every product from its prices."""
+    collection = Product.get_collection()
+    if collection is None:
+        click.echo("Database is not configured.")
+        return
+
+    # Documents still on the legacy prices map are handled by migrate-product-prices
+    result = collection.update_many({"prices": {"$type": "array"}}, [PRICE_SUMMARY_STAGE])
+    click.echo(f"Done. {result.modified_count} products updated.")
+
+
+@app.cli.command("migrate-product-prices")
+@click.option("--batch-size", default=500, show_default=True, help="Products converted per update.")
+@click.option("--restart", is_flag=True, help="Ignore the saved checkpoint and scan from the first product.")
+def migrate_product_prices(batch_size, restart):
+    """
+    Converts 'prices.<store>: {price, date}' maps into [{store, price, date}] arrays.
+    Resumable: the last converted _id is checkpointed in the 'migrations' collection.
+    """
+    collection = Product.get_collection()
+    if collection is None:
+        click.echo("Database is not configured.")
+        return
+
+    checkpoints = db['migrations']
+    checkpoint_id = "product-prices-array"
+    if restart:
+        checkpoints.delete_one({"_id": checkpoint_id})
+
+    checkpoint = checkpoints.find_one({"_id": checkpoint_id}) or {}
+    last_id = checkpoint.get("lastId")
+    converted = checkpoint.get("converted", 0)
+    if last_id:
+        click.echo(f"Resuming after _id {last_id} ({converted} products converted so far)")
+
+    # $type also matches array elements, and converted prices are arrays of objects: exclude arrays
+    legacy_prices = {"$type": "object", "$not": {"$type": "array"}}
+
+    while True:
+        query = {"prices": legacy_prices}
+        if last_id:
+            query["_id"] = {"$gt": last_id}
+        ids = [doc["_id"] for doc in collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+        if not ids:
+            break
+
+        result = collection.update_many(
+            {"_id": {"$in": ids}, "prices": legacy_prices},
+            [PRICES_TO_ARRAY_STAGE, PRICE_SUMMARY_STAGE]
+        )
+        converted += result.modified_count
+        last_id = ids[-1]
+        checkpoints.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"lastId": last_id, "converted": converted}},
+            upsert=True
+        )
+        click.echo(f"Converted {converted} products (last _id {last_id})")
+
+    # The whole-subdocument index is useless for the array layout
+    try:
+        collection.drop_index("prices_1")
+    except Exception:
+        pass
+    collection.create_index([("prices.store", 1), ("prices.price", 1)])
+    collection.create_index([("prices.store", 1), ("prices.date", -1)])
+
+    click.echo(f"Done. {converted} products converted.")
+
+
+@app.cli.command("build-product-snapshot")
+def build_product_snapshot():
+    """
+    Publishes a fresh catalog snapshot to PRODUCT_SNAPSHOT_DIR, e.g. before starting the workers,
+    so none of them has to build it on its first request.
+    """
+    collection = Product.get_collection()
+    if collection is None:
+        click.echo("Database is not configured.")
+        return
+    if not PRODUCT_SNAPSHOT_DIR:
+        click.echo("PRODUCT_SNAPSHOT_DIR is not set.")
+        return
+
+    snapshot = catalog_snapshot.build_or_load(
+        PRODUCT_SNAPSHOT_DIR,
+        lambda: list(collection.find({}, CACHE_PROJECTION)),
+        stale_version=catalog_snapshot.current_version(PRODUCT_SNAPSHOT_DIR)
+    )
+    click.echo(f"Published snapshot {snapshot.version} with {len(snapshot)} products.")
+
+
+@app.cli.command("receipt-worker")
+@click.option("--threads", default=4, show_default=True, help="Receipts processed concurrently.")
+@click.option("--poll-interval", default=1.0, show_default=True, help="Seconds to wait when the queue is empty.")
+@click.option("--metrics-port", default=0, show_default=True,
+              help="Serve this process's GET /metrics on 127.0.0.1:<port> (0: off).")
+def receipt_worker(threads, poll_interval, metrics_port):
+    """Processes receipts uploaded with RECEIPT_PROCESSING_MODE=async."""
+    if db is None:
+        click.echo("Database is not configured.")
+        return
+    if metrics_port:
+        metrics.serve(metrics_port)
+        click.echo(f"Receipt worker metrics on http://127.0.0.1:{metrics_port}/metrics")
+    run_receipt_worker(threads=threads, poll_interval=poll_interval)
+
+
+@app.cli.command("backfill-user-monthly-stats")
+@click.option("--batch-size", default=200, show_default=True, help="Users whose receipts are aggregated per batch.")
+def backfill_user_monthly_stats(batch_size):
+    """
+    Rebuilds 'userMonthlyStats' from the SUCCESS receipts, a batch of users at a time.
+    Safe to re-run and to run while receipts are being rewarded (see UserMonthlyStats.rebuild_operations).
+    Savings are not stored on receipts: only the current month's come from the user document.
+    """
+    users = User.get_collection()
+    stats = UserMonthlyStats.get_collection()
+    if users is None or stats is None:
+        click.echo("Database is not configured.")
+        return
+
+    UserMonthlyStats.ensure_indexes()
+    current_month = UserMonthlyStats.current_month()
+    receipts = Receipt.get_collection()
+
+    written = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        batch = list(users.find(
+            query,
+            {"statsMonth": 1, "monthlyContributions": 1, "monthlyExpenditure": 1, "monthlySavings": 1}
+        ).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        rows = {}
+        # Served by the (userId, submittedAt, _id) receipt index
+        for group in receipts.aggregate([
+            {"$match": {"userId": {"$in": [user["_id"] for user in batch]}, "status": "SUCCESS"}},
+            {"$group": {
+                "_id": {
+                    "userId": "$userId",
+                    "month": {"$dateToString": {"format": "%Y-%m", "date": "$submittedAt"}}
+                },
+                "receipts": {"$sum": 1},
+                "contributions": {"$sum": "$productsUpdated"},
+                "expenditure": {"$sum": "$totalAmount"}
+            }}
+        ]):
+            rows[(group["_id"]["userId"], group["_id"]["month"])] = {
+                "userId": group["_id"]["userId"],
+                "month": group["_id"]["month"],
+                "receipts": group["receipts"],
+                "contributions": group["contributions"],
+                "expenditure": group["expenditure"]
+            }
+
+        # The user document's live counters cover the current month, savings included
+        for user in batch:
+            if user.get("statsMonth") != current_month:
+                continue
+            row = rows.setdefault((user["_id"], current_month), {"userId": user["_id"], "month": current_month})
+            row["contributions"] = max(row.get("contributions", 0), user.get("monthlyContributions", 0))
+            row["expenditure"] = max(row.get("expenditure", 0.0), user.get("monthlyExpenditure", 0.0))
+            row["savings"] = user.get("monthlySavings", 0.0)
+
+        operations = UserMonthlyStats.rebuild_operations(list(rows.values()), current_month)
+        if operations:
+            stats.bulk_write(operations, ordered=False)
+        written += len(operations)
+        last_id = batch[-1]["_id"]
+        click.echo(f"Backfilled {written} user-months (last user _id {last_id})")
+
+    click.echo(f"Done. {written} user-months written.")
+
+
+def _next_rollover(now: datetime, delay_minutes: int) -> datetime:
+    """`delay_minutes` after the next midnight UTC on the 1st of a month."""
+    this_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc) + timedelta(minutes=delay_minutes)
+    if now < this_month:
+        return this_month
+    year, month = (now.year + 1, 1) if now.month == 12 else (now.year, now.month + 1)
+    return datetime(year, month, 1, tzinfo=timezone.utc) + timedelta(minutes=delay_minutes)
+
+
+@app.cli.command("monthly-rollover")
+@click.option("--batch-size", default=1000, show_default=True, help="Users reset per update_many.")
+@click.option("--wait", is_flag=True, help="Keep running and roll over shortly after midnight UTC on every 1st.")
+@click.option("--delay-minutes", default=5, show_default=True, help="Minutes after midnight to start (with --wait).")
+def monthly_rollover(batch_size, wait, delay_minutes):
+    """
+    Zeroes the monthly counters of every user still on a previous month, in batches.
+    Run it from cron just after midnight UTC on the 1st (e.g. `5 0 1 * *`), or as a
+    long-lived process with --wait. Rewards reset a stale month themselves, so a late run is harmless.
+    """
+    if User.get_collection() is None:
+        click.echo("Database is not configured.")
+        return
+
+    while True:
+        if wait:
+            next_run = _next_rollover(datetime.now(timezone.utc), delay_minutes)
+            click.echo(f"Next monthly rollover at {next_run.isoformat()}")
+            while datetime.now(timezone.utc) < next_run:
+                time.sleep(min(3600.0, (next_run - datetime.now(timezone.utc)).total_seconds()))
+
+        month = datetime.now(timezone.utc).strftime("%Y-%m")
+        reset = 0
+        last_id = None
+        while True:
+            count, last_id = User.roll_over_monthly_stats(month, after_id=last_id, batch_size=batch_size)
+            if last_id is None:
+                break
+            reset += count
+            click.echo(f"Reset monthly stats of {reset} users for {month} (last _id {last_id})")
+
+        click.echo(f"Done. {reset} users rolled over to {month}.")
+        if not wait:
+            return
+
+
+@app.cli.command("migrate-user-ratings")
+@click.option("--batch-size", default=200, show_default=True, help="Users migrated per batch.")
+def migrate_user_ratings(batch_size):
+    """
+    Moves 'userRating.ratedByUsers' arrays into 'userRatings' and replaces each with the
+    'userRating.raterCount' counter. Safe to re-run and to run while new ratings arrive.
+    Individual scores were never stored, so migrated ratings have score None.
+    """
+    users = User.get_collection()
+    ratings = UserRating.get_collection()
+    if users is None or ratings is None:
+        click.echo("Database is not configured.")
+        return
+
+    UserRating.ensure_indexes()
+
+    migrated = 0
+    last_id = None
+    while True:
+        query = {"userRating.ratedByUsers": {"$exists": True}}
+        if last_id:
+            query["_id"] = {"$gt": last_id}
+        batch = list(users.find(query, {"userRating.ratedByUsers": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"targetUserId": user["_id"], "raterUserId": rater_id},
+                {"$setOnInsert": {"score": None, "createdAt": now, "migrated": True}},
+                upsert=True
+            )
+            for user in batch
+            for rater_id in user["userRating"]["ratedByUsers"]
+        ]
+        if operations:
+            ratings.bulk_write(operations, ordered=False)
+
+        for user in batch:
+            # Counted from the rating documents, so a re-run after a crash adds the same number;
+            # ratings added since the deploy already incremented raterCount themselves
+            count = ratings.count_documents({"targetUserId": user["_id"], "migrated": True})
+            users.update_one(
+                {"_id": user["_id"], "userRating.ratedByUsers": {"$exists": True}},
+                {"$inc": {"userRating.raterCount": count}, "$unset": {"userRating.ratedByUsers": ""}}
+            )
+            User.invalidate_cache(user["_id"])
+
+        migrated += len(batch)
+        last_id = batch[-1]["_id"]
+        click.echo(f"Migrated ratings of {migrated} users (last _id {last_id})")
+
+    click.echo(f"Done. {migrated} users migrated.")
@@ -1,11 +1,40 @@
 import os
 import json
+import time
 import base64
 import textwrap
+import threading
 from typing import List, Optional
+
+import httpx
+from cachetools import LRUCache
 from pydantic import BaseModel, Field
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, stop_after_delay, wait_random_exponential
+
+from app.utils import metrics
+
+# --- Client Configuration ---
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Empty: Google's endpoint. Point at a local fake server for tests and load runs.
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT_SECONDS", "5"))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT_SECONDS", "60"))
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+# Retries stop once this much time has gone by since the first attempt
+GEMINI_RETRY_DEADLINE = float(os.getenv("GEMINI_RETRY_DEADLINE_SECONDS", "90"))
+
+# > 0: keep the system instruction in an explicit Gemini context cache for this long (re-created before
+# it expires). Gemini only accepts caches above a model-specific minimum size; below it calls fall back
+# to sending the instruction inline.
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "0"))
+# After a failed cache creation, wait this long before trying again
+_CONTEXT_CACHE_RETRY_SECONDS = 600
+
+# HTTP statuses worth another attempt: timeout, rate limit, overloaded / unavailable upstream
+_TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
 
 # --- Pydantic Models for Structured Output ---
 
@@ -24,82 +53,263 @@ class ReceiptAnalysis(BaseModel):
     products: List[Product] = Field(description="List of extracted products. Empty if error_code is not 0.")
 
 
-def get_receipt_analysis_instruction(date_str, target_city, available_stores):
+# Static part of the prompt, sent as the system instruction: identical on every call, so it is
+# a stable request prefix Gemini can cache (see GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+RECEIPT_ANALYSIS_SYSTEM_INSTRUCTION = textwrap.dedent("""
+    Instructions:
+    You are an expert receipt analysis AI. Analyze the provided image and extract data
+    into the specified JSON format. The Reference Date, Target City and Known Stores
+    are given with the image. Follow these validation steps in order:
+
+    1. Image Validation (Safeguards):
+       - Is the image a photograph of a physical receipt?
+       - Is the receipt from a Convenience Store, Supermarket, or Drug Store?
+       - Does the image appear authentic (NOT digitally edited, photoshopped, or screen-generated)?
+       - If the image is NOT a receipt or NOT from a valid store type -> Set error_code to 1.
+       - If the image appears edited or tampered with -> Set error_code to 2.
+       - If valid, proceed to the next step.
+
+    2. Analyze Billing Date:
+       - Check if the receipt date is within 3 days (inclusive) BEFORE the Reference Date.
+       - If date is too old or in the future -> Set error_code to 3.
+       - If date is missing/unreadable -> Set error_code to 4.
+
+    3. Analyze Store Location:
+       - Check if the store address/branch is in the Target City.
+       - If NOT in the Target City -> Set error_code to 5.
+       - If location is missing/unreadable -> Set error_code to 6.
+
+    4. Identify Store Name:
+       - Match against the Known Stores list.
+       - If match found -> Use the standard list name.
+       - If NO match -> Extract the generic brand name (exclude branch name).
+       - If store name is missing/unreadable -> Set error_code to 7.
+
+    5. Extract Data (Only if error_code is 0):
+       - Extract "products": List of items (name, english_name, price).
+       - Extract "total_amount": The Grand Total if possible.
+       - Set error_code to 0.
+
+    Constraint: If error_code is NOT 0, set 'store_name' to null, 'total_amount' to 0.0, and 'products' to [].
+""")
+
+# (date, city, store list version) -> rendered per-request instruction
+_instruction_cache = LRUCache(maxsize=16)
+_instruction_cache_lock = threading.Lock()
+
+
+def get_receipt_analysis_instruction(date_str, target_city, available_stores, stores_version=None):
+    """
+    The per-request part of the prompt (the values the system instruction refers to).
+    Memoized by (date, city, stores_version) when the caller passes the store list version.
+    """
+    key = (date_str, target_city, stores_version)
+    if stores_version is not None:
+        with _instruction_cache_lock:
+            cached = _instruction_cache.get(key)
+        if cached is not None:
+            return cached
+
     stores_list_str = ", ".join(available_stores)
+    instruction = (
+        f"Reference Date: {date_str}\n"
+        f"Target City: {target_city}\n"
+        f"Known Stores: [{stores_list_str}]\n"
+    )
+
+    if stores_version is not None:
+        with _instruction_cache_lock:
+            _instruction_cache[key] = instruction
+    return instruction
+
+
+class _ClientTimeoutHttpx(httpx.Client):
+    """
+    httpx client that always applies its own connect/read timeouts.
+    The SDK passes a single flat per-request timeout (or None, which would disable them).
+    """
+
+    def request(self, *args, timeout=None, **kwargs):
+        return super().request(*args, **kwargs)
+
+    def build_request(self, *args, timeout=None, **kwargs):
+        return super().build_request(*args, **kwargs)
 
-    receipt_analysis_instruction = textwrap.dedent(f"""
-        Instructions:
-        You are an expert receipt analysis AI. Analyze the provided image and extract data 
-        into the specified JSON format. Follow these validation steps in order:
-
-        1. Image Validation (Safeguards):
-           - Is the image a photograph of a physical receipt?
-           - Is the receipt from a Convenience Store, Supermarket, or Drug Store?
-           - Does the image appear authentic (NOT digitally edited, photoshopped, or screen-generated)?
-           - If the image is NOT a receipt or NOT from a valid store type -> Set error_code to 1.
-           - If the image appears edited or tampered with -> Set error_code to 2.
-           - If valid, proceed to the next step.
-
-        2. Analyze Billing Date:
-           - Reference Date: {date_str}
-           - Check if the receipt date is within 3 days (inclusive) BEFORE this reference date.
-           - If date is too old or in the future -> Set error_code to 3.
-           - If date is missing/unreadable -> Set error_code to 4.
-
-        3. Analyze Store Location:
-           - Check if the store address/branch is in {target_city}.
-           - If NOT in {target_city} -> Set error_code to 5.
-           - If location is missing/unreadable -> Set error_code to 6.
-
-        4. Identify Store Name:
-           - Match against this list: [{stores_list_str}].
-           - If match found -> Use the standard list name.
-           - If NO match -> Extract the generic brand name (exclude branch name).
-           - If store name is missing/unreadable -> Set error_code to 7.
-
-        5. Extract Data (Only if error_code is 0):
-           - Extract "products": List of items (name, english_name, price).
-           - Extract "total_amount": The Grand Total if possible.
-           - Set error_code to 0.
-
-        Constraint: If error_code is NOT 0, set 'store_name' to null, 'total_amount' to 0.0, and 'products' to [].
-    """)
-    return receipt_analysis_instruction
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_gemini_client():
+    """
+    Returns the process-wide Gemini client, creating it on first use.
+    Fork-safe: a process that inherited the client from its parent (gunicorn preload)
+    builds its own, since pooled connections must not be shared across processes.
+    Returns None if GEMINI_API_KEY is not set.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                return None
+
+            http_client = _ClientTimeoutHttpx(
+                timeout=httpx.Timeout(GEMINI_READ_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+            )
+            http_options = types.HttpOptions(httpx_client=http_client)
+            if GEMINI_BASE_URL:
+                http_options.base_url = GEMINI_BASE_URL
+
+            _client = genai.Client(api_key=api_key, http_options=http_options)
+            _client_pid = pid
+    return _client
+
+
+_instruction_cache_name = None
+_instruction_cache_pid = None
+_instruction_cache_expires = 0.0
+_instruction_cache_retry_at = 0.0
+_context_cache_lock = threading.Lock()
+
+
+def _get_instruction_cache_name(client):
+    """
+    Name of this process's Gemini context cache holding the system instruction, created
+    (or re-created shortly before it expires) on demand. None when caching is disabled
+    or Gemini refused to create it; the caller then sends the instruction inline.
+    """
+    global _instruction_cache_name, _instruction_cache_pid, _instruction_cache_expires, _instruction_cache_retry_at
+    if GEMINI_CONTEXT_CACHE_TTL <= 0:
+        return None
+
+    pid = os.getpid()
+    with _context_cache_lock:
+        now = time.monotonic()
+        if _instruction_cache_pid != pid:
+            _instruction_cache_name, _instruction_cache_pid = None, pid
+            _instruction_cache_expires = _instruction_cache_retry_at = 0.0
+        if _instruction_cache_name is not None and now < _instruction_cache_expires:
+            return _instruction_cache_name
+        if now < _instruction_cache_retry_at:
+            return None
+
+        try:
+            cache = client.caches.create(
+                model=GEMINI_MODEL,
+                config=types.CreateCachedContentConfig(
+                    display_name="receipt-analysis-instruction",
+                    system_instruction=RECEIPT_ANALYSIS_SYSTEM_INSTRUCTION,
+                    ttl=f"{GEMINI_CONTEXT_CACHE_TTL}s"
+                )
+            )
+        except Exception as e:
+            metrics.increment("gemini.context_cache_errors")
+            print(f"Gemini context cache unavailable, sending the instruction inline: {e}")
+            _instruction_cache_name = None
+            _instruction_cache_retry_at = now + _CONTEXT_CACHE_RETRY_SECONDS
+            return None
+
+        # Switch to a fresh cache a little before the server drops this one
+        _instruction_cache_name = cache.name
+        _instruction_cache_expires = now + GEMINI_CONTEXT_CACHE_TTL * 0.9
+        return _instruction_cache_name
+
+
+def _drop_instruction_cache(name: str):
+    global _instruction_cache_name
+    with _context_cache_lock:
+        if _instruction_cache_name == name:
+            _instruction_cache_name = None
+
+
+def _generate(client, image_bytes: bytes, instruction: str, cache_name):
+    """One generate_content call; the system instruction comes from the context cache when there is one."""
+    config = {
+        "response_mime_type": "application/json",
+        "response_schema": ReceiptAnalysis,
+    }
+    if cache_name is not None:
+        config["cached_content"] = cache_name
+    else:
+        config["system_instruction"] = RECEIPT_ANALYSIS_SYSTEM_INSTRUCTION
+
+    # Call Gemini 2.5 Flash
+    # 2.5 Flash is currently the fastest model for this task.
+    return client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=[
+            types.Part.from_bytes(
+                data=image_bytes,
+                mime_type='image/webp',
+            ),
+            instruction
+        ],
+        config=config
+    )
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Network failures, timeouts and retryable HTTP statuses."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, errors.APIError) and error.code in _TRANSIENT_STATUS_CODES
+
+
+def _log_retry(retry_state):
+    metrics.increment("gemini.retries")
+    print(f"Gemini attempt {retry_state.attempt_number} failed "
+          f"({retry_state.outcome.exception()}); retrying in {retry_state.next_action.sleep:.1f}s")
 
 
 def analyze_receipt_with_gemini(image_bytes: bytes, instruction: str):
     """
     Sends the image and instruction to Gemini via the Google Gen AI SDK.
     Enforces structured output using Pydantic.
+    Transient failures are retried with jittered exponential backoff; per-call latency
+    goes to the 'gemini.call' timing in the process metrics.
     """
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
+    client = get_gemini_client()
+    if client is None:
         print("Error: GEMINI_API_KEY is not set.")
         return None
 
+    started = time.perf_counter()
     try:
-        # Initialize Client
-        client = genai.Client(api_key=api_key)
-
-        # Call Gemini 2.5 Flash
-        # 2.5 Flash is currently the fastest model for this task.
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[
-                types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type='image/webp',
-                ),
-                instruction
-            ],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": ReceiptAnalysis,
-            }
+        retrying = Retrying(
+            stop=stop_after_attempt(GEMINI_MAX_ATTEMPTS) | stop_after_delay(GEMINI_RETRY_DEADLINE),
+            wait=wait_random_exponential(multiplier=0.5, max=8),
+            retry=retry_if_exception(_is_transient),
+            before_sleep=_log_retry,
+            reraise=True
         )
 
+        cache_name = _get_instruction_cache_name(client)
+        try:
+            response = retrying(_generate, client, image_bytes, instruction, cache_name)
+        except errors.ClientError as e:
+            if cache_name is None or e.code not in (400, 403, 404):
+                raise
+            # The context cache expired or was deleted under us: send the instruction inline
+            print(f"Gemini context cache {cache_name} rejected ({e}); retrying without it")
+            _drop_instruction_cache(cache_name)
+            response = retrying(_generate, client, image_bytes, instruction, None)
+
         return json.loads(response.text)
 
     except Exception as e:
+        metrics.increment("gemini.errors")
         print(f"Gemini Analysis Error: {e}")
         return None
+
+    finally:
+        latency_ms = (time.perf_counter() - started) * 1000
+        metrics.observe("gemini.call", latency_ms)
+        print(f"Gemini call finished in {latency_ms:.0f} ms")
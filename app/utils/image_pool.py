@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from app.utils import metrics
+from imaging.optimizer import optimize_image_stream, optimize_shared
+
+# inline: optimize on the request thread; process: in a per-worker pool of helper processes
+IMAGE_OPTIMIZE_MODE = os.getenv("IMAGE_OPTIMIZE_MODE", "inline")
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", "2"))
+# Jobs queued or running in the pool; further uploads are optimized inline instead of waiting
+IMAGE_POOL_MAX_PENDING = int(os.getenv("IMAGE_POOL_MAX_PENDING", str(IMAGE_POOL_WORKERS * 2)))
+IMAGE_POOL_TIMEOUT_SECONDS = float(os.getenv("IMAGE_POOL_TIMEOUT_SECONDS", "20"))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(IMAGE_POOL_MAX_PENDING)
+
+
+def _get_pool():
+    """One pool per gunicorn worker process, created on first use (never inherited across fork)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Helpers start from a clean forkserver, not by forking a multi-threaded web worker
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # Not app.*: importing the app package would build Flask and connect to MongoDB in every helper
+                context.set_forkserver_preload(["imaging.optimizer"])
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_POOL_WORKERS, mp_context=context)
+            _pool_pid = pid
+    return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def optimize_upload(file_storage):
+    """
+    optimize_image_stream for request handlers: runs it in the helper process pool when
+    IMAGE_OPTIMIZE_MODE is "process", so Pillow's CPU work does not hold this worker's GIL.
+
+    The upload is read once, straight into a shared memory segment the helper decodes
+    in place. When IMAGE_POOL_MAX_PENDING jobs are already queued or running, the image is
+    optimized inline instead. A job that takes longer than IMAGE_POOL_TIMEOUT_SECONDS (or
+    a crashed helper) fails the upload like a bad image: (None, None).
+    """
+    if IMAGE_OPTIMIZE_MODE != "process":
+        return optimize_image_stream(file_storage)
+
+    file_storage.seek(0, os.SEEK_END)
+    size = file_storage.tell()
+    file_storage.seek(0)
+
+    if size == 0 or not _slots.acquire(blocking=False):
+        metrics.increment("image_pool.inline")
+        return optimize_image_stream(file_storage)
+
+    try:
+        segment = shared_memory.SharedMemory(create=True, size=size)
+    except Exception as e:
+        _slots.release()
+        print(f"Image pool shared memory error, optimizing inline: {e}")
+        metrics.increment("image_pool.inline")
+        return optimize_image_stream(file_storage)
+
+    def finish(_future):
+        # The segment lives until the helper is done with it, even after a timeout
+        segment.close()
+        segment.unlink()
+        _slots.release()
+
+    start = time.perf_counter()
+    try:
+        filled = 0
+        with segment.buf[:size] as view:
+            while filled < size:
+                read = file_storage.readinto(view[filled:])
+                if not read:
+                    break
+                filled += read
+        pool = _get_pool()
+        future = pool.submit(optimize_shared, segment.name, filled)
+    except Exception as e:
+        finish(None)
+        print(f"Image pool submit error, optimizing inline: {e}")
+        metrics.increment("image_pool.inline")
+        file_storage.seek(0)
+        return optimize_image_stream(file_storage)
+    future.add_done_callback(finish)
+    metrics.increment("image_pool.submitted")
+
+    try:
+        return future.result(timeout=IMAGE_POOL_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        future.cancel()
+        print(f"Image optimization timed out after {IMAGE_POOL_TIMEOUT_SECONDS}s")
+        metrics.increment("image_pool.timeout")
+        return None, None
+    except BrokenProcessPool as e:
+        print(f"Image pool broken, restarting it: {e}")
+        metrics.increment("image_pool.broken")
+        _discard_pool(pool)
+        return None, None
+    finally:
+        metrics.observe("image_pool.optimize", (time.perf_counter() - start) * 1000)
@@ -0,0 +1,98 @@
+import hmac
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bearer token required by GET /metrics; the web app's route answers 404 while it is unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Process-local counters and gauges. Each gunicorn worker reports its own numbers.
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+def increment(name: str, value=1):
+    """Adds `value` to the counter `name`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value):
+    """Sets the gauge `name` to `value`."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, milliseconds: float):
+    """Records one duration sample under `name` (count, total and max are kept)."""
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "totalMs": 0.0, "maxMs": 0.0})
+        timing["count"] += 1
+        timing["totalMs"] += milliseconds
+        timing["maxMs"] = max(timing["maxMs"], milliseconds)
+
+
+def get_counter(name: str):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    """Returns a copy of all counters, gauges and timings (with their average)."""
+    with _lock:
+        return {
+            # Tells apart the workers answering /metrics behind one address
+            "pid": os.getpid(),
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {
+                name: dict(timing, avgMs=round(timing["totalMs"] / timing["count"], 2))
+                for name, timing in _timings.items()
+            }
+        }
+
+
+def is_authorized(authorization: str) -> bool:
+    """True if the Authorization header is 'Bearer <METRICS_TOKEN>' (and a token is configured)."""
+    scheme, _, token = (authorization or "").partition(" ")
+    return bool(METRICS_TOKEN) and scheme == "Bearer" and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+
+def serve(port: int, host: str = "127.0.0.1"):
+    """
+    Answers GET /metrics with snapshot() on a background thread, in the same envelope as
+    the web app's /metrics. For processes without Flask routes (`flask receipt-worker`).
+    Listens on localhost by default; requires METRICS_TOKEN too when one is set.
+    """
+    from app.models.response import Response
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            if METRICS_TOKEN and not is_authorized(self.headers.get("Authorization")):
+                self.send_error(401)
+                return
+            body = json.dumps(Response(
+                errorStatus=0,
+                message_en="Metrics fetched successfully.",
+                message_ja="メトリクスが正常に取得されました。",
+                result=snapshot()
+            ).to_dict(), ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,254 @@
+import zlib
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# Grams are hashed into this many buckets. The hash is stable across processes
+# (unlike hash()), so arrays built by one worker are valid in another.
+GRAM_BUCKETS = 1 << 22
+
+# Upper bound on the (queries x strings) count matrix built per bincount call
+_MAX_COUNT_CELLS = 1 << 20
+
+
+def extract_ngrams(text: str, sizes=(2, 3)) -> set:
+    """
+    Returns the set of character n-grams of the given sizes.
+    Strings shorter than the smallest size are returned as a single gram
+    so that one-character product names can still be looked up.
+    """
+    if not text:
+        return set()
+
+    text = text.lower()
+    grams = set()
+    for n in sizes:
+        for i in range(len(text) - n + 1):
+            grams.add(text[i:i + n])
+
+    if not grams:
+        grams.add(text)
+    return grams
+
+
+# gram -> gram id. Product names share most of their grams, so this stays small; capped anyway
+_gram_id_memo = {}
+_GRAM_ID_MEMO_SIZE = 1 << 20
+
+
+def _gram_id(gram: str) -> int:
+    gram_id = _gram_id_memo.get(gram)
+    if gram_id is None:
+        gram_id = zlib.crc32(gram.encode("utf-8")) % GRAM_BUCKETS
+        if len(_gram_id_memo) < _GRAM_ID_MEMO_SIZE:
+            _gram_id_memo[gram] = gram_id
+    return gram_id
+
+
+def hash_ngrams(text: str, sizes=(2, 3)) -> list:
+    """Returns the distinct hashed gram ids of `text`."""
+    return list({_gram_id(gram) for gram in extract_ngrams(text, sizes)})
+
+
+class NgramIndex:
+    """
+    Inverted index from hashed character n-grams to the strings containing them.
+
+    Several strings may share one key (e.g. a product's canonical name and its aliases).
+    `shortlist_batch` ranks keys by how many grams they share with each query (Dice coefficient),
+    so only a handful of candidates need an exact similarity check afterwards.
+
+    Strings passed to `build()` live in CSR arrays (gram -> string ids) that are scored with
+    NumPy for a whole batch of queries at once. Strings added afterwards go to a small
+    dict-based overlay, so the index can be extended in place without a rebuild.
+    The CSR arrays can be exported with `to_arrays()` and wrapped again, memory-mapped,
+    with `from_arrays()`.
+    """
+
+    def __init__(self, sizes=(2, 3)):
+        self._sizes = sizes
+
+        # CSR part: strings [0, _base_size)
+        self._base_size = 0
+        self._base_keys = []                             # string_id -> key
+        self._gram_ids = np.empty(0, dtype=np.int64)     # sorted distinct gram ids
+        self._indptr = np.zeros(1, dtype=np.int64)       # gram i -> postings[indptr[i]:indptr[i + 1]]
+        self._postings = np.empty(0, dtype=np.int32)     # string ids
+        self._base_gram_counts = np.empty(0, dtype=np.float64)
+
+        # Overlay: strings [_base_size, len(self))
+        self._overlay_keys = []
+        self._overlay_gram_counts = []
+        self._overlay = defaultdict(list)  # gram id -> [string_id, ...]
+
+    def __len__(self):
+        return self._base_size + len(self._overlay_keys)
+
+    @property
+    def overlay_size(self):
+        return len(self._overlay_keys)
+
+    def add(self, key, text: str):
+        """Indexes `text` under `key` (goes to the overlay until the index is rebuilt)."""
+        grams = hash_ngrams(text, self._sizes)
+        if not grams:
+            return
+
+        string_id = len(self)
+        self._overlay_keys.append(key)
+        self._overlay_gram_counts.append(len(grams))
+        for gram in grams:
+            self._overlay[gram].append(string_id)
+
+    @classmethod
+    def build(cls, entries, sizes=(2, 3)):
+        """Builds an index with every (key, text) pair in the CSR arrays, in one pass."""
+        index = cls(sizes)
+        keys = []
+        gram_counts = []
+        grams_flat = []
+        ids_flat = []
+        for key, text in entries:
+            grams = hash_ngrams(text, sizes)
+            if not grams:
+                continue
+            string_id = len(keys)
+            keys.append(key)
+            gram_counts.append(len(grams))
+            grams_flat.extend(grams)
+            ids_flat.extend([string_id] * len(grams))
+
+        index._load_pairs(
+            np.array(grams_flat, dtype=np.int64), np.array(ids_flat, dtype=np.int64), keys, gram_counts
+        )
+        return index
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, sizes=(2, 3)):
+        """
+        Wraps arrays produced by `to_arrays()` (typically memory-mapped) without copying them.
+        Keys come back as ints, so only indexes with integer keys round-trip.
+        """
+        index = cls(sizes)
+        index._base_keys = arrays["keys"]
+        index._gram_ids = arrays["gram_ids"]
+        index._indptr = arrays["indptr"]
+        index._postings = arrays["postings"]
+        index._base_gram_counts = arrays["gram_counts"]
+        index._base_size = len(arrays["keys"])
+        return index
+
+    def to_arrays(self) -> dict:
+        """The CSR part as plain arrays (integer keys only); the overlay is not included."""
+        return {
+            "keys": np.asarray(self._base_keys, dtype=np.int64),
+            "gram_ids": self._gram_ids,
+            "indptr": self._indptr,
+            "postings": self._postings,
+            "gram_counts": self._base_gram_counts
+        }
+
+    def _load_pairs(self, grams: np.ndarray, string_ids: np.ndarray, keys: list, gram_counts: list):
+        """Replaces the CSR arrays with the given (gram, string) pairs and empties the overlay."""
+        order = np.lexsort((string_ids, grams))
+        grams, string_ids = grams[order], string_ids[order]
+        self._gram_ids, starts = np.unique(grams, return_index=True)
+        self._indptr = np.append(starts, len(grams)).astype(np.int64)
+        self._postings = string_ids.astype(np.int32)
+        self._base_keys = keys
+        self._base_gram_counts = np.array(gram_counts, dtype=np.float64)
+        self._base_size = len(keys)
+        self._overlay_keys = []
+        self._overlay_gram_counts = []
+        self._overlay = defaultdict(list)
+
+    def shortlist_batch(self, texts: list, limit: int = 50) -> list:
+        """
+        Returns, for each text, up to `limit` distinct keys sharing at least one gram
+        with it, best first. The gram counts for all texts are computed in one pass.
+        """
+        query_grams = [np.array(hash_ngrams(text, self._sizes), dtype=np.int64) for text in texts]
+        # Several strings can share a key, so keep more than `limit` strings before deduplicating
+        base_scored = self._score_base(query_grams, limit * 4)
+
+        return [
+            self._rank_keys(base_scored[q] + self._score_overlay(grams), limit)
+            for q, grams in enumerate(query_grams)
+        ]
+
+    def _score_base(self, query_grams: list, keep: int) -> list:
+        """
+        Scores every query against every CSR-indexed string in a few bincount calls.
+        Returns, per query, the `keep` best (score, string_id) pairs.
+        """
+        scored = [[] for _ in query_grams]
+        if not self._base_size or not len(self._gram_ids):
+            return scored
+
+        chunk = max(1, _MAX_COUNT_CELLS // self._base_size)
+        for first in range(0, len(query_grams), chunk):
+            batch = query_grams[first:first + chunk]
+            sizes = np.array([len(g) for g in batch], dtype=np.int64)
+            grams = np.concatenate(batch)
+            query_of = np.repeat(np.arange(len(batch)), sizes)
+
+            # Locate each query gram in the CSR arrays
+            pos = np.minimum(np.searchsorted(self._gram_ids, grams), len(self._gram_ids) - 1)
+            found = self._gram_ids[pos] == grams
+            starts, ends = self._indptr[pos[found]], self._indptr[pos[found] + 1]
+            lengths = ends - starts
+            total = int(lengths.sum())
+            if not total:
+                continue
+
+            # Expand the posting ranges into one flat (query, string) array without a Python loop
+            offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+            string_ids = self._postings[offsets + np.arange(total)]
+            cells = np.repeat(query_of[found], lengths) * self._base_size + string_ids
+
+            # Shared-gram counts = sparse dot product of the binary gram vectors
+            counts = np.bincount(cells, minlength=len(batch) * self._base_size)
+            counts = counts.reshape(len(batch), self._base_size)
+
+            for row, count_row in enumerate(counts):
+                touched = np.flatnonzero(count_row)
+                dice = 2.0 * count_row[touched] / (sizes[row] + self._base_gram_counts[touched])
+                if len(touched) > keep:
+                    best = np.argpartition(dice, -keep)[-keep:]
+                    touched, dice = touched[best], dice[best]
+                scored[first + row] = list(zip(dice.tolist(), touched.tolist()))
+
+        return scored
+
+    def _score_overlay(self, grams: np.ndarray) -> list:
+        """(score, string_id) pairs for overlay strings sharing a gram with the query."""
+        if not self._overlay:
+            return []
+
+        shared = Counter()
+        for gram in grams.tolist():
+            shared.update(self._overlay.get(gram, ()))
+
+        query_size = len(grams)
+        return [
+            (2.0 * count / (query_size + self._overlay_gram_counts[string_id - self._base_size]), string_id)
+            for string_id, count in shared.items()
+        ]
+
+    def _rank_keys(self, scored: list, limit: int) -> list:
+        # Best Dice score per key (a key is as good as its best matching string)
+        best_by_key = {}
+        for score, string_id in scored:
+            key = self._key(string_id)
+            if score > best_by_key.get(key, 0.0):
+                best_by_key[key] = score
+
+        ranked = sorted(best_by_key.items(), key=lambda kv: kv[1], reverse=True)
+        return [key for key, _ in ranked[:limit]]
+
+    def _key(self, string_id: int):
+        if string_id >= self._base_size:
+            return self._overlay_keys[string_id - self._base_size]
+        key = self._base_keys[string_id]
+        # Memory-mapped keys come back as NumPy scalars
+        return key.item() if isinstance(key, np.generic) else key
@@ -0,0 +1,58 @@
+from bisect import bisect_left
+
+from app.utils.text_normalizer import canonicalize_product_name
+
+
+class PrefixIndex:
+    """
+    Immutable prefix index over canonicalized strings (sorted array + bisect).
+
+    Each entry is (key_text, value, rank): `rank` orders entries of equal quality,
+    e.g. canonical names before aliases. Built once, then swapped in whole, so
+    readers never see a half-built index.
+    """
+
+    # Entries examined past the first prefix hit before ranking; bounds the cost of 1-2 character queries
+    MAX_SCAN = 500
+
+    def __init__(self, entries):
+        rows = []
+        for text, value, rank in entries:
+            key = canonicalize_product_name(text)
+            if key:
+                rows.append((key, rank, value))
+        rows.sort(key=lambda row: (row[0], row[1]))
+
+        self._keys = [row[0] for row in rows]
+        self._rows = rows
+
+    def __len__(self):
+        return len(self._keys)
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Returns up to `limit` distinct values whose keys start with the canonicalized query.
+        Exact key matches come first, then better-ranked fields, then shorter keys.
+        """
+        prefix = canonicalize_product_name(query)
+        if not prefix:
+            return []
+
+        start = bisect_left(self._keys, prefix)
+        hits = []
+        for key, rank, value in self._rows[start:start + self.MAX_SCAN]:
+            if not key.startswith(prefix):
+                break
+            hits.append((key != prefix, rank, len(key), key, value))
+
+        hits.sort(key=lambda hit: hit[:4])
+
+        results = []
+        seen = set()
+        for *_, value in hits:
+            if value not in seen:
+                seen.add(value)
+                results.append(value)
+                if len(results) == limit:
+                    break
+        return results
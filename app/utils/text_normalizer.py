@@ -0,0 +1,52 @@
+import re
+import unicodedata
+
+# Katakana block that has a hiragana counterpart exactly 0x60 code points below
+_KATAKANA_START = 0x30A1  # ァ
+_KATAKANA_END = 0x30F6    # ヶ
+_KANA_OFFSET = 0x60
+
+# Unit spellings (after NFKC, casefold and kana folding) -> canonical unit
+_UNIT_MAP = {
+    "みりりっとる": "ml",
+    "りっとる": "l",
+    "きろぐらむ": "kg",
+    "ぐらむ": "g",
+    "cc": "ml",
+}
+# Digit grouping ("1,000ml") is dropped; a decimal point or comma between digits is a "." that is kept
+_THOUSANDS_PATTERN = re.compile(r"(?<=\d),(?=\d{3}(?!\d))")
+_DECIMAL_PATTERN = re.compile(r"(?<=\d)[.,](?=\d)")
+# Units only count as such right after a quantity ("500cc", not "soccer")
+_UNIT_PATTERN = re.compile(r"(?<=\d)(" + "|".join(re.escape(unit) for unit in _UNIT_MAP) + ")")
+
+
+def _fold_kana(text: str) -> str:
+    """Katakana -> Hiragana, so 'オチャ' and 'おちゃ' share a key. The long vowel mark 'ー' is kept."""
+    return "".join(
+        chr(ord(ch) - _KANA_OFFSET) if _KATAKANA_START <= ord(ch) <= _KATAKANA_END else ch
+        for ch in text
+    )
+
+
+def canonicalize_product_name(name: str) -> str:
+    """
+    Builds the lookup key used to treat Gemini's spelling variants of a product as the same name:
+    1. NFKC (full-width/half-width folding, ㍉/㎖ style compatibility characters)
+    2. Case folding
+    3. Katakana -> Hiragana
+    4. Whitespace, punctuation and symbols removed, except a decimal point ("1.5L" is not "15L")
+    5. Unit spellings normalized (ミリリットル/cc -> ml, リットル -> l, グラム -> g)
+    """
+    if not name:
+        return ""
+
+    text = unicodedata.normalize("NFKC", name).casefold()
+    text = _fold_kana(text)
+    # NUL marks kept decimal points while the rest of the punctuation is filtered out
+    text = _DECIMAL_PATTERN.sub("\0", _THOUSANDS_PATTERN.sub("", text.replace("\0", "")))
+    text = "".join(
+        ch for ch in text
+        if ch in ("ー", "\0") or unicodedata.category(ch)[0] not in ("P", "Z", "S", "C")
+    ).replace("\0", ".")
+    return _UNIT_PATTERN.sub(lambda m: _UNIT_MAP[m.group(1)], text)
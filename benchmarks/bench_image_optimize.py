@@ -0,0 +1,147 @@
+"""
+Benchmark: optimize_image_stream's fallback path (full decode + LANCZOS, as before
+draft decoding) against the current one, on typical phone uploads.
+
+Each (image, implementation) pair runs in a fresh interpreter, so the reported peak
+RSS is that of a single optimization on top of the imported modules.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_image_optimize [--repeat 5]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+from werkzeug.datastructures import FileStorage
+
+from imaging.optimizer import compute_image_hash, optimize_image_stream
+
+# (label, width, height, format, EXIF orientation)
+CASES = [
+    ("8 MP JPEG", 3264, 2448, "JPEG", 6),
+    ("12 MP JPEG", 4032, 3024, "JPEG", 6),
+    ("48 MP JPEG", 8064, 6048, "JPEG", 1),
+    ("screenshot PNG", 1179, 2556, "PNG", None),
+    ("12 MP PNG", 4032, 3024, "PNG", None),
+]
+
+
+def make_receipt(width: int, height: int, seed: int = 7) -> Image.Image:
+    """Paper-coloured background, lines of dark 'text' and sensor noise."""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (width, height), (236, 232, 222))
+    draw = ImageDraw.Draw(img)
+    line_height = max(8, height // 90)
+    for y in range(line_height * 4, height - line_height * 4, line_height * 2):
+        x = width // 8
+        while x < width * 7 // 8:
+            word = rng.randint(line_height, line_height * 6)
+            draw.rectangle((x, y, x + word, y + line_height), fill=(40, 40, 45))
+            x += word + line_height
+    noise = Image.effect_noise((width, height), 24).convert("RGB")
+    return Image.blend(img, noise, 0.15)
+
+
+def encode(img: Image.Image, image_format: str, orientation) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        img.save(buffer, format="JPEG", quality=90, exif=exif)
+    else:
+        img.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def legacy_optimize(file_storage, max_dimension=1500, quality=80):
+    """The pre-draft implementation of optimize_image_stream's fallback path."""
+    img = Image.open(file_storage)
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    width, height = img.size
+    max_side = max(width, height)
+    if max_side > max_dimension:
+        scale_factor = max_dimension / max_side
+        img = img.resize((int(width * scale_factor), int(height * scale_factor)), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="WEBP", quality=quality, method=4)
+    return buffer.getvalue(), compute_image_hash(img)
+
+
+def peak_rss_kb() -> int:
+    """High-water RSS of this process (ru_maxrss is no use here: Linux carries it over from the parent)."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    raise RuntimeError("VmHWM not available (this benchmark needs Linux)")
+
+
+def measure(path: str, mimetype: str, implementation: str, repeat: int) -> dict:
+    """Runs in the child interpreter: a first run for the peak RSS, then timed repeats."""
+    with open(path, "rb") as f:
+        data = f.read()
+    optimize = legacy_optimize if implementation == "legacy" else optimize_image_stream
+
+    baseline_kb = peak_rss_kb()
+    output, _ = optimize(FileStorage(stream=io.BytesIO(data), content_type=mimetype))
+    peak_kb = peak_rss_kb()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        optimize(FileStorage(stream=io.BytesIO(data), content_type=mimetype))
+    elapsed = (time.perf_counter() - start) / repeat
+
+    return {"ms": elapsed * 1000, "peak_mb": (peak_kb - baseline_kb) / 1024, "out_kb": len(output) / 1024,
+            "size": Image.open(io.BytesIO(output)).size}
+
+
+def run_case(label, width, height, image_format, orientation, repeat, workdir):
+    path = os.path.join(workdir, f"{width}x{height}.{image_format.lower()}")
+    with open(path, "wb") as f:
+        f.write(encode(make_receipt(width, height), image_format, orientation))
+    mimetype = f"image/{image_format.lower()}"
+
+    results = {}
+    for implementation in ("legacy", "current"):
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_image_optimize", "--child", path, mimetype, implementation,
+             "--repeat", str(repeat)],
+            check=True, capture_output=True, text=True
+        )
+        results[implementation] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    legacy, current = results["legacy"], results["current"]
+    print(f"{label:>15} ({os.path.getsize(path) / 1e6:5.1f} MB) | "
+          f"legacy {legacy['ms']:7.1f} ms {legacy['peak_mb']:6.1f} MB peak | "
+          f"current {current['ms']:7.1f} ms {current['peak_mb']:6.1f} MB peak | "
+          f"x{legacy['ms'] / current['ms']:4.1f} faster | output {tuple(current['size'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--child", nargs=3, metavar=("PATH", "MIMETYPE", "IMPLEMENTATION"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(*args.child, repeat=args.repeat)))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in CASES:
+            run_case(*case, repeat=args.repeat, workdir=tmp)
@@ -0,0 +1,90 @@
+"""
+Benchmark: fuzzy product matching, linear SequenceMatcher scan vs n-gram shortlist,
+one name at a time and a whole receipt's worth of names in one batch.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_product_match [--sizes 1000 10000 100000] [--queries 30]
+"""
+import argparse
+import random
+import time
+from difflib import SequenceMatcher
+
+from app.models.collections.product import Product
+
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+KANJI = "牛乳茶緑麦豆腐肉鶏豚魚米酒水塩糖油味噌醤辛甘"
+SIZES = ["500ml", "1L", "350ml", "200g", "6個", "12本", ""]
+
+
+def make_name(rng: random.Random) -> str:
+    word = "".join(rng.choice(KATAKANA) for _ in range(rng.randint(3, 8)))
+    extra = "".join(rng.choice(KANJI) for _ in range(rng.randint(0, 3)))
+    return f"{word}{extra}{rng.choice(SIZES)}"
+
+
+def make_variant(rng: random.Random, name: str) -> str:
+    """A Gemini-style misread: one character replaced."""
+    chars = list(name)
+    chars[rng.randrange(len(chars))] = rng.choice(KATAKANA)
+    return "".join(chars)
+
+
+def linear_scan(catalog, input_name, threshold=0.85):
+    """The fuzzy tier as it was before the n-gram index: SequenceMatcher over every product."""
+    best_doc, best_ratio = None, 0.0
+    for doc in catalog:
+        ratio = SequenceMatcher(None, input_name, doc.get('name', '')).ratio()
+        if ratio < threshold and 'aliases' in doc:
+            for alias in doc['aliases']:
+                ratio = max(ratio, SequenceMatcher(None, input_name, alias).ratio())
+        if ratio > best_ratio:
+            best_ratio, best_doc = ratio, doc
+    return (best_doc, best_ratio) if best_ratio >= threshold else (None, 0.0)
+
+
+def time_per_query(fn, queries):
+    start = time.perf_counter()
+    results = [fn(q) for q in queries]
+    return (time.perf_counter() - start) / len(queries), results
+
+
+def run(size: int, n_queries: int, seed: int = 7):
+    rng = random.Random(seed)
+    catalog = [{"_id": i, "name": make_name(rng), "aliases": []} for i in range(size)]
+    for doc in rng.sample(catalog, size // 10):
+        doc["aliases"].append(make_variant(rng, doc["name"]))
+
+    # Half near-duplicates of catalog entries, half unseen products
+    queries = [make_variant(rng, rng.choice(catalog)["name"]) for _ in range(n_queries // 2)]
+    queries += [make_name(rng) for _ in range(n_queries - len(queries))]
+
+    start = time.perf_counter()
+    Product._set_cache(catalog)
+    build_s = time.perf_counter() - start
+
+    # The full scan is slow at large sizes; a few queries are enough for a stable average
+    linear_queries = queries[:max(3, n_queries * 1000 // size)]
+    linear_s, linear_results = time_per_query(lambda q: linear_scan(catalog, q), linear_queries)
+    index_s, index_results = time_per_query(lambda q: Product._fuzzy_match_batch([q])[0], queries)
+
+    start = time.perf_counter()
+    batch_results = Product._fuzzy_match_batch(queries)
+    batch_s = (time.perf_counter() - start) / len(queries)
+
+    agree = sum(1 for a, b in zip(linear_results, index_results) if a[0] is b[0])
+    assert [r[0] for r in batch_results] == [r[0] for r in index_results]
+    print(f"{size:>7} products | index build {build_s * 1000:8.1f} ms | "
+          f"linear {linear_s * 1000:9.2f} ms/query | indexed {index_s * 1000:7.3f} ms/query | "
+          f"batch {batch_s * 1000:7.3f} ms/query | speedup x{linear_s / batch_s:7.1f} | "
+          f"same match {agree}/{len(linear_queries)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=30)
+    args = parser.parse_args()
+
+    for catalog_size in args.sizes:
+        run(catalog_size, args.queries)
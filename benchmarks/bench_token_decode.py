@@ -0,0 +1,84 @@
+"""
+Benchmark: per-request cost of token authentication, verifying the JWT on every call
+(as before the token cache) against answering repeat tokens from the cache.
+
+Times decode_auth_token alone and the whole @token_required wrapper (header parsing,
+decoding, calling the view) inside a Flask request context. The user lookup is replaced
+by a constant so the numbers show the token handling only, not MongoDB.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_token_decode [--calls 20000] [--tokens 1 100]
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+
+import jwt
+
+from app import app
+from app.utils import auth_helper
+
+
+def legacy_decode(auth_token: str):
+    """decode_auth_token before the token cache: full verification on every call."""
+    try:
+        payload = jwt.decode(auth_token, auth_helper.SECRET_KEY, algorithms=['HS256'])
+        if payload['exp'] < datetime.now(timezone.utc).timestamp():
+            return None
+        return payload['sub']
+    except jwt.ExpiredSignatureError:
+        return 'Signature expired'
+    except jwt.InvalidTokenError:
+        return 'Invalid token'
+    except Exception:
+        return 'Token error'
+
+
+@auth_helper.token_required
+def view(current_user):
+    return current_user['_id']
+
+
+def per_call_us(fn, tokens: list, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(tokens[i % len(tokens)])
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def call_view(token: str):
+    with app.test_request_context(headers={"Authorization": f"Bearer {token}"}):
+        return view()
+
+
+def run(n_tokens: int, calls: int):
+    tokens = [auth_helper.encode_auth_token(f"{i:024x}") for i in range(n_tokens)]
+
+    auth_helper.decode_auth_token = legacy_decode
+    legacy_decode_us = per_call_us(legacy_decode, tokens, calls)
+    legacy_view_us = per_call_us(call_view, tokens, calls)
+
+    auth_helper.decode_auth_token = cached_decode
+    auth_helper._token_cache.clear()
+    cached_decode_us = per_call_us(cached_decode, tokens, calls)
+    cached_view_us = per_call_us(call_view, tokens, calls)
+
+    assert [cached_decode(t) for t in tokens] == [legacy_decode(t) for t in tokens]
+    print(f"{n_tokens:>5} tokens | decode {legacy_decode_us:7.2f} -> {cached_decode_us:6.2f} us "
+          f"(x{legacy_decode_us / cached_decode_us:5.1f}) | "
+          f"@token_required {legacy_view_us:7.2f} -> {cached_view_us:6.2f} us "
+          f"(x{legacy_view_us / cached_view_us:4.1f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1, 100], help="distinct tokens in rotation")
+    args = parser.parse_args()
+
+    auth_helper.SECRET_KEY = auth_helper.SECRET_KEY or "benchmark-secret-key-of-32-bytes!"
+    auth_helper._load_current_user = lambda user_id, fields, cached: {"_id": user_id}
+    cached_decode = auth_helper.decode_auth_token
+
+    for token_count in args.tokens:
+        run(token_count, args.calls)
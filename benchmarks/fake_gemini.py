@@ -0,0 +1,174 @@
+"""
+Stand-in for the Gemini API surface analyze_receipt_with_gemini uses, for load tests
+that must not spend real quota:
+
+    POST /v1beta/models/<model>:generateContent   -> a canned ReceiptAnalysis as JSON text
+    POST /v1beta/cachedContents                   -> a context cache handle
+
+Latency is drawn per request from a fixed, uniform or lognormal distribution, and a
+fraction of requests fail with retryable HTTP statuses.
+
+Usage (from the repository root):
+    python -m benchmarks.fake_gemini [--port 8090] [--latency-ms 2500] [--latency-dist lognormal]
+        [--latency-sigma 0.35] [--error-rate 0.02] [--error-statuses 429 503] [--payloads FILE]
+
+Then start the app with GEMINI_BASE_URL=http://127.0.0.1:8090 and any GEMINI_API_KEY.
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STORES = ["FamilyMart", "Lawson", "7-Eleven", "Seicomart", "AEON", "Co-op", "Satudora"]
+PRODUCTS = [
+    ("おにぎり 鮭", "Salmon Rice Ball"), ("緑茶 500ml", "Green Tea 500ml"), ("牛乳 1L", "Milk 1L"),
+    ("食パン 6枚", "Sliced Bread 6pc"), ("卵 10個", "Eggs 10pc"), ("バナナ", "Banana"),
+    ("カップ麺 醤油", "Cup Noodle Soy Sauce"), ("ヨーグルト", "Yogurt"), ("豆腐", "Tofu"),
+    ("納豆 3個", "Natto 3pc"), ("鶏むね肉", "Chicken Breast"), ("コーヒー 缶", "Canned Coffee"),
+    ("ポテトチップス", "Potato Chips"), ("チョコレート", "Chocolate"), ("ミネラルウォーター 2L", "Mineral Water 2L"),
+    ("サラダ", "Salad"), ("唐揚げ弁当", "Fried Chicken Bento"), ("アイスクリーム", "Ice Cream"),
+]
+
+
+def random_analysis(rng: random.Random) -> dict:
+    """A successful ReceiptAnalysis with a few products at slightly varying prices."""
+    products = [
+        {"name": name, "english_name": english, "price": float(rng.randrange(80, 600, 10))}
+        for name, english in rng.sample(PRODUCTS, rng.randint(3, 8))
+    ]
+    return {
+        "error_code": 0,
+        "store_name": rng.choice(STORES),
+        "total_amount": sum(product["price"] for product in products),
+        "products": products
+    }
+
+
+# Google RPC status names for the injected HTTP errors
+STATUS_NAMES = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE", 504: "DEADLINE_EXCEEDED"}
+
+
+class FakeGemini:
+    def __init__(self, latency_ms: float, latency_dist: str, latency_sigma: float,
+                 error_rate: float, error_statuses: list, payloads: list = None, seed: int = 7):
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.payloads = payloads
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cache_ids = 0
+        self.stats = {"requests": 0, "errors": 0}
+
+    def draw_latency(self) -> float:
+        """Seconds to wait before answering; latency_ms is the median."""
+        with self._lock:
+            if self.latency_dist == "fixed":
+                ms = self.latency_ms
+            elif self.latency_dist == "uniform":
+                ms = self._rng.uniform(0, 2 * self.latency_ms)
+            else:
+                ms = self._rng.lognormvariate(math.log(max(self.latency_ms, 1e-3)), self.latency_sigma)
+        return ms / 1000
+
+    def draw_outcome(self):
+        """(HTTP status, body) for one generateContent call."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self._rng.random() < self.error_rate:
+                self.stats["errors"] += 1
+                status = self._rng.choice(self.error_statuses)
+                error = {
+                    "code": status,
+                    "message": "Injected by fake_gemini",
+                    "status": STATUS_NAMES.get(status, "UNKNOWN")
+                }
+                return status, {"error": error}
+            analysis = self._rng.choice(self.payloads) if self.payloads else random_analysis(self._rng)
+
+        return 200, {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": json.dumps(analysis, ensure_ascii=False)}]},
+                "finishReason": "STOP",
+                "index": 0
+            }],
+            "usageMetadata": {"promptTokenCount": 1800, "candidatesTokenCount": 300, "totalTokenCount": 2100},
+            "modelVersion": "fake-gemini"
+        }
+
+    def create_cache(self, request: dict) -> dict:
+        with self._lock:
+            self._cache_ids += 1
+            cache_id = self._cache_ids
+        ttl = float(str(request.get("ttl", "3600s")).rstrip("s"))
+        return {
+            "name": f"cachedContents/fake-{cache_id}",
+            "model": request.get("model"),
+            "displayName": request.get("displayName"),
+            "expireTime": (datetime.now(timezone.utc) + timedelta(seconds=ttl)).isoformat()
+        }
+
+
+def make_handler(fake: FakeGemini):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            path = self.path.split("?")[0]
+
+            if path.endswith(":generateContent"):
+                time.sleep(fake.draw_latency())
+                self._send(*fake.draw_outcome())
+            elif path.endswith("/cachedContents"):
+                self._send(200, fake.create_cache(request))
+            else:
+                self._send(404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=2500, help="median response time")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.35, help="lognormal shape (spread of the tail)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with an error")
+    parser.add_argument("--error-statuses", type=int, nargs="+", default=[429, 503])
+    parser.add_argument("--payloads", help="JSON file with a list of ReceiptAnalysis objects to answer with")
+    args = parser.parse_args()
+
+    canned = None
+    if args.payloads:
+        with open(args.payloads, encoding="utf-8") as f:
+            canned = json.load(f)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(FakeGemini(
+        args.latency_ms, args.latency_dist, args.latency_sigma, args.error_rate, args.error_statuses, canned
+    )))
+    server.daemon_threads = True
+    print(f"Fake Gemini listening on http://{args.host}:{args.port} "
+          f"({args.latency_dist} latency, median {args.latency_ms:.0f} ms, error rate {args.error_rate:.1%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
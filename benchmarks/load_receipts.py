@@ -0,0 +1,260 @@
+"""
+End-to-end load test of receipt uploads: PUT /product/ with receipt images against a
+running app, its database and (normally) benchmarks.fake_gemini in place of Gemini.
+
+Reports throughput, client-side p50/p95/p99 latency and the server's per-stage timings
+(image optimization, Gemini call, product upsert, user stats), read from /metrics.
+In async mode (202 responses) each receipt is polled until it leaves PENDING, so the
+latency is upload to result.
+
+Setup (from the repository root, three shells, same .env / MONGO_DB_URI / JWT_SECRET_KEY):
+    python -m benchmarks.fake_gemini --latency-ms 2500
+    GEMINI_BASE_URL=http://127.0.0.1:8090 GEMINI_API_KEY=fake gunicorn -w 2 --threads 8 app:app
+    python -m benchmarks.load_receipts [--base-url http://127.0.0.1:8000] [--requests 200]
+        [--concurrency 16] [--users 50] [--images DIR]
+
+In async mode (RECEIPT_PROCESSING_MODE=async) the AI, product upsert and user stats stages
+run in `flask receipt-worker`, which the app's /metrics never reaches. Start the worker
+with --metrics-port and pass its address, so those stages are measured too:
+    flask receipt-worker --metrics-port 9100
+    python -m benchmarks.load_receipts ... --worker-metrics http://127.0.0.1:9100
+
+/metrics is only served with METRICS_TOKEN set; the load test sends the same token
+(--metrics-token, default: METRICS_TOKEN from the environment).
+
+Load-test users (username 'loadtest-...') and their receipts are deleted afterwards
+unless --keep is given; products written by the run stay.
+"""
+import argparse
+import glob
+import io
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from app.models.collections.user import User
+from app.models.collections.receipt import Receipt
+from app.utils.auth_helper import encode_auth_token
+
+# Server timings reported per stage, in pipeline order
+STAGES = [
+    ("image", "receipt.image"),
+    ("AI", "gemini.call"),
+    ("product upsert", "receipt.product_upsert"),
+    ("user stats", "receipt.user_stats"),
+]
+
+ITEMS = ["ONIGIRI SAKE", "GREEN TEA 500ML", "MILK 1L", "BREAD 6P", "EGGS 10P", "BANANA", "CUP NOODLE",
+         "YOGURT", "TOFU", "NATTO 3P", "CHICKEN", "COFFEE CAN", "CHIPS", "CHOCOLATE", "WATER 2L", "SALAD"]
+
+TERMINAL_STATUSES = {"SUCCESS", "FAILED"}
+
+
+def make_receipt(rng: random.Random, width: int = 1080, height: int = 2200) -> bytes:
+    """A receipt-like JPEG with random lines, so every upload differs (no duplicate or cache hits)."""
+    img = Image.new("L", (width, height), 235)
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=44)
+    y = 120
+    draw.text((width // 4, y), f"STORE #{rng.randint(100, 999)}", fill=20, font=font)
+    y += 140
+    while y < height - 300:
+        draw.text((80, y), rng.choice(ITEMS), fill=25, font=font)
+        draw.text((width - 300, y), f"{rng.randint(80, 900):>5} YEN", fill=25, font=font)
+        y += rng.randint(60, 110)
+    draw.text((80, height - 220), f"TOTAL {rng.randint(1000, 9999)} YEN", fill=15, font=font)
+
+    noise = np.asarray(img, dtype=np.int16) + np.random.default_rng(rng.randrange(1 << 30)).integers(
+        -12, 12, size=(height, width), dtype=np.int16)
+    buffer = io.BytesIO()
+    Image.fromarray(noise.clip(0, 255).astype(np.uint8)).convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def jitter_photo(rng: random.Random, data: bytes) -> bytes:
+    """A real photo with a small random crop: same receipt, different bytes (defeats the analysis cache)."""
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    img.thumbnail((1500, 1500))
+    width, height = img.size
+    dx, dy = rng.randint(0, width // 50), rng.randint(0, height // 50)
+    buffer = io.BytesIO()
+    img.crop((dx, dy, width - rng.randint(0, width // 50), height - dy)).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def prepare_uploads(n_requests: int, n_users: int, images_dir: str, rng: random.Random) -> list:
+    """Image bytes per request, generated up front so the harness itself stays cheap while timing."""
+    if not images_dir:
+        return [make_receipt(rng) for _ in range(n_requests)]
+
+    photos = []
+    for path in sorted(glob.glob(f"{images_dir}/*")):
+        with open(path, "rb") as f:
+            photos.append(f.read())
+    if not photos:
+        raise SystemExit(f"No images in {images_dir}")
+    if n_requests > n_users * len(photos):
+        print("Warning: more requests than (user, image) pairs; repeats will be rejected as duplicates.")
+    # Request i goes to user i % n_users; each user gets each photo at most once
+    return [jitter_photo(rng, photos[(i // n_users) % len(photos)]) for i in range(n_requests)]
+
+
+def create_users(n_users: int, run_id: str) -> list:
+    """(user_id, token) pairs for fresh load-test users."""
+    users = []
+    for i in range(n_users):
+        user_id = User.create_user(f"loadtest-{run_id}-{i}")
+        if user_id is None:
+            raise SystemExit("Could not create load-test users (is MONGO_DB_URI set?)")
+        users.append((user_id, encode_auth_token(str(user_id))))
+    return users
+
+
+def delete_users(users: list):
+    user_ids = [user_id for user_id, _ in users]
+    Receipt.get_collection().delete_many({"userId": {"$in": user_ids}})
+    User.get_collection().delete_many({"_id": {"$in": user_ids}})
+
+
+def collect_timings(client: httpx.Client, samples: int, worker_urls: list = ()) -> dict:
+    """
+    pid -> timings, from repeated /metrics calls (each answers from whichever web worker got it)
+    plus one call per receipt worker metrics address.
+    """
+    by_pid = {}
+    urls = ["/metrics"] * samples + [f"{url.rstrip('/')}/metrics" for url in worker_urls]
+    for url in urls:
+        try:
+            result = client.get(url).json()["result"]
+        except Exception:
+            continue
+        by_pid[result.get("pid")] = result.get("timings", {})
+    return by_pid
+
+
+def stage_deltas(before: dict, after: dict) -> dict:
+    """metric -> (count, total ms) accumulated during the run, summed over the workers seen."""
+    deltas = {}
+    for pid, timings in after.items():
+        for _, metric in STAGES:
+            end = timings.get(metric, {"count": 0, "totalMs": 0.0})
+            start = before.get(pid, {}).get(metric, {"count": 0, "totalMs": 0.0})
+            count, total = deltas.get(metric, (0, 0.0))
+            deltas[metric] = (count + end["count"] - start["count"], total + end["totalMs"] - start["totalMs"])
+    return deltas
+
+
+class LoadRun:
+    def __init__(self, base_url: str, users: list, uploads: list, poll_interval: float, timeout: float):
+        self.base_url = base_url
+        self.users = users
+        self.uploads = uploads
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.latencies = []
+        self.outcomes = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _client(self) -> httpx.Client:
+        if not hasattr(self._local, "client"):
+            self._local.client = httpx.Client(base_url=self.base_url, timeout=self.timeout)
+        return self._local.client
+
+    def _record(self, outcome: str, started: float):
+        with self._lock:
+            self.latencies.append(time.perf_counter() - started)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def upload(self, i: int):
+        _, token = self.users[i % len(self.users)]
+        headers = {"Authorization": f"Bearer {token}"}
+        client = self._client()
+
+        started = time.perf_counter()
+        try:
+            response = client.put("/product/", headers=headers,
+                                  files={"receiptImage": ("receipt.jpg", self.uploads[i], "image/jpeg")})
+        except httpx.HTTPError as e:
+            self._record(type(e).__name__, started)
+            return
+
+        if response.status_code != 202:
+            self._record(str(response.status_code), started)
+            return
+
+        # Async mode: poll until the worker is done with it
+        receipt_id = response.json()["result"]["receiptId"]
+        deadline = started + self.timeout
+        while time.perf_counter() < deadline:
+            time.sleep(self.poll_interval)
+            status = client.get(f"/user/receipt/{receipt_id}", headers=headers).json()["result"]["status"]
+            if status in TERMINAL_STATUSES:
+                self._record(f"202 -> {status}", started)
+                return
+        self._record("202 -> timeout", started)
+
+
+def report(run: LoadRun, elapsed: float, deltas: dict):
+    latencies = np.array(run.latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+    print(f"\n{len(latencies)} uploads in {elapsed:.1f} s -> {len(latencies) / elapsed:.2f} uploads/s")
+    print(f"latency ms: p50 {p50:.0f} | p95 {p95:.0f} | p99 {p99:.0f} | max {latencies.max(initial=0):.0f}")
+    print("outcomes: " + ", ".join(f"{outcome} x{count}" for outcome, count in sorted(run.outcomes.items())))
+
+    print("\nserver stages (web and receipt workers seen on /metrics):")
+    for label, metric in STAGES:
+        count, total = deltas.get(metric, (0, 0.0))
+        average = f"{total / count:8.1f} ms avg" if count else "       - (no samples)"
+        print(f"  {label:>15}: {average} over {count} calls")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=50, help="uploads are spread over this many new users")
+    parser.add_argument("--images", help="directory of real receipt photos (default: synthetic receipts)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per upload, including polling")
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--metrics-samples", type=int, default=40, help="/metrics calls per snapshot")
+    parser.add_argument("--worker-metrics", nargs="*", default=[], metavar="URL",
+                        help="metrics addresses of `flask receipt-worker --metrics-port` processes (async mode)")
+    parser.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN", ""),
+                        help="bearer token for /metrics (the server's METRICS_TOKEN)")
+    parser.add_argument("--keep", action="store_true", help="keep the load-test users and receipts")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    random_source = random.Random(args.seed)
+    print(f"Preparing {args.requests} uploads...")
+    upload_images = prepare_uploads(args.requests, args.users, args.images, random_source)
+    load_users = create_users(args.users, uuid.uuid4().hex[:8])
+
+    try:
+        metrics_headers = {"Authorization": f"Bearer {args.metrics_token}"}
+        with httpx.Client(base_url=args.base_url, timeout=10, headers=metrics_headers) as metrics_client:
+            timings_before = collect_timings(metrics_client, args.metrics_samples, args.worker_metrics)
+            load = LoadRun(args.base_url, load_users, upload_images, args.poll_interval, args.timeout)
+
+            run_started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(load.upload, range(args.requests)))
+            run_elapsed = time.perf_counter() - run_started
+
+            # Let the background user-stats updates land before reading the metrics
+            time.sleep(1.0)
+            timings_after = collect_timings(metrics_client, args.metrics_samples, args.worker_metrics)
+
+        report(load, run_elapsed, stage_deltas(timings_before, timings_after))
+    finally:
+        if not args.keep:
+            delete_users(load_users)
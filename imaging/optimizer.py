@@ -0,0 +1,205 @@
+"""
+Pillow-only upload optimization: format sniffing, draft decoding, resizing and the
+perceptual hash. A package of its own, free of `app` imports, so the image pool's
+helper processes load it without building the Flask app or connecting to MongoDB.
+"""
+import io
+import math
+import os
+from multiprocessing import shared_memory
+
+from PIL import ExifTags, Image, ImageOps
+
+
+# Perceptual hash grid (width x height; receipts are tall): 256 bits
+IMAGE_HASH_GRID = (8, 32)
+IMAGE_HASH_BITS = IMAGE_HASH_GRID[0] * IMAGE_HASH_GRID[1]
+
+# Uploads we accept: Pillow format -> (offset, magic bytes) pairs its header must contain
+IMAGE_SIGNATURES = {
+    "JPEG": ((0, b"\xff\xd8\xff"),),
+    "PNG": ((0, b"\x89PNG\r\n\x1a\n"),),
+    "WEBP": ((0, b"RIFF"), (8, b"WEBP")),
+}
+
+# EXIF orientation -> transpose that makes the image upright
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Refuse to decode anything bigger (decompression bombs); 50 MP covers current phone sensors
+MAX_UPLOAD_PIXELS = 50_000_000
+
+
+def compute_image_hash(img) -> int:
+    """
+    256-bit perceptual (average) hash of the receipt's printed area: grayscale, crop to
+    the ink, shrink to an 8x32 grid and set one bit per cell darker than the median.
+    Re-photographs of the same receipt land within a few bits of each other, unlike their bytes.
+    (A 64-bit dHash is too coarse here: different receipts from one store collide.)
+    """
+    gray = img.convert("L")
+    gray.thumbnail((256, 1024), Image.Resampling.BOX)
+    gray = ImageOps.autocontrast(gray, cutoff=1)
+
+    # Margins differ from shot to shot; the printed block does not
+    box = ImageOps.invert(gray).point(lambda p: 255 if p > 96 else 0).getbbox()
+    if box:
+        gray = gray.crop(box)
+
+    cells = gray.resize(IMAGE_HASH_GRID, Image.Resampling.BOX).tobytes()
+    median = sorted(cells)[len(cells) // 2]
+    bits = 0
+    for value in cells:
+        bits = (bits << 1) | (value < median)
+    return bits
+
+
+def sniff_image_format(header: bytes):
+    """Pillow format name for a supported image header, None for anything else (PDFs, HEIC, junk)."""
+    for image_format, signature in IMAGE_SIGNATURES.items():
+        if all(header[offset:offset + len(magic)] == magic for offset, magic in signature):
+            return image_format
+    return None
+
+
+def _open_image(fp, image_format: str):
+    """Opens the image lazily, rejecting it on its header size before any pixels are decoded."""
+    img = Image.open(fp, formats=[image_format])
+    width, height = img.size
+    if width * height > MAX_UPLOAD_PIXELS:
+        raise ValueError(f"image too large ({width}x{height})")
+    return img
+
+
+def _decode_for_upload(file_storage, image_format: str, max_dimension: int):
+    """
+    Decodes just enough of the image for a `max_dimension` result, in RGB.
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg itself (draft mode), so a
+    12 MP photo never exists in memory at full size.
+    Returns (image, EXIF orientation transpose to apply once it is small, or None).
+    """
+    img = _open_image(file_storage, image_format)
+    width, height = img.size
+
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+
+    max_side = max(width, height)
+    if image_format == "JPEG" and max_side > max_dimension:
+        scale = max_dimension / max_side
+        # Draft picks the largest reduction that still covers the requested size
+        img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+
+    # Handle Transparency
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img, EXIF_TRANSPOSE.get(orientation)
+
+
+def _resize_longest_edge(img, max_dimension: int):
+    width, height = img.size
+    max_side = max(width, height)
+    if max_side <= max_dimension:
+        return img
+
+    scale_factor = max_dimension / max_side
+    new_size = (max(1, int(width * scale_factor)), max(1, int(height * scale_factor)))
+    if max_side / max_dimension >= 2:
+        # Large factor (PNG screenshots, non-JPEG photos): box-reduce to ~2x, then a cheap bicubic pass
+        return img.resize(new_size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    return img.resize(new_size, Image.Resampling.LANCZOS)
+
+
+def optimize_image_stream(file_storage, max_dimension=1500, quality=80):
+    """
+    Smart Optimization:
+    1. If file is already small (<1MB) and WebP -> Return bytes immediately.
+    2. Otherwise -> Resize and compress (Fallback for API clients/errors).
+    Anything that is not a JPEG/PNG/WebP by its header is rejected before decoding.
+    Returns (optimized bytes, perceptual hash of the image), or (None, None) on failure.
+    """
+    try:
+        # 1. Get file size without reading into memory yet
+        file_storage.seek(0, os.SEEK_END)
+        file_size = file_storage.tell()
+        file_storage.seek(0)  # Reset cursor to start
+
+        # The MIME type is whatever the client claims; the header is what Pillow will see
+        image_format = sniff_image_format(file_storage.read(16))
+        file_storage.seek(0)
+        if image_format is None:
+            raise ValueError("not a supported image format")
+
+        # SMART CHECK: If frontend did its job, don't re-compress (Avoids generation loss)
+        # Check if size is < 1MB and the file really is WebP
+        if file_size < 1 * 1024 * 1024 and image_format == "WEBP":
+            image_bytes = file_storage.read()
+            # Hashing decodes it, so the pixel limit applies here too
+            return image_bytes, compute_image_hash(_open_image(io.BytesIO(image_bytes), image_format))
+
+        # --- Fallback (Heavy Processing) ---
+        # Only runs if user bypasses frontend or sends a massive raw PNG
+        img, transpose = _decode_for_upload(file_storage, image_format, max_dimension)
+        img = _resize_longest_edge(img, max_dimension)
+        if transpose is not None:
+            # Phones store portrait shots sideways plus an orientation tag, which the WebP would lose
+            img = img.transpose(transpose)
+
+        # Compress
+        buffer = io.BytesIO()
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+        return buffer.getvalue(), compute_image_hash(img)
+
+    except Exception as e:
+        print(f"Optimization Error: {e}")
+        return None, None
+
+
+class _SharedBufferReader(io.RawIOBase):
+    """Seekable file over a memoryview, so Pillow reads the shared upload in place."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        chunk = self._buffer[self._position:self._position + len(target)]
+        target[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._buffer)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def optimize_shared(name: str, size: int):
+    """Image pool side: optimizes the upload sitting in shared memory segment `name`."""
+    segment = shared_memory.SharedMemory(name=name)
+    view = segment.buf[:size]
+    try:
+        return optimize_image_stream(io.BufferedReader(_SharedBufferReader(view)))
+    finally:
+        view.release()
+        segment.close()